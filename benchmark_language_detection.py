@@ -0,0 +1,128 @@
+# coding=utf-8
+"""
+Benchmark of the language detection of queries.
+
+The historical user queries (or built-in samples in several languages, when there is no history yet)
+are detected with:
+- langid: the previous path, `langid.classify` called by each step of a turn
+- script: the Unicode-script fast path with the langid fallback, without memoization
+- memoized: the language detector of the server, whose LRU is warm after the first pass
+
+The time to load the langid model, the latency percentiles of each path, the share of queries served
+by the fast path and the agreement of the fast path with langid are reported.
+
+Usage:
+    python benchmark_language_detection.py --max-queries 1000 --rounds 5
+"""
+import argparse
+import sqlite3
+import time
+from typing import Callable, List
+import numpy as np
+from server.constant.constants import SQLITE_DB_DIR, SQLITE_DB_NAME
+
+SAMPLE_QUERIES = [
+    "How do I deploy the service with docker?",
+    "What is the maximum size of a group chat?",
+    "如何使用 Docker 部署服务？",
+    "OpenIM 怎么部署",
+    "群聊最多支持多少人",
+    "Dockerでサービスをデプロイする方法は？",
+    "グループチャットの最大人数は？",
+    "도커로 서비스를 배포하려면 어떻게 해야 하나요?",
+    "Как развернуть сервис с помощью Docker?",
+    "كيف يمكنني نشر الخدمة باستخدام Docker؟",
+    "डॉकर के साथ सेवा कैसे तैनात करें?",
+    "Comment déployer le service avec Docker ?",
+    "¿Cómo despliego el servicio con Docker?",
+    "Wie stelle ich den Dienst mit Docker bereit?",
+    "Como faço para implantar o serviço com o Docker?",
+    "How to log in with 微信",
+    "Hello",
+]
+
+
+def load_queries(max_queries: int) -> List[str]:
+    queries: List[str] = []
+    try:
+        conn = sqlite3.connect(f'{SQLITE_DB_DIR}/{SQLITE_DB_NAME}')
+        try:
+            rows = conn.execute(
+                "SELECT DISTINCT query FROM t_user_qa_record_tab ORDER BY id DESC LIMIT ?",
+                (max_queries, )).fetchall()
+            queries.extend(row[0] for row in rows if row[0])
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[WARNING] load queries from SQLite failed, the exception is {e}")
+    if not queries:
+        queries = SAMPLE_QUERIES
+    return queries
+
+
+def measure(detect: Callable[[str], str], queries: List[str],
+            rounds: int) -> List[float]:
+    latencies = []
+    for _ in range(rounds):
+        for query in queries:
+            beg_time = time.perf_counter()
+            detect(query)
+            latencies.append((time.perf_counter() - beg_time) * 1000)
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-queries', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    import py3langid as langid
+    from server.app.utils.text_helper import normalize_text
+    from server.rag.pre_retrieval.query_transformation.language_detector import (
+        LanguageDetector, detect_script_lang)
+
+    queries = load_queries(args.max_queries)
+    print(f"queries: {len(queries)}, rounds: {args.rounds}\n")
+
+    beg_time = time.perf_counter()
+    langid.classify('warmup')
+    print(
+        f"langid model load: {(time.perf_counter() - beg_time) * 1000:.1f} ms\n"
+    )
+
+    def detect_script(query: str) -> str:
+        normalized_query = normalize_text(query)
+        lang = detect_script_lang(normalized_query)
+        if lang is None:
+            lang, _ = langid.classify(normalized_query)
+        return lang
+
+    language_detector = LanguageDetector()
+    paths = [
+        ('langid', lambda query: langid.classify(query)[0]),
+        ('script', detect_script),
+        ('memoized', language_detector.detect),
+    ]
+    print(f"{'path':>9} {'p50_ms':>8} {'p95_ms':>8} {'mean_ms':>8}")
+    for name, detect in paths:
+        latencies = measure(detect, queries, args.rounds)
+        p50, p95 = np.percentile(latencies, [50, 95])
+        print(f"{name:>9} {p50:>8.3f} {p95:>8.3f} {np.mean(latencies):>8.3f}")
+
+    fast_path = [(query, detect_script_lang(normalize_text(query)))
+                 for query in queries]
+    fast_path = [(query, lang) for query, lang in fast_path if lang]
+    agreed = sum(1 for query, lang in fast_path
+                 if langid.classify(query)[0] == lang)
+    print(
+        f"\nfast path: {len(fast_path)}/{len(queries)} queries, agreement with langid: {agreed}/{len(fast_path)}"
+    )
+    for query, lang in fast_path:
+        langid_lang = langid.classify(query)[0]
+        if langid_lang != lang:
+            print(f"  '{query}': script '{lang}', langid '{langid_lang}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# coding=utf-8
+"""
+Benchmark of the ONNX Runtime execution profiles of the re-ranking model.
+
+Every combination of precision, intra-op threads, graph optimization level and IO binding
+scores the same batches of query-passage pairs. The latency percentiles and the throughput
+are reported per profile, to pick the `RERANK_*` settings in server/constant/constants.py.
+
+With --cascade, the historical user queries are recalled from the knowledge base and the
+two-stage cascade is compared with scoring all candidates by the heavy model: recall@RECALL_TOP_K
+of the cascade and the latency of each stage are reported per number of survivors.
+
+With --windowing, the same recalled candidates are scored with shorter inputs and query-centered
+passage windows, and compared with the full 512-token model: recall@RECALL_TOP_K and latency are
+reported per max_length and window size.
+
+Usage:
+    python benchmark_reranker.py --threads 1,2,4 --precisions fp32,int8 --pairs 10
+    python benchmark_reranker.py --quantize
+    python benchmark_reranker.py --cascade --top-m 3,5,8 --recall-k 10,20
+    python benchmark_reranker.py --windowing --max-lengths 256,384 --recall-k 10
+"""
+import argparse
+import json
+import sqlite3
+import time
+from typing import List, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from server.constant.constants import (SQLITE_DB_DIR, SQLITE_DB_NAME,
+                                       RERANK_MODEL_NAME, RECALL_TOP_K,
+                                       RERANK_CASCADE_FIRST_STAGE_MODEL)
+
+
+def load_passages(max_passages: int) -> List[str]:
+    passages: List[str] = []
+    try:
+        conn = sqlite3.connect(f'{SQLITE_DB_DIR}/{SQLITE_DB_NAME}')
+        try:
+            rows = conn.execute(
+                "SELECT content FROM t_local_file_chunk_tab LIMIT ?",
+                (max_passages, )).fetchall()
+            passages.extend(row[0] for row in rows)
+            rows = conn.execute(
+                "SELECT content FROM t_isolated_url_tab WHERE doc_status = 4 LIMIT ?",
+                (max_passages, )).fetchall()
+            for row in rows:
+                passages.extend(json.loads(row[0]))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[WARNING] load passages from SQLite failed, the exception is {e}")
+
+    passages = [p for p in passages if p.strip()][:max_passages]
+    if not passages:
+        # No knowledge base yet, use synthetic passages of a typical chunk length
+        words = "the quick brown fox jumps over the lazy dog while the server answers questions".split()
+        rng = np.random.default_rng(0)
+        passages = [
+            ' '.join(rng.choice(words, size=200)) for _ in range(max_passages)
+        ]
+    return passages
+
+
+def quantize_model(model_name: str) -> None:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from server.rag.post_retrieval.rerank.flash_ranker import default_cache_dir, model_file_map
+
+    model_dir = f"{default_cache_dir}/{model_name}"
+    fp32_file = f"{model_dir}/{model_file_map[model_name]['fp32']}"
+    int8_file = f"{model_dir}/{model_file_map[model_name]['int8']}"
+    quantize_dynamic(fp32_file, int8_file, weight_type=QuantType.QInt8)
+    print(f"Saved the int8 model to '{int8_file}'")
+
+
+def load_queries(max_queries: int) -> List[str]:
+    conn = sqlite3.connect(f'{SQLITE_DB_DIR}/{SQLITE_DB_NAME}')
+    try:
+        rows = conn.execute(
+            "SELECT DISTINCT query FROM t_user_qa_record_tab ORDER BY id DESC LIMIT ?",
+            (max_queries, )).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+
+def load_candidates(queries: List[str],
+                    recall_k: int) -> List[Tuple[str, List[str]]]:
+    from server.rag.retrieval.vector_search import vector_search
+
+    candidates = []
+    for query in queries:
+        texts = [
+            doc.page_content
+            for doc, _ in vector_search.similarity_search_with_relevance_scores(
+                query, recall_k)
+        ]
+        if texts:
+            candidates.append((query, texts))
+    return candidates
+
+
+def init_recall_env() -> None:
+    # Recalling candidates needs the embedding model
+    load_dotenv(override=True)
+    from server.constant.env_constants import check_env_variables
+    check_env_variables()
+
+
+def check_window_selection() -> None:
+    from server.rag.post_retrieval.rerank.flash_ranker import get_window_start
+
+    # The query tokens occur at the beginning and in the middle of a passage, with filler between them
+    hits = np.zeros(490, dtype=np.int64)
+    hits[[0, 1, 245, 246]] = 1
+    window = 60
+    start = get_window_start(hits, window)
+    assert hits[start:start + window].sum() == 2, f"the window at {start} misses the query tokens"
+    # A single region is centered in the window
+    hits = np.zeros(490, dtype=np.int64)
+    hits[[300, 301]] = 1
+    start = get_window_start(hits, window)
+    assert start <= 300 and 301 < start + window and abs(
+        (start + window // 2) - 300) <= 1, f"the window at {start} is not centered"
+
+
+def benchmark_windowing(args: argparse.Namespace) -> None:
+    check_window_selection()
+    init_recall_env()
+    from server.rag.post_retrieval.rerank.flash_ranker import Ranker
+
+    queries = load_queries(args.max_queries)
+    if not queries:
+        print("[ERROR] Need historical user queries in t_user_qa_record_tab.")
+        return
+    candidates = load_candidates(queries,
+                                 [int(k) for k in args.recall_k.split(',')][0])
+    baseline = Ranker(model_name=args.model, max_length=512)
+
+    def run(ranker: Ranker) -> Tuple[List[set], float]:
+        tops, timecost = [], 0.0
+        for query, texts in candidates:
+            beg_time = time.perf_counter()
+            scores = ranker.predict([[query, text] for text in texts])
+            timecost += time.perf_counter() - beg_time
+            tops.append(set(np.argsort(-np.asarray(scores))[:RECALL_TOP_K]))
+        return tops, timecost * 1000 / max(len(candidates), 1)
+
+    full_tops, full_ms = run(baseline)
+    print(
+        f"model: {args.model}, queries: {len(candidates)}, recall@{RECALL_TOP_K} against max_length 512 without windowing\n"
+    )
+    print(f"{'max_len':>7} {'window':>6} {'recall':>8} {'ms':>8} {'full_ms':>8}")
+    for max_length in [int(m) for m in args.max_lengths.split(',')]:
+        # 0 keeps the beginning of each passage, like the tokenizer's truncation
+        for window in [0, max_length - 32]:
+            ranker = Ranker(model_name=args.model,
+                            max_length=max_length,
+                            passage_window_tokens=window)
+            tops, ms = run(ranker)
+            recall = np.mean([
+                len(top & full_top) / len(full_top)
+                for top, full_top in zip(tops, full_tops)
+            ])
+            print(
+                f"{max_length:>7} {window:>6} {recall:>8.4f} {ms:>8.2f} {full_ms:>8.2f}"
+            )
+
+
+def benchmark_cascade(args: argparse.Namespace) -> None:
+    init_recall_env()
+    from server.rag.post_retrieval.rerank.flash_ranker import Ranker
+
+    queries = load_queries(args.max_queries)
+    if not queries:
+        print("[ERROR] Need historical user queries in t_user_qa_record_tab.")
+        return
+    first_stage = Ranker(model_name=args.first_stage_model)
+    second_stage = Ranker(model_name=args.model)
+    top_m_list = [int(m) for m in args.top_m.split(',')]
+
+    print(
+        f"first stage: {args.first_stage_model}, second stage: {args.model}, queries: {len(queries)}, recall@{RECALL_TOP_K} against the second stage scoring all candidates\n"
+    )
+    print(
+        f"{'recall_k':>8} {'top_m':>6} {'recall':>8} {'stage1_ms':>10} {'stage2_ms':>10} {'full_ms':>8}"
+    )
+    for recall_k in [int(k) for k in args.recall_k.split(',')]:
+        candidates = load_candidates(queries, recall_k)
+
+        first_ms, full_ms = [], []
+        first_orders, full_tops = [], []
+        for query, texts in candidates:
+            pairs = [[query, text] for text in texts]
+            beg_time = time.perf_counter()
+            first_scores = first_stage.predict(pairs)
+            first_ms.append((time.perf_counter() - beg_time) * 1000)
+            beg_time = time.perf_counter()
+            full_scores = second_stage.predict(pairs)
+            full_ms.append((time.perf_counter() - beg_time) * 1000)
+            first_orders.append(np.argsort(-np.asarray(first_scores)))
+            full_tops.append(
+                set(np.argsort(-np.asarray(full_scores))[:RECALL_TOP_K]))
+
+        for top_m in top_m_list:
+            second_ms, recalls = [], []
+            for (query, texts), first_order, full_top in zip(
+                    candidates, first_orders, full_tops):
+                survivors = first_order[:top_m]
+                beg_time = time.perf_counter()
+                second_scores = second_stage.predict(
+                    [[query, texts[i]] for i in survivors])
+                second_ms.append((time.perf_counter() - beg_time) * 1000)
+                cascade_order = list(
+                    survivors[np.argsort(-np.asarray(second_scores))]) + list(
+                        first_order[top_m:])
+                recalls.append(
+                    len(set(cascade_order[:RECALL_TOP_K]) & full_top) /
+                    len(full_top))
+            print(
+                f"{recall_k:>8} {top_m:>6} {np.mean(recalls):>8.4f} {np.mean(first_ms):>10.2f} {np.mean(second_ms):>10.2f} {np.mean(full_ms):>8.2f}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare ONNX Runtime profiles of the re-ranking model.")
+    parser.add_argument('--model', default=RERANK_MODEL_NAME)
+    parser.add_argument('--precisions', default='fp32,int8')
+    parser.add_argument('--threads',
+                        default='1,2,4',
+                        help='Comma separated intra-op thread counts.')
+    parser.add_argument('--opt-levels', default='basic,all')
+    parser.add_argument('--pairs',
+                        type=int,
+                        default=10,
+                        help='Query-passage pairs per inference.')
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument(
+        '--quantize',
+        action='store_true',
+        help='Create the int8 model file from the fp32 one before benchmarking.')
+    parser.add_argument(
+        '--cascade',
+        action='store_true',
+        help='Report the quality and latency of each cascade stage instead.')
+    parser.add_argument('--first-stage-model',
+                        default=RERANK_CASCADE_FIRST_STAGE_MODEL)
+    parser.add_argument('--top-m',
+                        default='3,5,8',
+                        help='Comma separated numbers of cascade survivors.')
+    parser.add_argument('--recall-k',
+                        default='10,20',
+                        help='Comma separated numbers of recalled candidates.')
+    parser.add_argument(
+        '--windowing',
+        action='store_true',
+        help='Report the quality and latency of shorter inputs with passage windowing instead.')
+    parser.add_argument('--max-lengths',
+                        default='256,384',
+                        help='Comma separated max_length of the windowed runs.')
+    parser.add_argument('--max-queries', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.cascade:
+        benchmark_cascade(args)
+        return
+    if args.windowing:
+        benchmark_windowing(args)
+        return
+
+    if args.quantize:
+        quantize_model(args.model)
+
+    from server.rag.post_retrieval.rerank.flash_ranker import Ranker, RuntimeProfile
+
+    passages = load_passages(args.pairs * args.rounds)
+    query = "How do I deploy the service with docker?"
+    batches = [[[query, passages[(i * args.pairs + j) % len(passages)]]
+                for j in range(args.pairs)] for i in range(args.rounds)]
+
+    print(
+        f"model: {args.model}, pairs per inference: {args.pairs}, rounds: {args.rounds}\n"
+    )
+    print(
+        f"{'precision':>9} {'threads':>7} {'opt':>8} {'io_bind':>7} {'p50_ms':>8} {'p95_ms':>8} {'pairs/s':>9}"
+    )
+    for precision in args.precisions.split(','):
+        for threads in [int(t) for t in args.threads.split(',')]:
+            for opt_level in args.opt_levels.split(','):
+                for use_io_binding in [False, True]:
+                    profile = RuntimeProfile(intra_op_num_threads=threads,
+                                             graph_optimization_level=opt_level,
+                                             cache_optimized_model=False,
+                                             use_io_binding=use_io_binding,
+                                             precision=precision)
+                    ranker = Ranker(model_name=args.model, profile=profile)
+                    if ranker.profile.precision != precision:
+                        # The model file of this precision is missing
+                        break
+
+                    for batch in batches[:3]:
+                        ranker.predict(batch)
+                    latencies = []
+                    for batch in batches:
+                        beg_time = time.perf_counter()
+                        ranker.predict(batch)
+                        latencies.append(
+                            (time.perf_counter() - beg_time) * 1000)
+                    p50, p95 = np.percentile(latencies, [50, 95])
+                    throughput = args.pairs * len(latencies) / (
+                        sum(latencies) / 1000)
+                    print(
+                        f"{precision:>9} {threads:>7} {opt_level:>8} {str(use_io_binding):>7} {p50:>8.2f} {p95:>8.2f} {throughput:>9.1f}"
+                    )
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ def init_chroma_db():
         from server.constant.env_constants import check_env_variables
         check_env_variables()
         from server.rag.index.embedder.document_embedder import document_embedder
+        document_embedder.warmup()
         return True
     except Exception as e:
         print(f"[ERROR] init_chroma_db is failed, the exception is {e}")
@@ -201,6 +202,84 @@ def create_table():
     )
     ''')
 
+
+    # Create ingestion job table to store durable, per-document ingestion work items
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS t_ingestion_job_tab (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_type INTEGER NOT NULL,
+        doc_source INTEGER NOT NULL,
+        doc_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        job_status INTEGER NOT NULL,
+        retry_count INTEGER NOT NULL,
+        lease_owner TEXT NOT NULL,
+        lease_expire_time INTEGER NOT NULL,
+        available_time INTEGER NOT NULL,
+        checkpoint TEXT NOT NULL,
+        last_error TEXT NOT NULL,
+        ctime INTEGER NOT NULL,
+        mtime INTEGER NOT NULL
+    )
+    ''')
+    #`job_type` meanings:
+    #  1 - 'Crawl the sitemap links of a site'
+    #  2 - 'Add sitemap URL content'
+    #  3 - 'Delete sitemap URL content'
+    #  4 - 'Update sitemap URL content'
+    #  5 - 'Add isolated URL content'
+    #  6 - 'Delete isolated URL content'
+    #  7 - 'Add local file content'
+    #  8 - 'Delete local file content'
+    #`doc_source` meanings:
+    #  0 - 'site level job, doc_id is the id in t_sitemap_domain_tab'
+    #  1 - 'from sitemap URLs'
+    #  2 - 'from isolated URLs'
+    #  3 - 'from local files'
+    #`job_status` meanings:
+    #  0 - 'Job failed after all retries'
+    #  1 - 'Job pending'
+    #  2 - 'Job running under a lease'
+    #  3 - 'Job done'
+
+    # Create rerank score cache table
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS t_rerank_score_cache_tab (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        model_name TEXT NOT NULL,
+        query_md5 TEXT NOT NULL,
+        passage_md5 TEXT NOT NULL,
+        score REAL NOT NULL,
+        ctime INTEGER NOT NULL
+    )
+    ''')
+
+    # Create LLM usage table
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS t_llm_usage_tab (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        model_name TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        total_tokens INTEGER NOT NULL,
+        latency_ms INTEGER NOT NULL,
+        first_token_ms INTEGER NOT NULL,
+        cache_hit INTEGER NOT NULL,
+        coalesced INTEGER NOT NULL,
+        cost REAL NOT NULL,
+        ctime INTEGER NOT NULL
+    )
+    ''')
+    #`stage` meanings:
+    #  'refine_query' - 'Rewrite the query with the conversation history'
+    #  'smart_query' - 'Answer of /smart_query'
+    #  'smart_query_stream' - 'Answer of /smart_query_stream'
+    #`cache_hit` is 1 if the answer came from the intervened answers in Cache, without calling the LLM
+    #`coalesced` is 1 if the answer was shared with an identical in-flight query, its tokens are counted by that query
+    #`cost` is estimated with `LLM_MODEL_PRICES` at the time of the request
+
     conn.commit()
     conn.close()
 
@@ -241,6 +320,17 @@ def create_index():
         # the index of t_account_tab
         conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_account_name ON t_account_tab (account_name)')
 
+        # the index of t_ingestion_job_tab
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_job_status_available_time ON t_ingestion_job_tab (job_status, available_time)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_doc_source_doc_id ON t_ingestion_job_tab (doc_source, doc_id)')
+
+        # the index of t_rerank_score_cache_tab
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_model_query_passage ON t_rerank_score_cache_tab (model_name, query_md5, passage_md5)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_passage_md5 ON t_rerank_score_cache_tab (passage_md5)')
+
+        # the index of t_llm_usage_tab
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_usage_ctime ON t_llm_usage_tab (ctime)')
+
 
 def init_admin_account():
     # Initialize admin account with predefined credentials
@@ -0,0 +1,142 @@
+# coding=utf-8
+"""
+Offline evaluation of reduced-dimension embeddings on the data of this deployment.
+
+The stored knowledge base chunks and the historical user queries are embedded at full
+dimension. The exact top-k neighbours at full dimension are the ground truth, and each
+candidate dimension reports recall@k for 'truncate' and 'pca' against it.
+
+Usage:
+    python evaluate_embedding_dimension.py --dims 256,512,768,1024 --k 5
+    python evaluate_embedding_dimension.py --save-pca 512
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from typing import List
+import numpy as np
+from dotenv import load_dotenv
+from server.constant.constants import (SQLITE_DB_DIR, SQLITE_DB_NAME,
+                                       EMBEDDING_PCA_PROJECTION_FILE)
+
+
+def load_chunks(conn: sqlite3.Connection, max_docs: int) -> List[str]:
+    chunks: List[str] = []
+    for table in ['t_sitemap_url_tab', 't_isolated_url_tab']:
+        rows = conn.execute(
+            f"SELECT content FROM {table} WHERE doc_status = 4").fetchall()
+        for row in rows:
+            chunks.extend(json.loads(row[0]))
+    rows = conn.execute(
+        "SELECT content FROM t_local_file_chunk_tab ORDER BY id").fetchall()
+    chunks.extend(row[0] for row in rows)
+    chunks = [chunk for chunk in chunks if chunk.strip()]
+    return chunks[:max_docs]
+
+
+def load_queries(conn: sqlite3.Connection, max_queries: int) -> List[str]:
+    rows = conn.execute(
+        "SELECT DISTINCT query FROM t_user_qa_record_tab ORDER BY id DESC LIMIT ?",
+        (max_queries, )).fetchall()
+    queries = [row[0] for row in rows]
+    if len(queries) < max_queries:
+        rows = conn.execute(
+            "SELECT query FROM t_user_qa_intervene_tab LIMIT ?",
+            (max_queries - len(queries), )).fetchall()
+        queries.extend(row[0] for row in rows)
+    return list(dict.fromkeys(queries))
+
+
+def top_k_indexes(queries: np.ndarray, docs: np.ndarray, k: int) -> np.ndarray:
+    sims = queries @ docs.T
+    return np.argsort(-sims, axis=1)[:, :k]
+
+
+def recall_at_k(truth: np.ndarray, candidate: np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = [
+        len(set(t.tolist()) & set(c.tolist())) for t, c in zip(truth, candidate)
+    ]
+    return float(np.mean(hits)) / k
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Report recall@k loss of reduced-dimension embeddings.")
+    parser.add_argument('--dims',
+                        default='256,512,768,1024',
+                        help='Comma separated candidate dimensions.')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--max-docs', type=int, default=3000)
+    parser.add_argument('--max-queries', type=int, default=300)
+    parser.add_argument(
+        '--save-pca',
+        type=int,
+        default=0,
+        help=
+        f"Fit a PCA projection with this dimension and save it to '{EMBEDDING_PCA_PROJECTION_FILE}'."
+    )
+    args = parser.parse_args()
+
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+    from server.constant.env_constants import check_env_variables
+    check_env_variables()
+    from server.rag.index.embedder.dimension_reducer import DimensionReducer, normalize_rows
+    # Not `document_embedder`: its reducer needs the PCA projection that --save-pca is meant to create
+    from server.rag.index.embedder.document_embedder import create_base_embeddings
+
+    conn = sqlite3.connect(f'{SQLITE_DB_DIR}/{SQLITE_DB_NAME}')
+    try:
+        chunks = load_chunks(conn, args.max_docs)
+        queries = load_queries(conn, args.max_queries)
+    finally:
+        conn.close()
+
+    if not chunks or not queries:
+        print(
+            f"[ERROR] Need stored chunks and user queries, got {len(chunks)} chunks and {len(queries)} queries."
+        )
+        sys.exit(-1)
+    print(f"Embedding {len(chunks)} chunks and {len(queries)} queries at full dimension")
+
+    embeddings, _ = create_base_embeddings(os.getenv('LLM_NAME'))
+    doc_matrix = normalize_rows(
+        np.asarray(embeddings.embed_documents(chunks), dtype=np.float32))
+    query_matrix = normalize_rows(
+        np.asarray(embeddings.embed_queries(queries), dtype=np.float32))
+    full_dimension = doc_matrix.shape[1]
+    k = min(args.k, len(chunks))
+    truth = top_k_indexes(query_matrix, doc_matrix, k)
+
+    if args.save_pca:
+        mean, components = DimensionReducer.fit_pca(doc_matrix, args.save_pca)
+        DimensionReducer.save_projection(EMBEDDING_PCA_PROJECTION_FILE, mean,
+                                         components)
+        print(
+            f"Saved PCA projection with {args.save_pca} components to '{EMBEDDING_PCA_PROJECTION_FILE}'"
+        )
+
+    print(f"\nfull dimension: {full_dimension}, recall@{k} against full dimension")
+    print(f"{'dim':>6} {'bytes/vec':>10} {'truncate':>10} {'pca':>10}")
+    for dim in [int(d) for d in args.dims.split(',') if d.strip()]:
+        if dim >= full_dimension:
+            continue
+        truncated = top_k_indexes(normalize_rows(query_matrix[:, :dim]),
+                                  normalize_rows(doc_matrix[:, :dim]), k)
+        truncate_recall = recall_at_k(truth, truncated)
+
+        pca_recall = 'n/a'
+        if dim <= min(doc_matrix.shape):
+            mean, components = DimensionReducer.fit_pca(doc_matrix, dim)
+            projected = top_k_indexes(
+                normalize_rows((query_matrix - mean) @ components.T),
+                normalize_rows((doc_matrix - mean) @ components.T), k)
+            pca_recall = f"{recall_at_k(truth, projected):.4f}"
+        print(f"{dim:>6} {dim * 4:>10} {truncate_recall:>10.4f} {pca_recall:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,3 +5,18 @@ workers = 3
 accesslog = "access.log"  # Access logs file
 errorlog = "-"    # Disable gunicorn access logs
 loglevel = "info"
+# Import the app in the master, so the workers are forked with the loaded modules and models
+preload_app = True
+
+
+def when_ready(server):
+    # Load the read-only model weights once in the master, the workers share them copy-on-write
+    from rag_gpt_app import backfill_caches, warmup_models
+    backfill_caches()
+    warmup_models()
+
+
+def post_worker_init(worker):
+    # Threads are not inherited by forked workers, start them in each worker
+    from rag_gpt_app import start_background_tasks
+    start_background_tasks()
@@ -9,9 +9,14 @@ check_env_variables()
 from flask import Flask, send_from_directory, abort
 from flask_cors import CORS
 from werkzeug.utils import safe_join
-from server.app import account, auth, bot_config, common, files, intervention, queries, sitemaps, urls
-from server.constant.constants import STATIC_DIR, MEDIA_DIR
+from server.app import account, auth, bot_config, common, files, intervention, metrics, queries, sitemaps, urls
+from server.app.ingestion_worker import ingestion_worker
+from server.constant.constants import STATIC_DIR, MEDIA_DIR, RERANK_MODE, QUERY_ROUTER_USE_EMBEDDING_CLASSIFIER
 from server.logger.logger_config import my_logger as logger
+from server.rag.post_retrieval.rerank.cascade_ranker import first_stage_reranker
+from server.rag.post_retrieval.rerank.flash_ranker import reranker
+from server.rag.pre_retrieval.query_routing.query_router import query_router
+from server.rag.pre_retrieval.query_transformation.language_detector import language_detector
 
 
 app = Flask(__name__, static_folder=STATIC_DIR)
@@ -75,10 +80,50 @@ app.register_blueprint(bot_config.bot_config_bp)
 app.register_blueprint(common.common_bp)
 app.register_blueprint(files.files_bp)
 app.register_blueprint(intervention.intervention_bp)
+app.register_blueprint(metrics.metrics_bp)
 app.register_blueprint(queries.queries_bp)
 app.register_blueprint(sitemaps.sitemaps_bp)
 app.register_blueprint(urls.urls_bp)
 
 
+def warmup_models() -> None:
+    """
+    Load the language detection and re-ranking models, and embed the chitchat phrases of the query router,
+    ahead of the first request.
+
+    Called in the gunicorn master (see gunicorn_config.py), so the model bytes and tokenizers are loaded
+    once and shared copy-on-write by the forked workers.
+    """
+    language_detector.warmup()
+    if QUERY_ROUTER_USE_EMBEDDING_CLASSIFIER:
+        query_router.warmup()
+    if int(os.getenv('USE_RERANKING')):
+        reranker.warmup()
+        if RERANK_MODE == 'cascade':
+            first_stage_reranker.warmup()
+
+
+def backfill_caches() -> None:
+    """
+    Add the Cache entries that the records of older versions lack.
+
+    Called once in the gunicorn master (see gunicorn_config.py), before the workers are forked.
+    """
+    intervention.backfill_intervene_aliases()
+
+
+def start_background_tasks() -> None:
+    """
+    Start the background threads of a serving process.
+
+    Threads don't survive a fork, so this is called in each worker process after it is forked.
+    """
+    # Resume unfinished ingestion jobs and process new ones in the background
+    ingestion_worker.start()
+
+
 if __name__ == '__main__':
+    backfill_caches()
+    warmup_models()
+    start_background_tasks()
     app.run(debug=False, host='0.0.0.0', port=7000)
@@ -1,4 +1,5 @@
 import json
+from threading import Thread
 import time
 from flask import Blueprint, request
 from server.app.utils.decorators import token_required
@@ -6,6 +7,7 @@ from server.app.utils.sqlite_client import get_db_connection
 from server.app.utils.diskcache_client import diskcache_client
 from server.app.utils.diskcache_lock import diskcache_lock
 from server.logger.logger_config import my_logger as logger
+from server.rag.index.embedder.document_embedder import document_embedder
 
 bot_config_bp = Blueprint('bot_config',
                           __name__,
@@ -176,6 +178,10 @@ def update_bot_setting():
                 'data': {}
             }
 
+        # Suggested messages are asked verbatim, embed them ahead of the first request
+        Thread(target=document_embedder.query_embedding_cache.warmup,
+               args=(suggested_messages, )).start()
+
         return {
             'retcode': 0,
             'message': 'Settings updated successfully',
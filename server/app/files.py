@@ -3,17 +3,22 @@ import asyncio
 from datetime import datetime
 import json
 import os
-from threading import Thread
 import time
-from typing import Dict, List, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import uuid
 from flask import Blueprint, request
 from server.constant.constants import (MAX_LOCAL_FILE_BATCH_LENGTH,
                                        MAX_FILE_SIZE, LOCAL_FILE_DOWNLOAD_DIR,
                                        STATIC_DIR, FILE_LOADER_EXTENSIONS,
                                        MAX_CONCURRENT_WRITES,
-                                       LOCAL_FILE_PROCESS_FAILED)
+                                       LOCAL_FILE_UPLOAD_TTL,
+                                       LOCAL_FILE_PROCESS_FAILED,
+                                       FROM_LOCAL_FILE,
+                                       JOB_ADD_LOCAL_FILE_CONTENT,
+                                       JOB_DELETE_LOCAL_FILE_CONTENT)
 from server.app.utils.decorators import token_required
+from server.app.utils.diskcache_client import diskcache_client
+from server.app.utils.ingestion_queue import ingestion_queue
 from server.app.utils.sqlite_client import get_db_connection
 from server.app.utils.diskcache_lock import diskcache_lock
 from server.app.utils.hash import generate_md5
@@ -41,9 +46,14 @@ async def write_file_async(file_path: str, content: bytes) -> None:
         await f.write(content)
 
 
-async def parse_file_content_async(file_path: str, file_extension: str,
-                                   file_md5: str,
-                                   id_url_info: Dict[str, Any]) -> None:
+async def parse_file_content_async(
+        file_path: str,
+        file_extension: str,
+        doc_id: int,
+        url: str,
+        checkpoint: Optional[Dict[str, Any]] = None,
+        on_checkpoint: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> None:
     file_loader_obj = None
     if file_extension == ".csv":
         file_loader_obj = AsyncCsvLoader(file_path=file_path)
@@ -68,13 +78,13 @@ async def parse_file_content_async(file_path: str, file_extension: str,
 
     if file_loader_obj:
         content = await file_loader_obj.get_content()
-        doc_id = id_url_info[file_md5]["id"]
-        url = id_url_info[file_md5]["url"]
         text_parser_obj = AsyncTextParser()
         if content:
             await text_parser_obj.add_content(doc_id=doc_id,
                                               content=content,
-                                              url=url)
+                                              url=url,
+                                              checkpoint=checkpoint,
+                                              on_checkpoint=on_checkpoint)
         else:
             # if os.path.exists(file_path):
             #    os.remove(file_path)
@@ -101,50 +111,52 @@ async def parse_file_content_async(file_path: str, file_extension: str,
         logger.error(f"file_extension: '{file_extension}' is illegal!")
 
 
-async def add_files_limited_by_semaphore(
+async def write_files_limited_by_semaphore(
         file_data: List[Dict[str, str]],
-        id_url_info: Dict[str, Any],
         max_concurrent_writes: int = 5) -> None:
     """Save files with limited concurrency using a semaphore."""
     semaphore = asyncio.Semaphore(max_concurrent_writes)
 
-    async def semaphore_write(data, id_url_info):
+    async def semaphore_write(data):
         async with semaphore:
             await write_file_async(data['file_path'], data['content'])
 
-    # Create the event loop in the thread where this function is called
-    loop = asyncio.get_event_loop()
+    await asyncio.gather(*[semaphore_write(data) for data in file_data])
 
-    # Create and schedule coroutine tasks
-    tasks = [
-        loop.create_task(semaphore_write(data, id_url_info))
-        for data in file_data
-    ]
-    await asyncio.gather(*tasks)
 
-    for data in file_data:
-        await parse_file_content_async(data['file_path'],
-                                       data['file_extension'],
-                                       data['file_md5'], id_url_info)
+def get_upload_key(doc_id: int) -> str:
+    return f"open_kf:local_file_upload:{doc_id}"
 
 
-def add_local_file_info(file_data: List[Dict[str, str]],
-                        id_url_info: Dict[str, Any],
-                        max_concurrent_writes: int = 5):
-    """Synchronously calls the asynchronous save function to write files with limited concurrency."""
-    logger.info(
-        f"[DOWNLOAD FILE] add_local_file_info begin, id_url_info: {id_url_info}"
-    )
-    beg_time = int(time.time())
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(
-        add_files_limited_by_semaphore(file_data, id_url_info,
-                                       max_concurrent_writes))
-    loop.close()
-    timecost = int(time.time()) - beg_time
-    logger.warning(
-        f"[DOWNLOAD FILE] add_local_file_info end, timecost is {timecost}")
+async def write_uploaded_files_async(file_list: List[Tuple[int, str]],
+                                     max_concurrent_writes: int = 5) -> None:
+    """ Writes the content uploaded by `submit_local_file_list` to the files of the documents.
+
+    The content is kept in diskcache until the ingestion worker writes it, the files already written by a previous
+    attempt of the job are skipped. A file is written under a temporary name first, so an interrupted write
+    is never taken for a complete file.
+    """
+    file_data = []
+    for doc_id, file_path in file_list:
+        if os.path.exists(file_path):
+            continue
+        content = diskcache_client.get(get_upload_key(doc_id))
+        if content is None:
+            logger.error(
+                f"[DOWNLOAD FILE] the uploaded content of doc_id: {doc_id} is lost, file_path: '{file_path}'"
+            )
+            continue
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file_data.append({
+            'file_path': f"{file_path}.part",
+            'content': content
+        })
+
+    await write_files_limited_by_semaphore(file_data, max_concurrent_writes)
+    for data in file_data:
+        os.replace(data['file_path'], data['file_path'][:-len('.part')])
+    for doc_id, _ in file_list:
+        diskcache_client.delete(get_upload_key(doc_id))
 
 
 @files_bp.route('/submit_local_file_list', methods=['POST'])
@@ -221,7 +233,6 @@ def submit_local_file_list():
             unique_folder = str(uuid.uuid4())
             save_directory = os.path.join(STATIC_DIR, LOCAL_FILE_DOWNLOAD_DIR,
                                           day_folder, unique_folder)
-            os.makedirs(save_directory, exist_ok=True)
 
             file_path = os.path.join(save_directory, file_.filename)
             file_url = f"{URL_PREFIX}{STATIC_DIR}/{LOCAL_FILE_DOWNLOAD_DIR}/{day_folder}/{unique_folder}/{file_.filename}"
@@ -294,8 +305,19 @@ def submit_local_file_list():
                 "url": row["url"]
             }
 
-        Thread(target=add_local_file_info,
-               args=(file_data, id_url_info, MAX_CONCURRENT_WRITES)).start()
+        # The ingestion worker writes the files, the content is kept in diskcache so that any process can take the jobs
+        for data in file_data:
+            diskcache_client.set(
+                get_upload_key(id_url_info[data['file_md5']]["id"]),
+                data['content'], LOCAL_FILE_UPLOAD_TTL)
+        # Enqueue one job per file, the ingestion worker writes, parses and embeds them in the background
+        ingestion_queue.enqueue(JOB_ADD_LOCAL_FILE_CONTENT, FROM_LOCAL_FILE,
+                                [(id_url_info[data['file_md5']]["id"], {
+                                    "url":
+                                    id_url_info[data['file_md5']]["url"],
+                                    "file_path": data['file_path'],
+                                    "file_extension": data['file_extension']
+                                }) for data in file_data])
 
         return {
             'retcode': 0,
@@ -400,8 +422,11 @@ def delete_local_file_list():
             file_id_list)
         file_dict = {row['id']: row['file_path'] for row in cur.fetchall()}
 
-        # Use threading to avoid blocking the Flask application
-        Thread(target=delete_local_file_info, args=(file_dict, )).start()
+        # Enqueue one job per file, the ingestion worker processes them in the background
+        ingestion_queue.enqueue(JOB_DELETE_LOCAL_FILE_CONTENT, FROM_LOCAL_FILE,
+                                [(doc_id, {
+                                    "file_path": file_path
+                                }) for doc_id, file_path in file_dict.items()])
 
         return {
             'retcode': 0,
@@ -0,0 +1,271 @@
+import asyncio
+from threading import Thread
+import time
+from typing import Any, Dict, List
+from server.app.files import (parse_file_content_async, delete_local_file_info,
+                              write_uploaded_files_async)
+from server.app.sitemaps import async_crawl_link_task, async_crawl_content_task
+from server.app.urls import async_isolated_url_content_task
+from server.app.utils.diskcache_lock import diskcache_lock
+from server.app.utils.ingestion_queue import IngestionQueue, ingestion_queue
+from server.app.utils.sqlite_client import get_db_connection
+from server.constant.constants import (
+    ADD_SITEMAP_CONTENT, DELETE_SITEMAP_CONTENT, UPDATE_SITEMAP_CONTENT,
+    ADD_ISOLATED_URL_CONTENT, DELETE_ISOLATED_URL_CONTENT, FROM_SITEMAP_URL,
+    FROM_ISOLATED_URL, FROM_LOCAL_FILE, SITEMAP_URL_CRAWLING,
+    SITEMAP_URL_CRAWLING_COMPLETED, SITEMAP_URL_EMBEDDED,
+    SITEMAP_URL_PROCESS_FAILED, ISOLATED_URL_CRAWLING,
+    ISOLATED_URL_CRAWLING_COMPLETED, ISOLATED_URL_EMBEDDED,
+    ISOLATED_URL_PROCESS_FAILED, LOCAL_FILE_PARSING,
+    LOCAL_FILE_PARSING_COMPLETED, LOCAL_FILE_EMBEDDED,
+    LOCAL_FILE_PROCESS_FAILED, JOB_CRAWL_SITE, JOB_ADD_SITEMAP_CONTENT,
+    JOB_DELETE_SITEMAP_CONTENT, JOB_UPDATE_SITEMAP_CONTENT,
+    JOB_ADD_ISOLATED_URL_CONTENT, JOB_DELETE_ISOLATED_URL_CONTENT,
+    JOB_ADD_LOCAL_FILE_CONTENT, JOB_DELETE_LOCAL_FILE_CONTENT,
+    INGESTION_JOB_BATCH_SIZE, INGESTION_WORKER_POLL_INTERVAL,
+    MAX_CONCURRENT_WRITES)
+from server.logger.logger_config import my_logger as logger
+
+# The document table, and the `doc_status` values meaning 'in progress', 'embedded' and 'failed' of each source
+DOC_SOURCE_INFO = {
+    FROM_SITEMAP_URL: ('t_sitemap_url_tab', [
+        SITEMAP_URL_CRAWLING, SITEMAP_URL_CRAWLING_COMPLETED
+    ], SITEMAP_URL_EMBEDDED, SITEMAP_URL_PROCESS_FAILED),
+    FROM_ISOLATED_URL: ('t_isolated_url_tab', [
+        ISOLATED_URL_CRAWLING, ISOLATED_URL_CRAWLING_COMPLETED
+    ], ISOLATED_URL_EMBEDDED, ISOLATED_URL_PROCESS_FAILED),
+    FROM_LOCAL_FILE: ('t_local_file_tab', [
+        LOCAL_FILE_PARSING, LOCAL_FILE_PARSING_COMPLETED
+    ], LOCAL_FILE_EMBEDDED, LOCAL_FILE_PROCESS_FAILED),
+}
+
+# The jobs whose result is checked by the `doc_status` of their documents
+ADD_JOB_TYPES = {
+    JOB_ADD_SITEMAP_CONTENT, JOB_UPDATE_SITEMAP_CONTENT,
+    JOB_ADD_ISOLATED_URL_CONTENT, JOB_ADD_LOCAL_FILE_CONTENT
+}
+
+
+class IngestionWorker:
+    """ Processes the jobs of the ingestion queue in a background thread of each process. """
+    def __init__(self,
+                 queue: IngestionQueue,
+                 batch_size: int = INGESTION_JOB_BATCH_SIZE,
+                 poll_interval: int = INGESTION_WORKER_POLL_INTERVAL) -> None:
+        self.queue = queue
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.worker_id = ''
+        self.active_job_id_list: List[int] = []
+        self.started = False
+
+    def start(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        self.worker_id = IngestionQueue.get_worker_id()
+        logger.info(f"[INGESTION_WORKER] start, worker_id: '{self.worker_id}'")
+        Thread(target=self.run, daemon=True).start()
+        Thread(target=self.renew_leases, daemon=True).start()
+
+    def run(self) -> None:
+        try:
+            self.recover_stuck_documents()
+        except Exception as e:
+            logger.error(
+                f"[INGESTION_WORKER] recover_stuck_documents failed, the exception is {e}"
+            )
+
+        while True:
+            try:
+                jobs = self.queue.lease(self.worker_id, self.batch_size)
+            except Exception as e:
+                logger.error(
+                    f"[INGESTION_WORKER] lease failed, the exception is {e}")
+                jobs = []
+
+            if not jobs:
+                self.queue.new_job_event.wait(self.poll_interval)
+                self.queue.new_job_event.clear()
+                continue
+
+            self.active_job_id_list = [job["id"] for job in jobs]
+            try:
+                self.process_jobs(jobs)
+            finally:
+                self.active_job_id_list = []
+
+    def renew_leases(self) -> None:
+        while True:
+            time.sleep(self.queue.lease_time / 3)
+            try:
+                self.queue.renew(self.worker_id, list(self.active_job_id_list))
+            except Exception as e:
+                logger.error(
+                    f"[INGESTION_WORKER] renew failed, the exception is {e}")
+
+    def process_jobs(self, jobs: List[Dict[str, Any]]) -> None:
+        job_type = jobs[0]["job_type"]
+        logger.info(
+            f"[INGESTION_WORKER] process_jobs begin, job_type: {job_type}, job_id_list: {self.active_job_id_list}"
+        )
+        beg_time = time.time()
+        try:
+            self.dispatch(job_type, jobs)
+        except Exception as e:
+            logger.error(
+                f"[INGESTION_WORKER] job_type: {job_type} raised exception: {e}"
+            )
+            self.handle_failed_jobs(jobs, str(e))
+            return
+
+        if job_type in ADD_JOB_TYPES:
+            embedded_doc_ids = self.get_embedded_doc_ids(
+                jobs[0]["doc_source"], [job["doc_id"] for job in jobs])
+            done_jobs = [
+                job for job in jobs if job["doc_id"] in embedded_doc_ids
+            ]
+            failed_jobs = [
+                job for job in jobs if job["doc_id"] not in embedded_doc_ids
+            ]
+        else:
+            done_jobs, failed_jobs = jobs, []
+
+        self.queue.complete([job["id"] for job in done_jobs])
+        if failed_jobs:
+            self.handle_failed_jobs(failed_jobs, 'document is not embedded')
+
+        timecost = time.time() - beg_time
+        logger.warning(
+            f"[INGESTION_WORKER] process_jobs end, job_type: {job_type}, done: {len(done_jobs)}, failed: {len(failed_jobs)}, timecost: {timecost}"
+        )
+
+    def dispatch(self, job_type: int, jobs: List[Dict[str, Any]]) -> None:
+        if job_type == JOB_CRAWL_SITE:
+            for job in jobs:
+                async_crawl_link_task(job["payload"]["site"],
+                                      job["payload"]["version"])
+        elif job_type in (JOB_ADD_SITEMAP_CONTENT, JOB_DELETE_SITEMAP_CONTENT,
+                          JOB_UPDATE_SITEMAP_CONTENT):
+            task_type = {
+                JOB_ADD_SITEMAP_CONTENT: ADD_SITEMAP_CONTENT,
+                JOB_DELETE_SITEMAP_CONTENT: DELETE_SITEMAP_CONTENT,
+                JOB_UPDATE_SITEMAP_CONTENT: UPDATE_SITEMAP_CONTENT
+            }[job_type]
+            url_dict = {job["doc_id"]: job["payload"]["url"] for job in jobs}
+            domain_list = list(set(job["payload"]["domain"] for job in jobs))
+            async_crawl_content_task(domain_list, url_dict, task_type)
+        elif job_type in (JOB_ADD_ISOLATED_URL_CONTENT,
+                          JOB_DELETE_ISOLATED_URL_CONTENT):
+            task_type = ADD_ISOLATED_URL_CONTENT if job_type == JOB_ADD_ISOLATED_URL_CONTENT else DELETE_ISOLATED_URL_CONTENT
+            url_dict = {job["doc_id"]: job["payload"]["url"] for job in jobs}
+            async_isolated_url_content_task(url_dict, task_type)
+        elif job_type == JOB_ADD_LOCAL_FILE_CONTENT:
+            asyncio.run(
+                write_uploaded_files_async(
+                    [(job["doc_id"], job["payload"]["file_path"])
+                     for job in jobs], MAX_CONCURRENT_WRITES))
+            for job in jobs:
+                payload = job["payload"]
+
+                def on_checkpoint(checkpoint: Dict[str, Any],
+                                  job_id: int = job["id"]) -> None:
+                    self.queue.save_checkpoint(job_id, checkpoint)
+
+                asyncio.run(
+                    parse_file_content_async(payload["file_path"],
+                                             payload["file_extension"],
+                                             job["doc_id"], payload["url"],
+                                             job["checkpoint"], on_checkpoint))
+        elif job_type == JOB_DELETE_LOCAL_FILE_CONTENT:
+            file_dict = {
+                job["doc_id"]: job["payload"]["file_path"]
+                for job in jobs
+            }
+            delete_local_file_info(file_dict)
+        else:
+            raise ValueError(f"Unsupported job_type: {job_type}")
+
+    def handle_failed_jobs(self, jobs: List[Dict[str, Any]],
+                           error: str) -> None:
+        exhausted_doc_id_list = self.queue.fail(jobs, error)
+        doc_source = jobs[0]["doc_source"]
+        if exhausted_doc_id_list and doc_source in DOC_SOURCE_INFO:
+            table, _, _, failed_status = DOC_SOURCE_INFO[doc_source]
+            placeholders = ','.join(['?'] * len(exhausted_doc_id_list))
+            conn = get_db_connection()
+            try:
+                with diskcache_lock.lock():
+                    conn.execute(
+                        f"UPDATE {table} SET doc_status = ?, mtime = ? WHERE id IN ({placeholders})",
+                        [failed_status, int(time.time())] +
+                        exhausted_doc_id_list)
+                    conn.commit()
+            finally:
+                conn.close()
+
+    def get_embedded_doc_ids(self, doc_source: int,
+                             doc_id_list: List[int]) -> set:
+        table, _, embedded_status, _ = DOC_SOURCE_INFO[doc_source]
+        placeholders = ','.join(['?'] * len(doc_id_list))
+        conn = get_db_connection()
+        try:
+            cur = conn.execute(
+                f"SELECT id FROM {table} WHERE doc_status = ? AND id IN ({placeholders})",
+                [embedded_status] + doc_id_list)
+            return {row["id"] for row in cur.fetchall()}
+        finally:
+            conn.close()
+
+    def recover_stuck_documents(self) -> None:
+        """
+        Enqueue the documents left in progress (`doc_status` 2 or 3) without any unfinished job,
+        e.g. by a restart before the ingestion queue existed.
+        """
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id, domain, url FROM t_sitemap_url_tab WHERE doc_status IN (?, ?)",
+                DOC_SOURCE_INFO[FROM_SITEMAP_URL][1])
+            sitemap_items = [(row["id"], {
+                "url": row["url"],
+                "domain": row["domain"]
+            }) for row in cur.fetchall()]
+
+            cur.execute(
+                "SELECT id, url FROM t_isolated_url_tab WHERE doc_status IN (?, ?)",
+                DOC_SOURCE_INFO[FROM_ISOLATED_URL][1])
+            isolated_items = [(row["id"], {
+                "url": row["url"]
+            }) for row in cur.fetchall()]
+
+            cur.execute(
+                "SELECT id, url, file_path, file_type FROM t_local_file_tab WHERE doc_status IN (?, ?)",
+                DOC_SOURCE_INFO[FROM_LOCAL_FILE][1])
+            local_file_items = [(row["id"], {
+                "url": row["url"],
+                "file_path": row["file_path"],
+                "file_extension": row["file_type"]
+            }) for row in cur.fetchall()]
+        finally:
+            conn.close()
+
+        for job_type, doc_source, items in [
+            (JOB_ADD_SITEMAP_CONTENT, FROM_SITEMAP_URL, sitemap_items),
+            (JOB_ADD_ISOLATED_URL_CONTENT, FROM_ISOLATED_URL, isolated_items),
+            (JOB_ADD_LOCAL_FILE_CONTENT, FROM_LOCAL_FILE, local_file_items)
+        ]:
+            if items:
+                job_id_list = self.queue.enqueue(job_type,
+                                                 doc_source,
+                                                 items,
+                                                 skip_unfinished=True)
+                if job_id_list:
+                    logger.warning(
+                        f"[INGESTION_WORKER] recovered {len(job_id_list)} stuck documents, doc_source: {doc_source}"
+                    )
+
+
+# Initialize the ingestion worker, started by the application
+ingestion_worker = IngestionWorker(ingestion_queue)
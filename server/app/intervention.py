@@ -6,12 +6,45 @@ from server.app.utils.sqlite_client import get_db_connection
 from server.app.utils.diskcache_client import diskcache_client
 from server.app.utils.diskcache_lock import diskcache_lock
 from server.logger.logger_config import my_logger as logger
+from server.rag.pre_retrieval.query_routing.query_router import get_intervene_alias_key
 
 intervention_bp = Blueprint('intervention',
                             __name__,
                             url_prefix='/open_kf_api/intervention')
 
 
+def delete_intervene_alias(query: str) -> None:
+    alias_key = get_intervene_alias_key(query)
+    # Another intervened query may have the same normalized form
+    if diskcache_client.get(alias_key) == query:
+        diskcache_client.delete(alias_key)
+
+
+def backfill_intervene_aliases() -> None:
+    """ Sets the missing aliases of the intervened queries, e.g. for the records added before the query router. """
+    conn = None
+    try:
+        conn = get_db_connection()
+        rows = conn.execute(
+            'SELECT query FROM t_user_qa_intervene_tab').fetchall()
+        count = 0
+        for row in rows:
+            alias_key = get_intervene_alias_key(row['query'])
+            if diskcache_client.get(alias_key) is None:
+                diskcache_client.set(alias_key, row['query'])
+                count += 1
+        logger.info(
+            f"[INTERVENTION] backfill {count} aliases of {len(rows)} intervened queries"
+        )
+    except Exception as e:
+        logger.error(
+            f"[INTERVENTION] backfill the aliases of the intervened queries failed, the exception is {e}"
+        )
+    finally:
+        if conn:
+            conn.close()
+
+
 @intervention_bp.route('/add_intervene_record', methods=['POST'])
 @token_required
 def add_intervene_record():
@@ -69,6 +102,8 @@ def add_intervene_record():
         key = f"open_kf:intervene:{query}"
         value = json.dumps({"answer": intervene_answer, "source": source})
         diskcache_client.set(key, value)
+        # The query router also matches the query regardless of case and punctuation
+        diskcache_client.set(get_intervene_alias_key(query), query)
 
         return {"retcode": 0, "message": "success", 'data': {}}
     except Exception as e:
@@ -121,6 +156,7 @@ def delete_intervene_record():
             # Now, delete the corresponding record from Cache
             key = f"open_kf:intervene:{query}"
             diskcache_client.delete(key)
+            delete_intervene_alias(query)
 
             return {"retcode": 0, "message": "success", 'data': {}}
         else:
@@ -164,6 +200,7 @@ def batch_delete_intervene_record():
             query = row['query']
             key = f"open_kf:intervene:{query}"
             diskcache_client.delete(key)
+            delete_intervene_alias(query)
 
         # Then, batch delete from DB
         try:
@@ -235,6 +272,7 @@ def update_intervene_record():
             key = f"open_kf:intervene:{query}"
             value = json.dumps({"answer": intervene_answer, "source": source})
             diskcache_client.set(key, value)
+            diskcache_client.set(get_intervene_alias_key(query), query)
         else:
             return {
                 'retcode': -20001,
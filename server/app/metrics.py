@@ -0,0 +1,128 @@
+from flask import Blueprint, request
+from server.app.utils.decorators import token_required
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.sqlite_client import get_db_connection
+from server.constant.constants import RERANK_MODE
+from server.logger.logger_config import my_logger as logger
+from server.rag.generation.llm_http_client import get_connection_stats
+from server.rag.generation.provider_limiter import get_limiter_stats
+from server.rag.index.embedder.document_embedder import document_embedder
+from server.rag.pre_retrieval.query_construction.query_constructor import query_constructor
+from server.rag.pre_retrieval.query_expansion.query_expander import query_expander
+from server.rag.pre_retrieval.query_transformation.refine_classifier import refine_classifier
+from server.rag.post_retrieval.compression.extractive_compressor import extractive_compressor
+from server.rag.post_retrieval.conversation.retrieval_memory import retrieval_memory
+from server.rag.post_retrieval.rerank.cascade_ranker import cascade_ranker
+
+metrics_bp = Blueprint('metrics', __name__, url_prefix='/open_kf_api/metrics')
+
+
+@metrics_bp.route('/get_metrics', methods=['POST'])
+@token_required
+def get_metrics():
+    """Retrieve the performance counters shared by all worker processes."""
+    try:
+        data = {
+            'counters': metrics_client.get_all(),
+            'query_embedding_cache':
+            document_embedder.query_embedding_cache.get_stats(),
+            'llm_http': get_connection_stats(),
+            'llm_limiter': get_limiter_stats(),
+            'refine_classifier': refine_classifier.get_stats(),
+            'query_expansion': query_expander.get_stats(),
+            'query_construction': query_constructor.get_stats(),
+            'context_compression': extractive_compressor.get_stats(),
+            'retrieval_memory': retrieval_memory.get_stats()
+        }
+        if RERANK_MODE == 'cascade':
+            data['rerank_cascade'] = cascade_ranker.get_stats()
+        return {'retcode': 0, 'message': 'Success', 'data': data}
+    except Exception as e:
+        logger.error(f"Failed to retrieve metrics: {e}")
+        return {
+            'retcode': -30000,
+            'message': f'An error occurred: {e}',
+            'data': {}
+        }
+
+
+# The SQL expressions of the supported `group_by` dimensions of LLM usage
+usage_group_by_map = {
+    'day': "date(ctime, 'unixepoch', 'localtime')",
+    'model': 'model_name',
+    'stage': 'stage'
+}
+
+
+@metrics_bp.route('/get_llm_usage', methods=['POST'])
+@token_required
+def get_llm_usage():
+    """ Aggregate the token usage, cost and latency of LLM calls within a time range by day, model and stage.
+
+    Each worker process buffers its usage records, the calls of the last `LLM_USAGE_FLUSH_INTERVAL` seconds
+    may not be counted yet.
+    """
+    data = request.json
+    start_timestamp = data.get('start_timestamp')
+    end_timestamp = data.get('end_timestamp')
+    group_by = data.get('group_by', ['day', 'model', 'stage'])
+
+    if None in ([start_timestamp, end_timestamp]):
+        return {'retcode': -20000, 'message': 'Missing required parameters'}
+
+    if not isinstance(start_timestamp, int) or not isinstance(
+            end_timestamp, int):
+        return {
+            'retcode': -20001,
+            'message': 'Invalid start_timestamp or end_timestamp parameters',
+            'data': {}
+        }
+
+    if not isinstance(group_by, list) or not group_by or any(
+            key not in usage_group_by_map for key in group_by):
+        return {
+            'retcode': -20001,
+            'message':
+            f'Invalid group_by parameter, must be a non-empty subset of {list(usage_group_by_map)}',
+            'data': {}
+        }
+
+    group_by = list(dict.fromkeys(group_by))
+    columns = ', '.join(f"{usage_group_by_map[key]} AS {key}"
+                        for key in group_by)
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {columns},
+                COUNT(*) AS requests,
+                SUM(prompt_tokens) AS prompt_tokens,
+                SUM(completion_tokens) AS completion_tokens,
+                SUM(total_tokens) AS total_tokens,
+                SUM(cost) AS cost,
+                AVG(CASE WHEN cache_hit = 0 THEN latency_ms END) AS avg_latency_ms,
+                AVG(CASE WHEN first_token_ms > 0 THEN first_token_ms END) AS avg_first_token_ms,
+                SUM(cache_hit) AS cache_hits,
+                SUM(coalesced) AS coalesced
+            FROM t_llm_usage_tab
+            WHERE ctime BETWEEN ? AND ?
+            GROUP BY {', '.join(group_by)}
+            ORDER BY {', '.join(group_by)}
+        """, (start_timestamp, end_timestamp))
+        usage_list = [dict(row) for row in cur.fetchall()]
+
+        return {
+            'retcode': 0,
+            'message': 'Success',
+            'data': {
+                'group_by': group_by,
+                'usage_list': usage_list
+            }
+        }
+    except Exception as e:
+        logger.error(f"Failed to retrieve LLM usage: {e}")
+        return {'retcode': -30000, 'message': 'Internal server error'}
+    finally:
+        if conn:
+            conn.close()
@@ -1,36 +1,60 @@
 from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+import itertools
 import json
+import math
 import os
 from threading import Thread
 import time
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 from urllib.parse import urlparse
 from flask import Blueprint, request, Response
 from langchain.schema.document import Document
 from server.constant.constants import (RECALL_TOP_K, RERANK_RECALL_TOP_K,
+                                       RERANK_MODE,
+                                       QUERY_CONSTRUCTION_MIN_RESULTS,
                                        MAX_QUERY_LENGTH, SESSION_EXPIRE_TIME,
                                        MAX_HISTORY_SESSION_LENGTH)
 from server.app.utils.decorators import token_required
 from server.app.utils.sqlite_client import get_db_connection
 from server.app.utils.diskcache_client import diskcache_client
 from server.app.utils.diskcache_lock import diskcache_lock
+from server.app.utils.hash import generate_md5
+from server.app.utils.single_flight import SingleFlight
+from server.app.utils.text_helper import normalize_text
 from server.logger.logger_config import my_logger as logger
+from server.rag.generation.json_answer_parser import JsonAnswerStreamParser, parse_json_answer
 from server.rag.generation.llm import llm_generator
+from server.rag.generation.prompt_templates import prompt_template_registry
+from server.rag.generation.provider_limiter import ProviderBusyError
+from server.rag.generation.usage_recorder import usage_recorder
+from server.rag.index.embedder.document_embedder import get_kb_version
+from server.rag.pre_retrieval.query_construction.query_constructor import query_constructor
+from server.rag.pre_retrieval.query_expansion.query_expander import query_expander
+from server.rag.pre_retrieval.query_routing.query_router import QueryRoute, query_router
+from server.rag.pre_retrieval.query_transformation.refine_classifier import refine_classifier
 from server.rag.pre_retrieval.query_transformation.rewrite import detect_query_lang
-from server.rag.post_retrieval.rerank.flash_ranker import RerankRequest, reranker
+from server.rag.post_retrieval.compression.extractive_compressor import extractive_compressor
+from server.rag.post_retrieval.conversation.retrieval_memory import retrieval_memory
+from server.rag.post_retrieval.rerank.cascade_ranker import cascade_ranker
+from server.rag.post_retrieval.rerank.flash_ranker import RerankRequest
+from server.rag.post_retrieval.rerank.rerank_batcher import rerank_batcher
+from server.rag.retrieval.rank_fusion import reciprocal_rank_fusion
 from server.rag.retrieval.vector_search import vector_search
 
-LLM_NAME = os.getenv('LLM_NAME')
-
 MIN_RELEVANCE_SCORE = float(os.getenv('MIN_RELEVANCE_SCORE', '0.3'))
 BOT_TOPIC = os.getenv('BOT_TOPIC')
 USE_PREPROCESS_QUERY = int(os.getenv('USE_PREPROCESS_QUERY'))
 USE_RERANKING = int(os.getenv('USE_RERANKING'))
 USE_DEBUG = int(os.getenv('USE_DEBUG'))
+USE_QUERY_EXPANSION = int(os.getenv('USE_QUERY_EXPANSION', '0'))
+USE_CONTEXT_COMPRESSION = int(os.getenv('USE_CONTEXT_COMPRESSION', '0'))
 
 queries_bp = Blueprint('queries', __name__, url_prefix='/open_kf_api/queries')
 
+# Concurrent identical queries of this process share one answer computation
+answer_single_flight = SingleFlight('answer')
+
 
 def get_user_query_history(user_id: str, is_streaming: bool) -> List[Any]:
     if is_streaming:
@@ -97,25 +121,20 @@ def save_user_query_history(user_id: str, query: str, answer: str,
             conn.close()
 
 
-def refine_query(query: str, history_context: str, lang: str) -> str:
-    prompt = f"""Given a conversation (between Human and Assistant) and a follow up message from Human, using the prior knowledge relationships, rewrite the message to be a standalone and detailed question that captures all relevant context from the conversation. Ensure the rewritten question:
-1. Preserves the original intent of the follow-up message.
-2. If the true intent of the follow-up message cannot be determined, make no modifications to avoid generating an incorrect question.
-3. The length of the rewritten question should not increase significantly compared to the follow-up message, to avoid altering the original intent.
-4. Do not directly use the content of the Assistant's responses to form the rewritten question. Prioritize referring to the information of the Human's historical question.
-5. Maintains the same language as the follow-up message (e.g., reply in Chinese if the question was asked in Chinese and in English if it was asked in English).
-
-Chat History (Sorted by request time from most recent to oldest):
+def refine_query(query: str, history_context: str, lang: str,
+                 user_id: str) -> str:
+    user_prompt = f"""Chat History (Sorted by request time from most recent to oldest):
 {history_context}
 
 Follow Up Input: {query}
 
-**NOTE:** The detected language of the Input is '{lang}'. Please respond in '{lang}'.
-
 Refined Standalone Question:"""
+    messages = prompt_template_registry.build_messages('refine_query',
+                                                       user_prompt,
+                                                       lang=lang)
 
     beg_time = time.time()
-    response = llm_generator.generate(prompt, False, False)
+    response = llm_generator.generate(messages, False, False, 'refine')
     timecost = time.time() - beg_time
     adjust_query = response.choices[0].message.content
     logger.warning(
@@ -125,19 +144,43 @@ Refined Standalone Question:"""
         logger.warning(
             f"[Track token consumption] for refine_query: '{query}', usage={response.usage}"
         )
+    usage_recorder.record(user_id, 'refine_query',
+                          getattr(response, 'model', ''),
+                          getattr(response, 'usage', None), timecost)
+    refine_classifier.record_refine_latency(timecost * 1000)
     return adjust_query
 
 
-def search_documents(query: str, k: int) -> List[Tuple[Document, float]]:
+def search_documents(
+        query: str,
+        k: int,
+        where: Optional[Dict[str, Any]] = None
+) -> List[Tuple[Document, float]]:
     beg_time = time.time()
-    results = vector_search.similarity_search_with_relevance_scores(query, k)
+    results = vector_search.similarity_search_with_relevance_scores(
+        query, k, where)
     timecost = time.time() - beg_time
     logger.warning(
-        f"search_documents, query: '{query}', k: {k}, the timecost is {timecost}"
+        f"search_documents, query: '{query}', k: {k}, where: {where}, the timecost is {timecost}"
     )
     return results
 
 
+def batch_search_documents(
+        queries: List[str],
+        k: int,
+        where: Optional[Dict[str, Any]] = None
+) -> List[List[Tuple[Document, float]]]:
+    beg_time = time.time()
+    result_lists = vector_search.batch_similarity_search_with_relevance_scores(
+        queries, k, where)
+    timecost = time.time() - beg_time
+    logger.warning(
+        f"batch_search_documents, queries: {queries}, k: {k}, where: {where}, the timecost is {timecost}"
+    )
+    return result_lists
+
+
 def rerank_documents(
         query: str, results: List[Tuple[Document,
                                         float]]) -> List[Dict[str, Any]]:
@@ -157,7 +200,10 @@ def rerank_documents(
     if passages:
         beg_time = time.time()
         rerankrequest = RerankRequest(query=query, passages=passages)
-        rerank_results = reranker.rerank(rerankrequest)
+        if RERANK_MODE == 'cascade':
+            rerank_results = cascade_ranker.rerank(rerankrequest)
+        else:
+            rerank_results = rerank_batcher.rerank(rerankrequest)
         timecost = time.time() - beg_time
         logger.warning(
             f"For the query: '{query}', rerank_documents, the timecost is {timecost}"
@@ -185,11 +231,47 @@ def filter_documents(
     return filter_results
 
 
+def get_expanded_recall_documents(
+        queries: List[str],
+        k: int,
+        user_id: str,
+        min_relevance_score: float,
+        where: Optional[Dict[str, Any]] = None
+) -> List[Tuple[Document, float]]:
+    """ Searches all the variants of a query at once, and fuses their results by reciprocal rank. """
+    result_lists = [
+        filter_documents(ret, min_relevance_score)
+        for ret in batch_search_documents(queries, k, where)
+    ]
+    results = reciprocal_rank_fusion(result_lists)[:k]
+    if USE_DEBUG:
+        results_info = "\n********************\n".join([
+            f"URL: {doc.metadata['source']}\nscore: {score}\npage_content: {doc.page_content}"
+            for doc, score in results
+        ])
+        logger.info(
+            f"==========\nFor the queries: {queries}, '{user_id}', the fused recall results is\n{results_info}\n=========="
+        )
+    return results
+
+
 def get_recall_documents(
-        current_query, refined_query, k, user_id,
-        min_relevance_score: float) -> List[Tuple[Document, float]]:
+        current_query,
+        refined_query,
+        k,
+        user_id,
+        min_relevance_score: float,
+        expansions: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None
+) -> List[Tuple[Document, float]]:
+    if expansions:
+        queries = list(dict.fromkeys([current_query, refined_query] +
+                                     expansions))
+        return get_expanded_recall_documents(queries, k, user_id,
+                                             min_relevance_score, where)
+
     if current_query == refined_query:
-        ret = search_documents(current_query, k)
+        ret = search_documents(current_query, k, where)
         results = filter_documents(ret, min_relevance_score)
         if USE_DEBUG:
             results_info = "\n********************\n".join([
@@ -203,8 +285,10 @@ def get_recall_documents(
         return results
 
     with ThreadPoolExecutor() as executor:
-        future_ret1 = executor.submit(search_documents, current_query, k)
-        future_ret2 = executor.submit(search_documents, refined_query, k)
+        future_ret1 = executor.submit(search_documents, current_query, k,
+                                      where)
+        future_ret2 = executor.submit(search_documents, refined_query, k,
+                                      where)
 
         ret1 = filter_documents(future_ret1.result(), min_relevance_score)
         ret2 = filter_documents(future_ret2.result(), min_relevance_score)
@@ -240,17 +324,85 @@ def get_recall_documents(
         return results
 
 
-def generate_answer(query: str, user_id: str, is_streaming: bool = False):
+def get_routed_data(query_route: QueryRoute) -> Optional[str]:
+    """Returns the intervened or canned answer of a routed query in the format of the intervene data, if any."""
+    if query_route.intervene_data:
+        return query_route.intervene_data
+    if query_route.answer:
+        return json.dumps({
+            "answer": query_route.answer,
+            "source": []
+        },
+                          ensure_ascii=False)
+    return None
+
+
+def get_provider_busy_response(e: ProviderBusyError) -> Tuple[Dict[str, Any], int, Dict[str, str]]:
+    """Returns the 429 response telling the client when to retry, the LLM provider being saturated."""
+    return {
+        'retcode': -20002,
+        'message': str(e),
+        'data': {
+            'retry_after': e.retry_after
+        }
+    }, 429, {
+        'Retry-After': str(math.ceil(e.retry_after))
+    }
+
+
+def generate_answer(query: str,
+                    user_id: str,
+                    is_streaming: bool = False,
+                    is_json_streaming: bool = False,
+                    intent: str = 'knowledge'):
+    """ Returns the LLM response, and whether it is shared with an identical in-flight query.
+
+    `is_streaming` streams a Markdown answer, `is_json_streaming` streams the JSON answer of `smart_query`.
+    `intent` is the route of the query, see `QueryRouter`.
+    """
+    # Get the history session from the cache
+    history_session = get_user_query_history(user_id, is_streaming)
+    if history_session:
+        # The history of the user is part of the prompt, the answer can't be shared
+        return compute_answer(query, user_id, history_session, is_streaming,
+                              is_json_streaming, intent), False
+
+    # Identical queries without history build the same prompt, as long as the knowledge base is unchanged
+    query_md5 = generate_md5(normalize_text(query).encode('utf-8'))
+    key = f"{int(is_streaming)}:{int(is_json_streaming)}:{get_kb_version()}:{query_md5}"
+    if is_streaming or is_json_streaming:
+        return answer_single_flight.do_stream(
+            key, lambda: compute_answer(query, user_id, [], is_streaming,
+                                        is_json_streaming, intent))
+    return answer_single_flight.do(
+        key, lambda: compute_answer(query, user_id, [], False, False, intent))
+
+
+def compute_answer(query: str,
+                   user_id: str,
+                   history_session: List[Any],
+                   is_streaming: bool,
+                   is_json_streaming: bool = False,
+                   intent: str = 'knowledge'):
     bot_topic = BOT_TOPIC
 
     # Detect the language of the query
     lang = detect_query_lang(query)
     logger.warning(f"For query: '{query}', detect the language is '{lang}'!")
 
+    if intent == 'chitchat':
+        # Small talk is answered with a short prompt, without recall
+        messages = prompt_template_registry.build_messages(
+            'chitchat',
+            f"**Message:** {query}",
+            bot_topic=bot_topic,
+            lang=lang,
+            is_streaming=is_streaming)
+        return llm_generator.generate(messages, is_streaming
+                                      or is_json_streaming, not is_streaming)
+
     history_context = f"""Human: Hello
 Assistant: I'm here to assist you with information related to `{bot_topic}`. If you have any specific questions about our services or need help, feel free to ask, and I'll do my best to provide you with accurate and relevant answers."""
-    # Get the history session from the cache
-    history_session = get_user_query_history(user_id, is_streaming)
     if history_session:
         # Build the history context, showing user's historical queries and answers
         history_context = "\n--------------------\n".join([
@@ -258,8 +410,19 @@ Assistant: I'm here to assist you with information related to `{bot_topic}`. If
             for item in history_session
         ])
 
-    if USE_PREPROCESS_QUERY and history_context:
-        adjust_query = refine_query(query, history_context, lang)
+    # Follow-ups on the same topic reuse the documents of the previous turn instead of a fresh recall
+    previous_results, is_same_topic = retrieval_memory.get_previous_results(
+        user_id, is_streaming, query, history_session)
+
+    # The expansion of the query overlaps with its refinement
+    expansion_task = None
+    if USE_QUERY_EXPANSION and not is_same_topic:
+        expansion_task = query_expander.submit(query, lang, user_id)
+
+    # The synthetic greeting of `history_context` has nothing to resolve, only refine queries depending on real history
+    if USE_PREPROCESS_QUERY and refine_classifier.should_refine(
+            query, history_session):
+        adjust_query = refine_query(query, history_context, lang, user_id)
     else:
         adjust_query = query
 
@@ -268,28 +431,59 @@ Assistant: I'm here to assist you with information related to `{bot_topic}`. If
     else:
         top_k = RECALL_TOP_K
 
-    results = get_recall_documents(query, adjust_query, top_k, user_id,
-                                   MIN_RELEVANCE_SCORE)
-
-    filter_context = ''
-    # Build the context with filtered documents, showing relevant documents
+    if is_same_topic:
+        results = previous_results
+    else:
+        # Scoped questions only search the chunks matching their constraints
+        where = query_constructor.construct(adjust_query, user_id).to_where()
+
+        expansions = expansion_task.result() if expansion_task else []
+        results = get_recall_documents(query, adjust_query, top_k, user_id,
+                                       MIN_RELEVANCE_SCORE, expansions, where)
+        if where and len(results) < QUERY_CONSTRUCTION_MIN_RESULTS:
+            # The constraints may be too narrow, or the matching documents were embedded without these metadata
+            logger.warning(
+                f"For the query: '{query}', only {len(results)} documents match {where}, search the whole collection"
+            )
+            query_constructor.record_fallback()
+            results = get_recall_documents(query, adjust_query, top_k,
+                                           user_id, MIN_RELEVANCE_SCORE,
+                                           expansions)
+        if previous_results:
+            results = retrieval_memory.merge(results, previous_results,
+                                             MIN_RELEVANCE_SCORE)
+
+    # The relevant documents with their recall scores, from the most to the least relevant
+    top_results: List[Tuple[Document, float]] = []
     if USE_RERANKING and results:
         # Rerank the documents
         rerank_results = rerank_documents(query, results)
-        if rerank_results:
-            filter_context = "\n--------------------\n".join([
-                f"Citation URL: {doc['metadata']['source']}\nDocument Content: {doc['text']}"
-                for doc in rerank_results[:RECALL_TOP_K]
-            ])
+        top_results = [(Document(page_content=doc['text'],
+                                 metadata=doc['metadata']), doc['chroma_score'])
+                       for doc in rerank_results[:RECALL_TOP_K]]
     else:
         if len(results) > 1:
             results.sort(key=lambda x: x[1], reverse=True)
+        top_results = results[:RECALL_TOP_K]
+    retrieval_memory.save(user_id, is_streaming, adjust_query, top_results)
 
-        if results:
-            filter_context = "\n--------------------\n".join([
-                f"Citation URL: {doc.metadata['source']}\nDocument Content: {doc.page_content}"
-                for doc, score in results[:RECALL_TOP_K]
-            ])
+    # The (source, text) of the relevant documents
+    documents = [(doc.metadata['source'], doc.page_content)
+                 for doc, _ in top_results]
+
+    if USE_CONTEXT_COMPRESSION and documents:
+        # Only keep the sentences relevant to the query, the cross-encoder is already loaded with reranking
+        compressed_texts = extractive_compressor.compress(
+            adjust_query, [text for _, text in documents], USE_RERANKING)
+        documents = [(source, text)
+                     for (source, _), text in zip(documents, compressed_texts)
+                     if text]
+
+    # Build the context with filtered documents, showing relevant documents
+    filter_context = "\n--------------------\n".join([
+        f"Citation URL: {source}\nDocument Content: {text}"
+        for source, text in documents
+    ])
 
     if filter_context:
         context = f"""Chat History (Sorted by request time from most recent to oldest):
@@ -317,60 +511,29 @@ Documents Information:
 {fallback_answer}
 """
 
-    if not is_streaming:
-        answer_format_prompt = '''**Expected Response Format:**
-The response should be a JSON object, with 'answer' and 'source' fields.
-- "answer": "A detailed and specific answer, crafted in the question's language and fully formatted using **Markdown** syntax. **Don't repeat the question**". Only cite the most relevant Documents that answer the question accurately.
-- "source": ["List only unique `Citation URL` from the context that are directly related to the answer. Ensure that each URL is listed only once. If no documents are referenced, or the documents are not relevant, use an empty list []. The number of `Citation URL` should not exceed {RECALL_TOP_K}. The generated answer must have indeed used content from the document corresponding to the `Citation URL` before including that URL in the `source`; otherwise, the URL should not be included in the `source`."]'''
-    else:
-        answer_format_prompt = '''**Expected Response Format:**
-The response should be fully formatted using **Mardown** syntax (Note: Don't start with 'Answer:' or 'answer:'). First output the answer. Then output the Sources.
-- A detailed and specific answer, crafted in the question's language. Don't repeat the question. Only cite the most relevant Documents that answer the question accurately.
-- Sources: "List only unique `Citation URL` from the context that are directly related to the answer. Ensure that each URL is listed only once. If no documents are referenced, or the documents are not relevant, return ''. The number of `Citation URL` should not exceed {RECALL_TOP_K}. The generated answer must have indeed used content from the document corresponding to the `Citation URL` before including that URL in the `Sources`; otherwise, the URL should not be included in the `Sources`."'''
-
-    prompt = f"""
-You are a smart customer service assistant and problem-solver, tasked to answer any question about `{bot_topic}`. Using the provided context, answer the user's question to the best of your ability using the resources provided.
-
-If the user's question is a straightforward greeting, the assistant will offer a friendly standard response, guiding users to seek information or services related to `{bot_topic}`.
-
-Base on the Chat History and the provided context. First, analyze the provided context information without assuming prior knowledge. Identify all relevant aspects of knowledge contained within. Then, from various perspectives and angles, answer questions as thoroughly and comprehensively as possible to better address and resolve the user's question. If the question is not related to the provided context, the user is informed that no relevant answer can be provided.
-
-**Question:** {query}
+    # The static instructions go first in the system prompt, so that providers can reuse their cached prefix
+    user_prompt = f"""**Question:** {query}
 
 **Context for Answering the Question:**
-{context}
-
-**Response Requirements:**
-- Don't repeat the question at the beginning.
-- If unsure about the answer, proactively seek clarification.
-- Ensure that answers are strictly based on the provided context.
-- Inform users that questions unrelated to the provided context cannot be answered.
-- Format the answer using Markdown syntax for clarity and readability.
-- Respond in the language of the original question; for instance, reply in Chinese if the question was asked in Chinese and in English if it was asked in English!
-
-**REMEMBER:** Please do not fabricate any knowledge. If you cannot get knowledge from the provided context, please directly state that you do not know, rather than constructing nonexistent and potentially fake information!!!
-
-**NOTE:** The detected language of the question is '{lang}'. Please respond in '{lang}'.
-
-{answer_format_prompt}
-
-Please format answer as follows:
-The answer must be fully formatted using Markdown syntax. This includes:
-- **Bold** (`**bold**`) and *italic* (`*italic*`) text for emphasis.
-- Unordered lists (`- item`) for itemization and ordered lists (`1. item`) for sequencing.
-- `Inline code` (`` `Inline code` ``) for brief code snippets and (` ``` `) for longer examples, specifying the programming language for syntax highlighting when possible.
-- [Hyperlinks](URL) (`[Hyperlinks](URL)`) to reference external sources.
-- Headings (`# Heading 1`, `## Heading 2`, ...) to structure the answer effectively.
-"""
+{context}"""
+    messages = prompt_template_registry.build_messages(
+        'answer',
+        user_prompt,
+        bot_topic=bot_topic,
+        lang=lang,
+        is_streaming=is_streaming)
 
     if USE_DEBUG:
+        prompt = "\n".join(f"[{message['role']}]\n{message['content']}"
+                           for message in messages)
         logger.info(f"$$$$$$$$$$\nPrompt is:\n{prompt}\n$$$$$$$$$$")
 
     if is_streaming:
         is_json = False
     else:
         is_json = True
-    response = llm_generator.generate(prompt, is_streaming, is_json)
+    response = llm_generator.generate(messages, is_streaming
+                                      or is_json_streaming, is_json)
     return response
 
 
@@ -418,7 +581,14 @@ def smart_query():
         user_id = request.user_id
         query = request.query
         intervene_data = request.intervene_data
+        query_route = QueryRoute('intervention')
+        if not intervene_data:
+            # Intervened and canned answers are returned without recall
+            query_route = query_router.route(query)
+            intervene_data = get_routed_data(query_route)
         if intervene_data:
+            usage_recorder.record(user_id, 'smart_query', '', None, 0,
+                                  cache_hit=True)
             # Start a new thread to execute saving history records asynchronously
             Thread(target=save_user_query_history,
                    args=(user_id, query, intervene_data, False)).start()
@@ -433,25 +603,25 @@ def smart_query():
             query = query[:MAX_QUERY_LENGTH]
 
         beg_time = time.time()
-        response = generate_answer(query, user_id, False)
-        if hasattr(response, 'usage'):
+        response, is_coalesced = generate_answer(query,
+                                                 user_id,
+                                                 False,
+                                                 intent=query_route.intent)
+        if hasattr(response, 'usage') and not is_coalesced:
             logger.warning(
                 f"[Track token consumption] for smart_query: '{query}', usage={response.usage}"
             )
+        usage_recorder.record(user_id,
+                              'smart_query',
+                              getattr(response, 'model', ''),
+                              getattr(response, 'usage', None),
+                              time.time() - beg_time,
+                              coalesced=is_coalesced)
         answer = response.choices[0].message.content
 
-        #logger.warning(f"The answer is:\n{answer}")
-        if LLM_NAME == 'ZhipuAI':
-            #logger.warning(f"The answer is:\n{answer}")
-
-            # Solve the result format problem of ZhipuAI
-            if answer.startswith("```json"):
-                answer = answer[7:]
-                if answer.endswith("```"):
-                    answer = answer[:-3]
-
         timecost = time.time() - beg_time
-        answer_json = json.loads(answer)
+        # Some models (e.g. ZhipuAI) wrap the JSON object in a ```json fence
+        answer_json = parse_json_answer(answer)
         answer_json["source"] = list(dict.fromkeys(answer_json["source"]))
         logger.success(
             f"For smart_query, query: '{query}' and user_id: '{user_id}', is processed successfully, the answer is:\n{answer}\nthe total timecost is {timecost}\n"
@@ -459,8 +629,15 @@ def smart_query():
 
         # Start another new thread to execute saving history records asynchronously
         Thread(target=save_user_query_history,
-               args=(user_id, query, answer, False)).start()
+               args=(user_id, query, json.dumps(answer_json,
+                                                ensure_ascii=False),
+                     False)).start()
         return {"retcode": 0, "message": "success", "data": answer_json}
+    except ProviderBusyError as e:
+        logger.warning(
+            f"For the query: '{query}' and user_id: '{user_id}', the LLM provider is busy, the exception is {e}"
+        )
+        return get_provider_busy_response(e)
     except Exception as e:
         logger.error(
             f"For the query: '{query}' and user_id: '{user_id}', is processed failed, the exception is {e}"
@@ -482,7 +659,13 @@ def smart_query_stream():
         user_id = request.user_id
         query = request.query
         intervene_data = request.intervene_data
+        query_route = QueryRoute('intervention')
+        if not intervene_data:
+            query_route = query_router.route(query)
+            intervene_data = query_route.intervene_data
         if intervene_data:
+            usage_recorder.record(user_id, 'smart_query_stream', '', None, 0,
+                                  cache_hit=True)
             save_user_query_history(user_id, query, intervene_data, True)
 
             def generate_intervene():
@@ -492,29 +675,66 @@ def smart_query_stream():
                             mimetype="text/event-stream",
                             headers=headers)
 
+        if query_route.answer:
+            # The canned response of a chitchat query
+            usage_recorder.record(user_id, 'smart_query_stream', '', None, 0,
+                                  cache_hit=True)
+            save_user_query_history(user_id, query, query_route.answer, True)
+
+            def generate_canned():
+                yield query_route.answer
+
+            return Response(generate_canned(),
+                            mimetype="text/event-stream",
+                            headers=headers)
+
         if len(query) > MAX_QUERY_LENGTH:
             query = query[:MAX_QUERY_LENGTH]
 
+        beg_time = time.time()
+        response, is_coalesced = generate_answer(query,
+                                                 user_id,
+                                                 True,
+                                                 intent=query_route.intent)
+        # Wait for the first chunk, so that a busy provider is answered with a 429 before the headers are sent,
+        # for the followers of a coalesced query too
+        response = iter(response)
+        first_chunks = list(itertools.islice(response, 1))
+
         def generate_llm():
-            beg_time = time.time()
             answer_chunks = []
-            response = generate_answer(query, user_id, True)
-            for chunk in response:
+            first_token_timecost = 0.0
+            model_name = ''
+            usage = None
+            for chunk in itertools.chain(first_chunks, response):
                 #logger.info(f"chunk is: {chunk}")
-                content = chunk.choices[0].delta.content
+                model_name = getattr(chunk, 'model', None) or model_name
+                # The last chunk may only carry the usage
+                content = chunk.choices[0].delta.content if chunk.choices else None
                 if content:
+                    if not answer_chunks:
+                        first_token_timecost = time.time() - beg_time
                     answer_chunks.append(content)
                     # Send each answer segment
                     yield content
 
                 if hasattr(chunk, 'usage'):
                     if chunk.usage:
-                        logger.warning(
-                            f"[Track token consumption of streaming] for smart_query_stream: '{query}', usage={chunk.usage}"
-                        )
+                        usage = chunk.usage
+                        if not is_coalesced:
+                            logger.warning(
+                                f"[Track token consumption of streaming] for smart_query_stream: '{query}', usage={chunk.usage}"
+                            )
             # After the streaming response is complete, save to Cache and SQLite
             answer = ''.join(answer_chunks)
             timecost = time.time() - beg_time
+            usage_recorder.record(user_id,
+                                  'smart_query_stream',
+                                  model_name,
+                                  usage,
+                                  timecost,
+                                  first_token_latency=first_token_timecost,
+                                  coalesced=is_coalesced)
             logger.success(
                 f"query: '{query}' and user_id: '{user_id}' is processed successfully, the answer is:\n{answer}\nthe total timecost is {timecost}\n"
             )
@@ -523,6 +743,11 @@ def smart_query_stream():
         return Response(generate_llm(),
                         mimetype="text/event-stream",
                         headers=headers)
+    except ProviderBusyError as e:
+        logger.warning(
+            f"query: '{query}' and user_id: '{user_id}', the LLM provider is busy, the exception is {e}"
+        )
+        return get_provider_busy_response(e)
     except Exception as e:
         logger.error(
             f"query: '{query}' and user_id: '{user_id}' is processed failed, the exception is {e}"
@@ -530,6 +755,131 @@ def smart_query_stream():
         return {'retcode': -30000, 'message': str(e), 'data': {}}
 
 
+@queries_bp.route('/smart_query_json_stream', methods=['POST'])
+@check_smart_query
+@token_required
+def smart_query_json_stream():
+    """ The chunked-transfer variant of `smart_query`, with the latency of streaming and the same structured output.
+
+    The response is newline-delimited JSON: `{"answer_delta": "..."}` lines carry the answer as it is decoded
+    from the JSON-mode completion, then the last line is the same response as `smart_query`, with the
+    whole answer and the source.
+    """
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    user_id = request.user_id
+    query = request.query
+    intervene_data = request.intervene_data
+    query_route = QueryRoute('intervention')
+    if not intervene_data:
+        query_route = query_router.route(query)
+        intervene_data = get_routed_data(query_route)
+    if intervene_data:
+        usage_recorder.record(user_id,
+                              'smart_query_json_stream',
+                              '',
+                              None,
+                              0,
+                              cache_hit=True)
+        Thread(target=save_user_query_history,
+               args=(user_id, query, intervene_data, False)).start()
+
+        def generate_intervene():
+            yield json.dumps(
+                {
+                    "retcode": 0,
+                    "message": "success",
+                    "data": json.loads(intervene_data)
+                },
+                ensure_ascii=False) + "\n"
+
+        return Response(generate_intervene(),
+                        mimetype="application/x-ndjson",
+                        headers=headers)
+
+    if len(query) > MAX_QUERY_LENGTH:
+        query = query[:MAX_QUERY_LENGTH]
+
+    def generate_llm():
+        try:
+            beg_time = time.time()
+            parser = JsonAnswerStreamParser('answer')
+            first_token_timecost = 0.0
+            model_name = ''
+            usage = None
+            response, is_coalesced = generate_answer(
+                query,
+                user_id,
+                is_json_streaming=True,
+                intent=query_route.intent)
+            for chunk in response:
+                model_name = getattr(chunk, 'model', None) or model_name
+                # The last chunk may only carry the usage
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content:
+                    answer_delta = parser.feed(content)
+                    if answer_delta:
+                        if not first_token_timecost:
+                            first_token_timecost = time.time() - beg_time
+                        yield json.dumps({"answer_delta": answer_delta},
+                                         ensure_ascii=False) + "\n"
+
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                    if not is_coalesced:
+                        logger.warning(
+                            f"[Track token consumption of streaming] for smart_query_json_stream: '{query}', usage={chunk.usage}"
+                        )
+
+            answer_json = parser.finish()
+            answer_json["source"] = list(dict.fromkeys(answer_json["source"]))
+            timecost = time.time() - beg_time
+            usage_recorder.record(user_id,
+                                  'smart_query_json_stream',
+                                  model_name,
+                                  usage,
+                                  timecost,
+                                  first_token_latency=first_token_timecost,
+                                  coalesced=is_coalesced)
+            answer = json.dumps(answer_json, ensure_ascii=False)
+            logger.success(
+                f"For smart_query_json_stream, query: '{query}' and user_id: '{user_id}', is processed successfully, the answer is:\n{answer}\nthe total timecost is {timecost}\n"
+            )
+            Thread(target=save_user_query_history,
+                   args=(user_id, query, answer, False)).start()
+            yield json.dumps(
+                {
+                    "retcode": 0,
+                    "message": "success",
+                    "data": answer_json
+                },
+                ensure_ascii=False) + "\n"
+        except ProviderBusyError as e:
+            logger.warning(
+                f"For the query: '{query}' and user_id: '{user_id}', the LLM provider is busy, the exception is {e}"
+            )
+            yield json.dumps({
+                'retcode': -20002,
+                'message': str(e),
+                'data': {
+                    'retry_after': e.retry_after
+                }
+            }) + "\n"
+        except Exception as e:
+            logger.error(
+                f"For the query: '{query}' and user_id: '{user_id}', is processed failed, the exception is {e}"
+            )
+            yield json.dumps({
+                'retcode': -20001,
+                'message': str(e),
+                'data': {}
+            }) + "\n"
+
+    return Response(generate_llm(),
+                    mimetype="application/x-ndjson",
+                    headers=headers)
+
+
 @queries_bp.route('/get_user_conversation_list', methods=['POST'])
 @token_required
 def get_user_conversation_list():
@@ -1,19 +1,23 @@
 import asyncio
 from functools import wraps
 import json
-from threading import Thread
 import time
 from typing import Callable, Dict, Any, List
 from urllib.parse import urlparse
 from flask import Blueprint, request
 from server.app.utils.decorators import token_required
+from server.app.utils.ingestion_queue import ingestion_queue
 from server.app.utils.sqlite_client import get_db_connection
 from server.app.utils.diskcache_lock import diskcache_lock
 from server.app.utils.url_helper import is_valid_url
 from server.constant.constants import (ADD_SITEMAP_CONTENT,
                                        DELETE_SITEMAP_CONTENT,
                                        UPDATE_SITEMAP_CONTENT,
-                                       DOMAIN_PROCESSING, FROM_SITEMAP_URL)
+                                       DOMAIN_PROCESSING, FROM_SITEMAP_URL,
+                                       JOB_CRAWL_SITE,
+                                       JOB_ADD_SITEMAP_CONTENT,
+                                       JOB_DELETE_SITEMAP_CONTENT,
+                                       JOB_UPDATE_SITEMAP_CONTENT)
 from server.logger.logger_config import my_logger as logger
 from server.rag.index.parser.html_parser.web_link_crawler import AsyncCrawlerSiteLink
 from server.rag.index.parser.html_parser.web_content_crawler import AsyncCrawlerSiteContent
@@ -96,6 +100,7 @@ def submit_crawl_site():
                         "INSERT INTO t_sitemap_domain_tab (domain, domain_status, version, ctime, mtime) VALUES (?, 1, ?, ?, ?)",
                         (domain, timestamp, int(time.time()), int(
                             time.time())))
+                    domain_id = cur.lastrowid
 
                 conn.commit()
         except Exception as e:
@@ -106,8 +111,11 @@ def submit_crawl_site():
                 'data': {}
             }
 
-        # Start the asynchronous crawl task
-        Thread(target=async_crawl_link_task, args=(site, timestamp)).start()
+        # Enqueue the crawl task, the ingestion worker runs it in the background
+        ingestion_queue.enqueue(JOB_CRAWL_SITE, 0, [(domain_id, {
+            "site": site,
+            "version": timestamp
+        })])
 
         return {
             'retcode': 0,
@@ -266,6 +274,15 @@ def async_crawl_content_task(domain_list: List[str], url_dict: Dict[int, str],
     )
 
 
+def enqueue_crawl_content_jobs(job_type: int, url_dict: Dict[int,
+                                                             str]) -> None:
+    items = [(doc_id, {
+        "url": url,
+        "domain": urlparse(url).netloc
+    }) for doc_id, url in url_dict.items()]
+    ingestion_queue.enqueue(job_type, FROM_SITEMAP_URL, items)
+
+
 # Define the type for a generic Flask view function
 FlaskViewFunction = Callable[..., Dict[str, Any]]
 
@@ -354,11 +371,9 @@ def check_crawl_content_task(f: FlaskViewFunction) -> FlaskViewFunction:
 @check_crawl_content_task
 @token_required
 def add_crawl_url_list():
-    domain_list = request.domain_list
     url_dict = request.url_dict
-    # Use threading to avoid blocking the Flask application
-    Thread(target=async_crawl_content_task,
-           args=(domain_list, url_dict, ADD_SITEMAP_CONTENT)).start()
+    # Enqueue one job per URL, the ingestion worker processes them in the background
+    enqueue_crawl_content_jobs(JOB_ADD_SITEMAP_CONTENT, url_dict)
     return {
         'retcode': 0,
         'message': 'Started processing the URL list.',
@@ -370,11 +385,9 @@ def add_crawl_url_list():
 @check_crawl_content_task
 @token_required
 def delete_crawl_url_list():
-    domain_list = request.domain_list
     url_dict = request.url_dict
-    # Use threading to avoid blocking the Flask application
-    Thread(target=async_crawl_content_task,
-           args=(domain_list, url_dict, DELETE_SITEMAP_CONTENT)).start()
+    # Enqueue one job per URL, the ingestion worker processes them in the background
+    enqueue_crawl_content_jobs(JOB_DELETE_SITEMAP_CONTENT, url_dict)
     return {
         'retcode': 0,
         'message': 'Started deleting the URL list embeddings.',
@@ -386,11 +399,9 @@ def delete_crawl_url_list():
 @check_crawl_content_task
 @token_required
 def update_crawl_url_list():
-    domain_list = request.domain_list
     url_dict = request.url_dict
-    # Use threading to avoid blocking the Flask application
-    Thread(target=async_crawl_content_task,
-           args=(domain_list, url_dict, UPDATE_SITEMAP_CONTENT)).start()
+    # Enqueue one job per URL, the ingestion worker processes them in the background
+    enqueue_crawl_content_jobs(JOB_UPDATE_SITEMAP_CONTENT, url_dict)
     return {
         'retcode': 0,
         'message': 'Started updating the URL list embeddings.',
@@ -1,6 +1,5 @@
 import asyncio
 import json
-from threading import Thread
 import time
 from typing import Dict, Any
 from urllib.parse import urlparse
@@ -8,8 +7,11 @@ from flask import Blueprint, request
 from server.constant.constants import (MAX_ISOLATED_URL_BATCH_LENGTH,
                                        FROM_ISOLATED_URL,
                                        ADD_ISOLATED_URL_CONTENT,
-                                       DELETE_ISOLATED_URL_CONTENT)
+                                       DELETE_ISOLATED_URL_CONTENT,
+                                       JOB_ADD_ISOLATED_URL_CONTENT,
+                                       JOB_DELETE_ISOLATED_URL_CONTENT)
 from server.app.utils.decorators import token_required
+from server.app.utils.ingestion_queue import ingestion_queue
 from server.app.utils.sqlite_client import get_db_connection
 from server.app.utils.diskcache_lock import diskcache_lock
 from server.app.utils.url_helper import is_valid_url, normalize_url
@@ -127,9 +129,12 @@ def submit_isolated_url_list() -> Dict[str, Any]:
             normalized_url_list)
         url_dict = {row['id']: row['url'] for row in cur.fetchall()}
 
-        # Start the asynchronous crawl task
-        Thread(target=async_isolated_url_content_task,
-               args=(url_dict, ADD_ISOLATED_URL_CONTENT)).start()
+        # Enqueue one job per URL, the ingestion worker processes them in the background
+        ingestion_queue.enqueue(JOB_ADD_ISOLATED_URL_CONTENT,
+                                FROM_ISOLATED_URL,
+                                [(doc_id, {
+                                    "url": url
+                                }) for doc_id, url in url_dict.items()])
 
         return {
             'retcode': 0,
@@ -211,9 +216,12 @@ def delete_isolated_url_list():
             url_id_list)
         url_dict = {row['id']: row['url'] for row in cur.fetchall()}
 
-        # Use threading to avoid blocking the Flask application
-        Thread(target=async_isolated_url_content_task,
-               args=(url_dict, DELETE_ISOLATED_URL_CONTENT)).start()
+        # Enqueue one job per URL, the ingestion worker processes them in the background
+        ingestion_queue.enqueue(JOB_DELETE_ISOLATED_URL_CONTENT,
+                                FROM_ISOLATED_URL,
+                                [(doc_id, {
+                                    "url": url
+                                }) for doc_id, url in url_dict.items()])
 
         return {
             'retcode': 0,
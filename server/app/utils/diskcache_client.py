@@ -1,3 +1,4 @@
+import os
 from typing import Any, Optional, List
 from diskcache import Cache
 from server.constant.constants import DISKCACHE_DIR
@@ -6,6 +7,8 @@ from server.constant.constants import DISKCACHE_DIR
 class DiskcacheClient:
     def __init__(self, diskcache_dir: str) -> None:
         self.cache: Cache = Cache(diskcache_dir)
+        # A SQLite connection must not be used across a fork, the cache reconnects on next use
+        os.register_at_fork(before=self.cache.close)
 
     def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
         """
@@ -0,0 +1,209 @@
+import json
+import os
+import socket
+from threading import Event
+import time
+from typing import Any, Dict, List, Tuple
+from server.app.utils.sqlite_client import get_db_connection
+from server.app.utils.diskcache_lock import diskcache_lock
+from server.constant.constants import (JOB_FAILED, JOB_PENDING, JOB_RUNNING,
+                                       JOB_DONE, INGESTION_JOB_LEASE_TIME,
+                                       INGESTION_JOB_MAX_RETRIES,
+                                       INGESTION_JOB_RETRY_DELAY)
+from server.logger.logger_config import my_logger as logger
+
+
+class IngestionQueue:
+    """ A SQLite-backed queue of per-document ingestion jobs, shared by all processes.
+
+    A worker leases pending jobs for `INGESTION_JOB_LEASE_TIME` seconds and renews the lease while working.
+    A job whose lease expires (e.g. the worker was restarted) becomes leasable again and counts as a retry.
+    """
+    def __init__(self, lease_time: int = INGESTION_JOB_LEASE_TIME) -> None:
+        self.lease_time = lease_time
+        self.distributed_lock = diskcache_lock
+        # Wakes up the worker of this process when a job is enqueued
+        self.new_job_event = Event()
+
+    @staticmethod
+    def get_worker_id() -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def enqueue(self,
+                job_type: int,
+                doc_source: int,
+                items: List[Tuple[int, Dict[str, Any]]],
+                skip_unfinished: bool = False) -> List[int]:
+        """ Adds one job per document.
+
+        Args:
+            job_type (int): The job type, `JOB_*` in constants.
+            doc_source (int): The document source, `FROM_*` in constants, or 0 for site level jobs.
+            items (List[Tuple[int, Dict[str, Any]]]): Pairs of doc_id and the payload needed to process it.
+            skip_unfinished (bool): Skip the documents that already have a pending or running job.
+
+        Returns:
+            List[int]: The ids of the inserted jobs.
+        """
+        timestamp = int(time.time())
+        job_id_list = []
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                cur = conn.cursor()
+                unfinished_doc_ids = set()
+                if skip_unfinished:
+                    cur.execute(
+                        "SELECT DISTINCT doc_id FROM t_ingestion_job_tab WHERE doc_source = ? AND job_status IN (?, ?)",
+                        (doc_source, JOB_PENDING, JOB_RUNNING))
+                    unfinished_doc_ids = {row["doc_id"] for row in cur.fetchall()}
+                for doc_id, payload in items:
+                    if doc_id in unfinished_doc_ids:
+                        continue
+                    cur.execute(
+                        "INSERT INTO t_ingestion_job_tab (job_type, doc_source, doc_id, payload, job_status, retry_count, lease_owner, lease_expire_time, available_time, checkpoint, last_error, ctime, mtime) VALUES (?, ?, ?, ?, ?, 0, '', 0, ?, '{}', '', ?, ?)",
+                        (job_type, doc_source, doc_id, json.dumps(payload),
+                         JOB_PENDING, timestamp, timestamp, timestamp))
+                    job_id_list.append(cur.lastrowid)
+                conn.commit()
+        finally:
+            conn.close()
+        logger.info(
+            f"[INGESTION_QUEUE] enqueue, job_type: {job_type}, doc_source: {doc_source}, job_id_list: {job_id_list}"
+        )
+        if job_id_list:
+            self.new_job_event.set()
+        return job_id_list
+
+    def lease(self, worker_id: str, batch_size: int) -> List[Dict[str, Any]]:
+        """ Leases up to `batch_size` jobs of the same type, oldest first.
+
+        A job is skipped while an older unfinished job exists for the same document, so the add and delete
+        jobs of one document never run concurrently or out of order.
+        """
+        now = int(time.time())
+        leasable = "((j.job_status = ? AND j.available_time <= ?) OR (j.job_status = ? AND j.lease_expire_time < ?))"
+        blocked = "EXISTS (SELECT 1 FROM t_ingestion_job_tab o WHERE o.doc_source = j.doc_source AND o.doc_id = j.doc_id AND o.id < j.id AND o.job_status IN (?, ?))"
+        params = [JOB_PENDING, now, JOB_RUNNING, now, JOB_PENDING, JOB_RUNNING]
+
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                cur = conn.cursor()
+                cur.execute(
+                    f"SELECT j.job_type FROM t_ingestion_job_tab j WHERE {leasable} AND NOT {blocked} ORDER BY j.id LIMIT 1",
+                    params)
+                row = cur.fetchone()
+                if not row:
+                    return []
+
+                cur.execute(
+                    f"SELECT j.* FROM t_ingestion_job_tab j WHERE j.job_type = ? AND {leasable} AND NOT {blocked} ORDER BY j.id LIMIT ?",
+                    [row["job_type"]] + params + [batch_size])
+                jobs = [dict(r) for r in cur.fetchall()]
+
+                leased_jobs = []
+                for job in jobs:
+                    if job["job_status"] == JOB_RUNNING:
+                        # The previous lease expired, the worker holding it is gone
+                        job["retry_count"] += 1
+                        if job["retry_count"] > INGESTION_JOB_MAX_RETRIES:
+                            cur.execute(
+                                "UPDATE t_ingestion_job_tab SET job_status = ?, retry_count = ?, lease_owner = '', last_error = ?, mtime = ? WHERE id = ?",
+                                (JOB_FAILED, job["retry_count"],
+                                 'lease expired too many times', now,
+                                 job["id"]))
+                            logger.error(
+                                f"[INGESTION_QUEUE] job_id: {job['id']} failed, lease expired too many times"
+                            )
+                            continue
+                    cur.execute(
+                        "UPDATE t_ingestion_job_tab SET job_status = ?, retry_count = ?, lease_owner = ?, lease_expire_time = ?, mtime = ? WHERE id = ?",
+                        (JOB_RUNNING, job["retry_count"], worker_id,
+                         now + self.lease_time, now, job["id"]))
+                    job["payload"] = json.loads(job["payload"])
+                    job["checkpoint"] = json.loads(job["checkpoint"])
+                    leased_jobs.append(job)
+                conn.commit()
+                return leased_jobs
+        finally:
+            conn.close()
+
+    def renew(self, worker_id: str, job_id_list: List[int]) -> None:
+        if not job_id_list:
+            return
+        now = int(time.time())
+        placeholders = ','.join(['?'] * len(job_id_list))
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                conn.execute(
+                    f"UPDATE t_ingestion_job_tab SET lease_expire_time = ?, mtime = ? WHERE lease_owner = ? AND job_status = ? AND id IN ({placeholders})",
+                    [now + self.lease_time, now, worker_id, JOB_RUNNING] +
+                    job_id_list)
+                conn.commit()
+        finally:
+            conn.close()
+
+    def save_checkpoint(self, job_id: int, checkpoint: Dict[str,
+                                                            Any]) -> None:
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                conn.execute(
+                    "UPDATE t_ingestion_job_tab SET checkpoint = ?, mtime = ? WHERE id = ?",
+                    (json.dumps(checkpoint), int(time.time()), job_id))
+                conn.commit()
+        finally:
+            conn.close()
+
+    def complete(self, job_id_list: List[int]) -> None:
+        if not job_id_list:
+            return
+        placeholders = ','.join(['?'] * len(job_id_list))
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                conn.execute(
+                    f"UPDATE t_ingestion_job_tab SET job_status = ?, lease_owner = '', mtime = ? WHERE id IN ({placeholders})",
+                    [JOB_DONE, int(time.time())] + job_id_list)
+                conn.commit()
+        finally:
+            conn.close()
+
+    def fail(self, jobs: List[Dict[str, Any]], error: str) -> List[int]:
+        """ Schedules the jobs for a retry with exponential backoff, or marks them as failed.
+
+        Returns:
+            List[int]: The doc_id list of the jobs that have exhausted their retries.
+        """
+        now = int(time.time())
+        exhausted_doc_id_list = []
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                for job in jobs:
+                    retry_count = job["retry_count"] + 1
+                    if retry_count > INGESTION_JOB_MAX_RETRIES:
+                        conn.execute(
+                            "UPDATE t_ingestion_job_tab SET job_status = ?, retry_count = ?, lease_owner = '', last_error = ?, mtime = ? WHERE id = ?",
+                            (JOB_FAILED, retry_count, error, now, job["id"]))
+                        exhausted_doc_id_list.append(job["doc_id"])
+                    else:
+                        available_time = now + INGESTION_JOB_RETRY_DELAY * 2**(
+                            retry_count - 1)
+                        conn.execute(
+                            "UPDATE t_ingestion_job_tab SET job_status = ?, retry_count = ?, lease_owner = '', available_time = ?, last_error = ?, mtime = ? WHERE id = ?",
+                            (JOB_PENDING, retry_count, available_time, error,
+                             now, job["id"]))
+                conn.commit()
+        finally:
+            conn.close()
+        logger.error(
+            f"[INGESTION_QUEUE] fail, job_id_list: {[job['id'] for job in jobs]}, error: '{error}', exhausted doc_id_list: {exhausted_doc_id_list}"
+        )
+        return exhausted_doc_id_list
+
+
+# Initialize the ingestion job queue
+ingestion_queue = IngestionQueue()
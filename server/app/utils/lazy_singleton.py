@@ -0,0 +1,67 @@
+import os
+from threading import Lock
+import time
+from typing import Any, Callable, Generic, List, TypeVar
+from server.logger.logger_config import my_logger as logger
+
+T = TypeVar('T')
+
+
+class LazySingleton(Generic[T]):
+    """ A module level instance that is only created on first use or on an explicit `warmup()`.
+
+    Attribute access is forwarded to the instance, so call sites use it like the instance itself.
+    After a fork, a created instance that defines `reinit_after_fork()` gets it called in the child,
+    to rebuild what doesn't survive a fork (threads, ONNX Runtime sessions) while keeping the
+    read-only data loaded by the parent. Other instances (e.g. holding SQLite or HTTP connections)
+    are dropped in the child and created again on first use.
+    """
+    registry: List['LazySingleton'] = []
+
+    def __init__(self, name: str, factory: Callable[[], T]) -> None:
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = Lock()
+        LazySingleton.registry.append(self)
+
+    def warmup(self) -> T:
+        """Creates the instance if it doesn't exist yet and returns it."""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    beg_time = time.time()
+                    self._instance = self._factory()
+                    timecost = time.time() - beg_time
+                    logger.info(
+                        f"[LAZY_SINGLETON] '{self._name}' created in pid {os.getpid()}, the timecost is {timecost}"
+                    )
+        return self._instance
+
+    def is_created(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.warmup(), attr)
+
+    def __repr__(self) -> str:
+        return f"LazySingleton('{self._name}', created={self.is_created()})"
+
+    @classmethod
+    def reinit_after_fork(cls) -> None:
+        for singleton in cls.registry:
+            # The lock may have been held by another thread of the parent
+            singleton._lock = Lock()
+            instance = singleton._instance
+            if instance is None:
+                continue
+            if hasattr(instance, 'reinit_after_fork'):
+                instance.reinit_after_fork()
+                logger.info(
+                    f"[LAZY_SINGLETON] '{singleton._name}' reinitialized in pid {os.getpid()}"
+                )
+            else:
+                singleton._instance = None
+
+
+os.register_at_fork(after_in_child=LazySingleton.reinit_after_fork)
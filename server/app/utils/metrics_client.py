@@ -0,0 +1,56 @@
+from typing import Dict, List
+from diskcache import Cache
+from server.app.utils.diskcache_client import diskcache_client
+from server.logger.logger_config import my_logger as logger
+
+
+class MetricsClient:
+    """ Integer counters stored in Diskcache, so that they are shared by all worker processes. """
+    KEY_PREFIX = "open_kf:metrics:"
+    NAMES_KEY = "open_kf:metrics_names"
+
+    def __init__(self, cache: Cache) -> None:
+        self.cache: Cache = cache
+
+    def incr(self, name: str, delta: int = 1) -> None:
+        """
+        Atomically increment a counter, creating it on first use.
+
+        Args:
+            name (str): The counter name, e.g. 'query_embedding_cache:lru_hit'.
+            delta (int): The amount to add.
+        """
+        try:
+            value = self.cache.incr(f"{self.KEY_PREFIX}{name}",
+                                    delta,
+                                    default=0)
+            if value == delta:
+                # First increment, register the name so the counter can be listed
+                with self.cache.transact():
+                    names = set(self.cache.get(self.NAMES_KEY, default=[]))
+                    if name not in names:
+                        names.add(name)
+                        self.cache.set(self.NAMES_KEY, sorted(names))
+        except Exception as e:
+            # Metrics must never break the request path
+            logger.error(f"Increment metric '{name}' failed, the exception is {e}")
+
+    def get(self, name: str) -> int:
+        return self.cache.get(f"{self.KEY_PREFIX}{name}", default=0)
+
+    def get_all(self, prefix: str = '') -> Dict[str, int]:
+        """
+        Get all counters whose name starts with `prefix`.
+
+        Returns:
+            Dict[str, int]: The counter values keyed by name.
+        """
+        names: List[str] = self.cache.get(self.NAMES_KEY, default=[])
+        return {
+            name: self.get(name)
+            for name in names if name.startswith(prefix)
+        }
+
+
+# Initialize metrics client
+metrics_client = MetricsClient(diskcache_client.cache)
@@ -0,0 +1,142 @@
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from server.app.utils.metrics_client import metrics_client
+from server.logger.logger_config import my_logger as logger
+
+
+class Flight:
+    """ One in-flight computation, shared by the leader that runs it and the followers that join it.
+
+    A streamed result is published chunk by chunk, so followers receive the chunks as they arrive
+    instead of waiting for the end of the computation.
+    """
+    def __init__(self) -> None:
+        self.chunks: List[Any] = []
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        self.done = False
+        self.condition = Condition()
+
+    def publish(self, chunk: Any) -> None:
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, result: Any = None, error: Optional[Exception] = None) -> None:
+        with self.condition:
+            self.result = result
+            self.error = error
+            self.done = True
+            self.condition.notify_all()
+
+    def wait(self) -> Any:
+        """Returns the result of the computation, or raises its error."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def iter_chunks(self) -> Iterator[Any]:
+        """Yields all chunks from the first one, waiting for the next one until the stream ends."""
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+                done = self.done
+            yield from chunks
+            index += len(chunks)
+            if done and index == len(self.chunks):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """ Coalesces concurrent identical computations of this process into a single one.
+
+    The first caller of a key becomes the leader and runs the computation, the callers arriving
+    while it is in flight share its result. The key is released when the computation ends, so
+    results are never cached beyond the flight.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.flights: Dict[str, Flight] = {}
+        self.lock = Lock()
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                metrics_client.incr(f"single_flight:{self.name}:followers")
+                return flight, False
+            flight = Flight()
+            self.flights[key] = flight
+        metrics_client.incr(f"single_flight:{self.name}:leaders")
+        return flight, True
+
+    def release(self, key: str, flight: Flight) -> None:
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """ Runs `fn` once for concurrent callers of the same key.
+
+        Args:
+            key (str): Identifies the computation.
+            fn (Callable[[], Any]): The computation.
+
+        Returns:
+            Tuple[Any, bool]: The result of `fn`, shared by all callers of the flight, and whether
+            this caller is a follower that didn't run it.
+        """
+        flight, is_leader = self.join(key)
+        if not is_leader:
+            return flight.wait(), True
+        try:
+            result = fn()
+            flight.finish(result=result)
+            return result, False
+        except Exception as e:
+            flight.finish(error=e)
+            raise
+        finally:
+            self.release(key, flight)
+
+    def do_stream(self, key: str,
+                  fn: Callable[[], Iterable[Any]]) -> Tuple[Iterator[Any], bool]:
+        """ Same as `do`, for a computation returning a stream of chunks.
+
+        The stream is consumed by a background thread of the leader, so it is not stalled by the
+        client of the leader disconnecting. Every caller, leader included, reads the published chunks.
+
+        Returns:
+            Tuple[Iterator[Any], bool]: All chunks of the stream, and whether this caller is a follower.
+        """
+        flight, is_leader = self.join(key)
+        if not is_leader:
+            return flight.iter_chunks(), True
+        try:
+            stream = fn()
+        except Exception as e:
+            flight.finish(error=e)
+            self.release(key, flight)
+            raise
+        Thread(target=self.pump, args=(key, flight, stream), daemon=True).start()
+        return flight.iter_chunks(), False
+
+    def pump(self, key: str, flight: Flight, stream: Iterable[Any]) -> None:
+        try:
+            for chunk in stream:
+                flight.publish(chunk)
+            flight.finish()
+        except Exception as e:
+            logger.error(
+                f"[SINGLE_FLIGHT] '{self.name}' stream of key '{key}' failed, the exception is {e}"
+            )
+            flight.finish(error=e)
+        finally:
+            self.release(key, flight)
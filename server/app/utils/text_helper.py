@@ -0,0 +1,8 @@
+import re
+import unicodedata
+
+
+def normalize_text(text: str) -> str:
+    """Normalize Unicode forms and collapse whitespace, so that equivalent texts share cache keys."""
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
@@ -25,6 +25,19 @@ ZHIPUAI_EMBEDDING_MODEL_NAME = "embedding-2"
 # Name of the Ollama model used for embedding text
 OLLAMA_EMBEDDING_MODEL_NAME = "mxbai-embed-large"
 
+# Method used to shrink embeddings before they are stored in Chroma, applied to both documents and queries.
+# 'none': Store full-dimension embeddings.
+# 'truncate': Keep the leading `EMBEDDING_REDUCED_DIMENSION` components (Matryoshka-style, e.g. text-embedding-3-small).
+# 'pca': Project onto principal components fitted by `python evaluate_embedding_dimension.py --save-pca <dim>`.
+# Changing this setting uses a separate Chroma collection, so the knowledge base must be imported again.
+EMBEDDING_REDUCTION_METHOD = "none"
+
+# Target dimension of the stored embeddings when `EMBEDDING_REDUCTION_METHOD` is not 'none'
+EMBEDDING_REDUCED_DIMENSION = 512
+
+# File storing the fitted PCA projection (mean and components)
+EMBEDDING_PCA_PROJECTION_FILE = "chroma_dir/pca_projection.npz"
+
 # Maximum length of text chunks when splitting up large documents
 MAX_CHUNK_LENGTH = 1300
 
@@ -167,3 +180,312 @@ LOCAL_FILE_EMBEDDED = 4
 FROM_SITEMAP_URL = 1
 FROM_ISOLATED_URL = 2
 FROM_LOCAL_FILE = 3
+
+# in t_ingestion_job_tab
+# `job_type` meanings:
+#  1 - 'Crawl the sitemap links of a site'
+#  2 - 'Add sitemap URL content'
+#  3 - 'Delete sitemap URL content'
+#  4 - 'Update sitemap URL content'
+#  5 - 'Add isolated URL content'
+#  6 - 'Delete isolated URL content'
+#  7 - 'Add local file content'
+#  8 - 'Delete local file content'
+JOB_CRAWL_SITE = 1
+JOB_ADD_SITEMAP_CONTENT = 2
+JOB_DELETE_SITEMAP_CONTENT = 3
+JOB_UPDATE_SITEMAP_CONTENT = 4
+JOB_ADD_ISOLATED_URL_CONTENT = 5
+JOB_DELETE_ISOLATED_URL_CONTENT = 6
+JOB_ADD_LOCAL_FILE_CONTENT = 7
+JOB_DELETE_LOCAL_FILE_CONTENT = 8
+
+# in t_ingestion_job_tab
+# `job_status` meanings:
+#  0 - 'Job failed after all retries'
+#  1 - 'Job pending'
+#  2 - 'Job running under a lease'
+#  3 - 'Job done'
+JOB_FAILED = 0
+JOB_PENDING = 1
+JOB_RUNNING = 2
+JOB_DONE = 3
+
+# Duration in seconds of a worker's lease on a job; an expired lease means the worker died and the job is retried
+INGESTION_JOB_LEASE_TIME = 300
+
+# Maximum number of retries of an ingestion job before it is marked as failed
+INGESTION_JOB_MAX_RETRIES = 3
+
+# Base delay in seconds before a failed ingestion job is retried, doubled on each retry
+INGESTION_JOB_RETRY_DELAY = 30
+
+# Maximum number of jobs of the same type that a worker leases and processes together
+INGESTION_JOB_BATCH_SIZE = MAX_CRAWL_PARALLEL_REQUEST * 2
+
+# Interval in seconds at which an idle ingestion worker polls for new jobs
+INGESTION_WORKER_POLL_INTERVAL = 2
+
+# Maximum number of query embeddings kept in the in-memory LRU of each worker process
+QUERY_EMBEDDING_LRU_SIZE = 2048
+
+# Duration in seconds that a query embedding is kept in the Diskcache tier shared by all worker processes
+QUERY_EMBEDDING_CACHE_EXPIRE_TIME = 7 * 24 * 3600
+
+# Maximum number of query-passage pairs scored by the re-ranking model in one inference
+RERANK_MAX_BATCH_SIZE = 64
+
+# Maximum time in milliseconds that the re-ranking dispatcher waits for concurrent requests to join a batch
+RERANK_MAX_WAIT_MS = 5
+
+# Maximum number of (query, passage) scores kept in the rerank score cache, the oldest scores are evicted first
+RERANK_SCORE_CACHE_MAX_SIZE = 200000
+
+# Number of cache writes of a process between two checks of `RERANK_SCORE_CACHE_MAX_SIZE`
+RERANK_SCORE_CACHE_PRUNE_INTERVAL = 100
+
+# Unique identifier for the distributed lock guarding writes to the rerank score cache.
+# It is separate from `DISTRIBUTED_LOCK_ID`, because chunks are evicted while that lock is held.
+RERANK_SCORE_CACHE_LOCK_ID = "open_kf:rerank_score_cache_lock"
+
+# Number of gunicorn worker processes sharing the CPU, keep it in sync with `workers` in gunicorn_config.py
+SERVER_WORKER_COUNT = 3
+
+# ONNX Runtime execution profile of the re-ranking model.
+# Number of threads used to parallelize an operator, 0 means the CPU cores divided by `SERVER_WORKER_COUNT`,
+# so that the worker processes don't oversubscribe the CPU.
+RERANK_INTRA_OP_NUM_THREADS = 0
+
+# Number of threads used to run independent operators in parallel
+RERANK_INTER_OP_NUM_THREADS = 1
+
+# Graph optimization level: 'disable', 'basic', 'extended' or 'all'
+RERANK_GRAPH_OPTIMIZATION_LEVEL = "all"
+
+# Whether ONNX Runtime keeps freed memory in an arena for reuse; disable it to return memory to the system
+RERANK_ENABLE_CPU_MEM_ARENA = True
+
+# Whether the optimized graph is serialized next to the model file and loaded on the next start
+RERANK_CACHE_OPTIMIZED_MODEL = True
+
+# Whether inputs are bound to reused buffers with IO binding instead of being passed to every `run` call
+RERANK_USE_IO_BINDING = False
+
+# Weight precision of the re-ranking model file: 'fp32' or 'int8' (dynamically quantized).
+# If the file of this precision is missing, the other one is used.
+RERANK_MODEL_PRECISION = "int8"
+
+# Minimum ratio of real tokens to padded tokens within a length bucket of re-ranking pairs.
+# A longer pair that would drop the ratio below it starts a new bucket, run as a separate inference.
+RERANK_MIN_PADDING_EFFICIENCY = 0.75
+
+# Re-ranking mode.
+# 'single': Score all recalled candidates with `RERANK_MODEL_NAME`.
+# 'cascade': Score all recalled candidates with the cheap `RERANK_CASCADE_FIRST_STAGE_MODEL`,
+#            then rescore the top `RERANK_CASCADE_TOP_M` survivors with `RERANK_MODEL_NAME`.
+RERANK_MODE = "single"
+
+# Cheap model of the first stage in the 'cascade' re-ranking mode
+RERANK_CASCADE_FIRST_STAGE_MODEL = "ms-marco-TinyBERT-L-2-v2"
+
+# Number of first stage survivors rescored by the second stage, keep it no less than `RECALL_TOP_K`
+RERANK_CASCADE_TOP_M = 8
+
+# Maximum number of passages whose token ids are kept in the LRU of each re-ranking model,
+# so that only the query is tokenized per request
+RERANK_PASSAGE_TOKEN_CACHE_SIZE = 20000
+
+# Maximum number of tokens of a query-passage pair fed to the re-ranking model, the model supports up to 512
+RERANK_MAX_LENGTH = 512
+
+# Number of passage tokens kept around the query terms before re-ranking, 0 disables windowing.
+# Each passage is trimmed to its window with the most query tokens instead of keeping its beginning,
+# e.g. 224 with `RERANK_MAX_LENGTH` = 256 roughly halves the inference time of long chunks.
+RERANK_PASSAGE_WINDOW_TOKENS = 0
+
+# Connection pool of the HTTP client of the LLM provider, shared by the request threads of each process
+LLM_HTTP_MAX_CONNECTIONS = 20
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+
+# Seconds an idle connection to the LLM provider is kept for reuse, below the idle timeout of the API gateways
+LLM_HTTP_KEEPALIVE_EXPIRY = 60
+
+# Timeouts in seconds of the LLM API calls: establishing a connection (including the TLS handshake),
+# waiting for the next chunk of the response, sending the request, and waiting for a pooled connection
+LLM_HTTP_CONNECT_TIMEOUT = 5
+LLM_HTTP_READ_TIMEOUT = 60
+LLM_HTTP_WRITE_TIMEOUT = 10
+LLM_HTTP_POOL_TIMEOUT = 5
+
+# Retries of the LLM SDK on connection errors, 429 and 5xx responses
+LLM_HTTP_MAX_RETRIES = 2
+
+# Whether HTTP/2 is negotiated with the LLM provider. It is opt-in: the 'h2' package it requires isn't in
+# requirements.txt, install it with `pip install httpx[http2]` before enabling it
+LLM_HTTP2 = False
+
+# Per-provider overrides of the `LLM_HTTP_*` settings above, keyed by `LLM_NAME`
+LLM_HTTP_PROVIDER_SETTINGS = {
+    # Local models may take long to produce the first token, and Ollama serves plain HTTP/1.1
+    "Ollama": {
+        "read_timeout": 300,
+        "max_retries": 0,
+        "http2": False
+    },
+}
+
+# Seconds to wait for the first token of a streaming answer from an LLM provider before a hedged request
+# is sent to the next provider in `LLM_FALLBACK_NAMES`; the first stream to produce tokens is used
+LLM_HEDGE_TTFT_DEADLINE = 3.0
+
+# Same as `LLM_HEDGE_TTFT_DEADLINE`, for non-streaming calls that wait for the whole response
+LLM_HEDGE_RESPONSE_DEADLINE = 20.0
+
+# Smoothing factor of the moving averages of the time to first token and the error rate of each LLM provider
+LLM_PROVIDER_HEALTH_ALPHA = 0.2
+
+# An LLM provider whose error rate exceeds it, or whose average time to first token exceeds the hedge deadline,
+# is moved behind the healthy providers for `LLM_PROVIDER_DEMOTION_TIME` seconds
+LLM_PROVIDER_MAX_ERROR_RATE = 0.5
+LLM_PROVIDER_DEMOTION_TIME = 60
+
+# LLM usage records are buffered in memory and written to `t_llm_usage_tab` in batches,
+# when `LLM_USAGE_BATCH_SIZE` records are pending or every `LLM_USAGE_FLUSH_INTERVAL` seconds
+LLM_USAGE_BATCH_SIZE = 50
+LLM_USAGE_FLUSH_INTERVAL = 5
+
+# Prices in USD per 1M prompt and completion tokens, used to estimate the cost of each LLM call.
+# Models that are not listed are recorded with a cost of 0.
+LLM_MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "deepseek-chat": (0.14, 0.28),
+    "deepseek-coder": (0.14, 0.28),
+}
+
+# Rate limits of the calls of each worker process to an LLM provider, keyed by `LLM_NAME` (embedding calls use the
+# provider serving the embeddings) then by model name, '*' matching any model: requests per minute (rpm) and tokens
+# per minute (tpm), 0 meaning unlimited, and concurrent calls. Divide the limits of the account by the number of workers.
+LLM_RATE_LIMITS = {
+    "OpenAI": {
+        "*": {
+            "rpm": 1000,
+            "tpm": 200000,
+            "max_concurrency": 16
+        }
+    },
+    "ZhipuAI": {
+        "*": {
+            "rpm": 300,
+            "tpm": 0,
+            "max_concurrency": 8
+        }
+    },
+    "Ollama": {
+        "*": {
+            "rpm": 0,
+            "tpm": 0,
+            "max_concurrency": 4
+        }
+    },
+}
+
+# Limits of the providers and models that are not listed in `LLM_RATE_LIMITS`
+LLM_RATE_LIMIT_DEFAULT = {"rpm": 0, "tpm": 0, "max_concurrency": 16}
+
+# Maximum number of calls waiting for a provider in each worker process, more calls are rejected right away
+LLM_LIMITER_MAX_QUEUE = 100
+
+# Maximum seconds a call of each priority class waits for a provider before it is rejected
+LLM_LIMITER_MAX_WAIT = {
+    "query_embedding": 10,
+    "refine": 15,
+    "answer": 30,
+    "ingestion": 600
+}
+
+# Share of the concurrent calls and of the rate limits of a provider that ingestion can't use,
+# so that live chat still gets capacity during a bulk ingestion
+LLM_LIMITER_RESERVED_SHARE = 0.25
+
+# Seconds to pause the calls to a provider after a 429 response without a Retry-After header
+LLM_LIMITER_DEFAULT_RETRY_AFTER = 5
+
+# Completion tokens of a chat call reserved from the tokens per minute of the provider, settled with the actual usage
+LLM_LIMITER_COMPLETION_TOKENS = 500
+
+# Maximum number of normalized queries whose detected language is kept in the LRU of each process
+LANG_DETECT_CACHE_SIZE = 10000
+
+# Minimum share of the letters of a query written in a script that identifies its language (e.g. Han, Hangul,
+# Cyrillic) to skip the statistical model of langid
+LANG_DETECT_SCRIPT_MIN_RATIO = 0.3
+
+# With `USE_PREPROCESS_QUERY`, follow-up queries shorter than these numbers of English words or Chinese characters
+# are treated as elliptical and refined with the chat history; longer queries without references are sent as is
+REFINE_MIN_SELF_CONTAINED_WORDS = 4
+REFINE_MIN_SELF_CONTAINED_CHARS = 6
+
+# Whether the queries that the local rules of the query router don't match are compared with the chitchat phrases
+# by embedding similarity. Only queries up to `QUERY_ROUTER_CLASSIFIER_MAX_LENGTH` characters are classified, and
+# the query embedding is cached, so knowledge questions reuse it for recall.
+QUERY_ROUTER_USE_EMBEDDING_CLASSIFIER = False
+QUERY_ROUTER_CLASSIFIER_MAX_LENGTH = 32
+
+# Minimum cosine similarity to a chitchat phrase for a query to be answered without recall
+QUERY_ROUTER_CHITCHAT_MIN_SIMILARITY = 0.9
+
+# With `USE_QUERY_EXPANSION`, the numbers of paraphrases and of hypothetical answers (HyDE) generated for a query
+QUERY_EXPANSION_MAX_PARAPHRASES = 3
+QUERY_EXPANSION_MAX_HYPOTHETICAL_ANSWERS = 1
+
+# Query expansion is dropped when the LLM call takes longer than this budget in milliseconds.
+# It is also skipped while its average latency exceeds the budget, except for one probe query out of `QUERY_EXPANSION_PROBE_INTERVAL`
+QUERY_EXPANSION_LATENCY_BUDGET_MS = 1500
+QUERY_EXPANSION_PROBE_INTERVAL = 20
+
+# Constant `k` of reciprocal rank fusion, the score of a document is the sum of 1 / (k + rank) over the result lists
+RRF_K = 60
+
+# Scoped questions (e.g. 'in the pdf', 'latest') search only the chunks matching their metadata filters.
+# When fewer than `QUERY_CONSTRUCTION_MIN_RESULTS` relevant chunks match, the whole collection is searched instead
+QUERY_CONSTRUCTION_MIN_RESULTS = 2
+
+# 'Latest' questions search the documents embedded within this number of days before the most recently embedded one
+QUERY_CONSTRUCTION_RECENT_DAYS = 90
+
+# Whether questions hinting at a scope that the local patterns can't resolve are sent to the LLM
+QUERY_CONSTRUCTION_USE_LLM = False
+
+# Maximum number of sections of the knowledge base listed in the prompt of the LLM fallback
+QUERY_CONSTRUCTION_MAX_LLM_SECTIONS = 50
+
+# With `USE_CONTEXT_COMPRESSION`, the compressed documents keep at least this share of the estimated tokens of the
+# recalled chunks. The budget follows the recalled size, so CJK text, estimated at a token per character, isn't cut harder
+CONTEXT_COMPRESSION_KEEP_RATIO = 0.6
+
+# Minimum token budget of the compressed documents, chunks fitting in it together are kept whole
+CONTEXT_COMPRESSION_MIN_TOKEN_BUDGET = 800
+
+# Number of sentences kept before and after each selected sentence
+CONTEXT_COMPRESSION_WINDOW = 1
+
+# A follow-up question reuses the documents of the previous turn without a fresh recall when at least this share of its
+# content words appears in the previous question or documents
+CONVERSATION_REUSE_MIN_TERM_COVERAGE = 0.8
+
+# Factor applied to the relevance scores of the previous turn's documents, merged with the recall of a new topic
+CONVERSATION_REUSE_SCORE_DECAY = 0.9
+
+# Maximum time in seconds that a rerank call waits for the dispatcher of the batcher, before scoring its pairs itself
+RERANK_DISPATCH_TIMEOUT = 10
+
+# New rerank scores are buffered in memory and written to `t_rerank_score_cache_tab` in batches,
+# when `RERANK_SCORE_CACHE_BATCH_SIZE` scores are pending or every `RERANK_SCORE_CACHE_FLUSH_INTERVAL` seconds
+RERANK_SCORE_CACHE_BATCH_SIZE = 500
+RERANK_SCORE_CACHE_FLUSH_INTERVAL = 2
+
+# Time in seconds that the content of an uploaded local file is kept in diskcache, until the ingestion worker writes it
+LOCAL_FILE_UPLOAD_TTL = 7 * 24 * 3600
@@ -5,19 +5,15 @@ from server.logger.logger_config import my_logger as logger
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
-def check_env_variables():
-    # LLM_NAME: Name of the language model being used, should be in ['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot'].
-    LLM_NAME = os.getenv('LLM_NAME')
-    llm_name_list = ['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot']
-    if LLM_NAME not in llm_name_list:
-        logger.error(
-            f"LLM_NAME: '{LLM_NAME}' is illegal! Must be in {llm_name_list}.")
-        sys.exit(-1)
+def check_llm_provider(LLM_NAME: str, is_fallback: bool = False) -> None:
+    """Exits if the API key or model name of the provider `LLM_NAME` is missing or illegal.
 
+    A fallback provider only serves chat completions, the embeddings always come from `LLM_NAME`.
+    """
     if LLM_NAME == 'OpenAI':
         # OPENAI_API_KEY: API key for accessing OpenAI's services.
         OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-        if OPENAI_API_KEY == 'xxxx':
+        if not OPENAI_API_KEY or OPENAI_API_KEY == 'xxxx':
             logger.error(f"OPENAI_API_KEY: '{OPENAI_API_KEY}' is illegal!")
             sys.exit(-1)
 
@@ -34,7 +30,7 @@ def check_env_variables():
     elif LLM_NAME == 'ZhipuAI':
         # ZHIPUAI_API_KEY: API key for accessing ZhipuAI's services.
         ZHIPUAI_API_KEY = os.getenv('ZHIPUAI_API_KEY')
-        if ZHIPUAI_API_KEY == 'xxxx':
+        if not ZHIPUAI_API_KEY or ZHIPUAI_API_KEY == 'xxxx':
             logger.error(f"ZHIPUAI_API_KEY: '{ZHIPUAI_API_KEY}' is illegal!")
             sys.exit(-1)
 
@@ -51,13 +47,13 @@ def check_env_variables():
     elif LLM_NAME == 'Ollama':
         # OLLAMA_MODEL_NAME: Specific Ollma model being used, e.g., 'llama3', 'llama3:70b', 'phi3', 'mistral', etc.
         OLLAMA_MODEL_NAME = os.getenv('OLLAMA_MODEL_NAME')
-        if OLLAMA_MODEL_NAME == 'xxxx':
+        if not OLLAMA_MODEL_NAME or OLLAMA_MODEL_NAME == 'xxxx':
             logger.error(
                 f"OLLAMA_MODEL_NAME: '{OLLAMA_MODEL_NAME}' is illegal! Mast be 'llama3', 'llama3:70b', 'phi3', 'mistral', etc."
             )
             sys.exit(-1)
 
-        OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL')
+        OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', '')
         if not OLLAMA_BASE_URL.startswith(
                 'http://') and not OLLAMA_BASE_URL.startswith('https://'):
             logger.error(
@@ -73,15 +69,16 @@ def check_env_variables():
             )
             sys.exit(-1)
     elif LLM_NAME == 'DeepSeek':
-        # ZHIPUAI_API_KEY: API key for accessing ZhipuAI's services.
+        # ZHIPUAI_API_KEY: API key for accessing ZhipuAI's services, DeepSeek uses ZhipuAI's Embedding API.
         ZHIPUAI_API_KEY = os.getenv('ZHIPUAI_API_KEY')
-        if ZHIPUAI_API_KEY == 'xxxx':
+        if not is_fallback and (not ZHIPUAI_API_KEY
+                                or ZHIPUAI_API_KEY == 'xxxx'):
             logger.error(f"ZHIPUAI_API_KEY: '{ZHIPUAI_API_KEY}' is illegal!")
             sys.exit(-1)
 
         # DEEPSEEK_API_KEY: API key for accessing DeepSeek's services.
         DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
-        if DEEPSEEK_API_KEY == 'xxxx':
+        if not DEEPSEEK_API_KEY or DEEPSEEK_API_KEY == 'xxxx':
             logger.error(f"DEEPSEEK_API_KEY: '{DEEPSEEK_API_KEY}' is illegal!")
             sys.exit(-1)
 
@@ -93,15 +90,16 @@ def check_env_variables():
             )
             sys.exit(-1)
     elif LLM_NAME == 'Moonshot':
-        # ZHIPUAI_API_KEY: API key for accessing ZhipuAI's services.
+        # ZHIPUAI_API_KEY: API key for accessing ZhipuAI's services, Moonshot uses ZhipuAI's Embedding API.
         ZHIPUAI_API_KEY = os.getenv('ZHIPUAI_API_KEY')
-        if ZHIPUAI_API_KEY == 'xxxx':
+        if not is_fallback and (not ZHIPUAI_API_KEY
+                                or ZHIPUAI_API_KEY == 'xxxx'):
             logger.error(f"ZHIPUAI_API_KEY: '{ZHIPUAI_API_KEY}' is illegal!")
             sys.exit(-1)
 
         # MOONSHOT_API_KEY: API key for accessing Moonshot's services.
         MOONSHOT_API_KEY = os.getenv('MOONSHOT_API_KEY')
-        if MOONSHOT_API_KEY == 'xxxx':
+        if not MOONSHOT_API_KEY or MOONSHOT_API_KEY == 'xxxx':
             logger.error(f"MOONSHOT_API_KEY: '{MOONSHOT_API_KEY}' is illegal!")
             sys.exit(-1)
 
@@ -113,6 +111,32 @@ def check_env_variables():
             )
             sys.exit(-1)
 
+
+def check_env_variables():
+    # LLM_NAME: Name of the language model being used, should be in ['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot'].
+    LLM_NAME = os.getenv('LLM_NAME')
+    llm_name_list = ['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot']
+    if LLM_NAME not in llm_name_list:
+        logger.error(
+            f"LLM_NAME: '{LLM_NAME}' is illegal! Must be in {llm_name_list}.")
+        sys.exit(-1)
+    check_llm_provider(LLM_NAME)
+
+    # LLM_FALLBACK_NAMES: Optional comma separated providers, tried in order when `LLM_NAME` is slow or fails, e.g. 'DeepSeek,Moonshot'.
+    # Their API keys and model names must be set as well.
+    LLM_FALLBACK_NAMES = os.getenv('LLM_FALLBACK_NAMES', '')
+    for fallback_name in [
+            name.strip() for name in LLM_FALLBACK_NAMES.split(',')
+            if name.strip()
+    ]:
+        if fallback_name not in llm_name_list or fallback_name == LLM_NAME:
+            logger.error(
+                f"LLM_FALLBACK_NAMES: '{LLM_FALLBACK_NAMES}' is illegal! Each name must be in {llm_name_list} and differ from LLM_NAME."
+            )
+            sys.exit(-1)
+        # A misconfigured fallback would only fail in the middle of a hedge
+        check_llm_provider(fallback_name, is_fallback=True)
+
     # MIN_RELEVANCE_SCORE: Minimum score for a document to be considered relevant, and will be used in prompt, between 0.3 and 0.7.
     MIN_RELEVANCE_SCORE = os.getenv('MIN_RELEVANCE_SCORE')
     try:
@@ -174,6 +198,22 @@ def check_env_variables():
             f"USE_RERANKING: {USE_RERANKING} is illegal! It should be 0 or 1!")
         sys.exit(-1)
 
+    # USE_QUERY_EXPANSION: Optional flag (0 or 1, default 0) indicating whether queries of the bot should be expanded with an LLM before recall.
+    USE_QUERY_EXPANSION = os.getenv('USE_QUERY_EXPANSION', '0')
+    if USE_QUERY_EXPANSION not in ['0', '1']:
+        logger.error(
+            f"USE_QUERY_EXPANSION: {USE_QUERY_EXPANSION} is illegal! It should be 0 or 1!"
+        )
+        sys.exit(-1)
+
+    # USE_CONTEXT_COMPRESSION: Optional flag (0 or 1, default 0) indicating whether the recalled documents should be compressed to their sentences relevant to the query.
+    USE_CONTEXT_COMPRESSION = os.getenv('USE_CONTEXT_COMPRESSION', '0')
+    if USE_CONTEXT_COMPRESSION not in ['0', '1']:
+        logger.error(
+            f"USE_CONTEXT_COMPRESSION: {USE_CONTEXT_COMPRESSION} is illegal! It should be 0 or 1!"
+        )
+        sys.exit(-1)
+
     # USE_DEBUG: Flag (0 or 1) indicating whether to output additional debug information, such as `search`, `reranking`, `prompt`.
     USE_DEBUG = os.getenv('USE_DEBUG')
     try:
@@ -0,0 +1,178 @@
+from queue import Empty, Queue
+from threading import Lock, Thread
+import time
+from typing import Any, Dict, Iterator, List, Optional, Union
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (LLM_HEDGE_TTFT_DEADLINE,
+                                       LLM_HEDGE_RESPONSE_DEADLINE)
+from server.logger.logger_config import my_logger as logger
+from server.rag.generation.provider_health import METRIC_PREFIX, ProviderHealth
+from server.rag.generation.provider_limiter import LimitedStream
+
+
+class Attempt:
+    """ The request of one provider within a hedged request. """
+    def __init__(self, provider: Any, health: ProviderHealth) -> None:
+        self.provider = provider
+        self.health = health
+        self.response: Any = None
+        self.iterator: Optional[Iterator[Any]] = None
+        self.first_chunks: List[Any] = []
+        self.error: Optional[Exception] = None
+        self.beg_time = time.time()
+        self.ttft = 0.0
+        self.done = False
+        self.cancelled = False
+        self.lock = Lock()
+
+    def close(self) -> None:
+        # Closing the HTTP response of a stream aborts the generation of the provider
+        http_response = getattr(self.response, 'response', None)
+        if http_response is not None:
+            try:
+                http_response.close()
+            except Exception as e:
+                logger.warning(
+                    f"[HEDGED_REQUEST] close the stream of '{self.provider.llm_name}' failed, the exception is {e}"
+                )
+        # Free the concurrency slot now, not when the abandoned stream is garbage collected
+        if isinstance(self.response, LimitedStream):
+            self.response.permit.release()
+        self.response = None
+        self.iterator = None
+        self.first_chunks = []
+
+
+class HedgedRequest:
+    """ Sends a completion request to the providers in order, hedging the slow ones.
+
+    The first provider is requested right away. If it has not produced its first token within the
+    deadline, or if it fails, the next provider is requested as well. The first attempt to produce a
+    token wins: the others are cancelled and only the stream of the winner is returned.
+    For non-streaming calls, the whole response plays the role of the first token.
+    """
+    def __init__(self, providers: List[Any], health: Dict[str, ProviderHealth],
+                 is_streaming: bool) -> None:
+        self.providers = providers
+        self.health = health
+        self.is_streaming = is_streaming
+        self.deadline = LLM_HEDGE_TTFT_DEADLINE if is_streaming else LLM_HEDGE_RESPONSE_DEADLINE
+        self.events: Queue = Queue()
+        self.attempts: List[Attempt] = []
+
+    def launch(self, prompt: Union[str, List[Dict[str, str]]], is_json: bool,
+               priority: str) -> None:
+        provider = self.providers[len(self.attempts)]
+        attempt = Attempt(provider, self.health[provider.llm_name])
+        self.attempts.append(attempt)
+        Thread(target=self.run_attempt,
+               args=(attempt, prompt, is_json, priority),
+               daemon=True).start()
+        metrics_client.incr(f"{METRIC_PREFIX}{provider.llm_name}:requests")
+
+    def run_attempt(self, attempt: Attempt,
+                    prompt: Union[str, List[Dict[str, str]]], is_json: bool,
+                    priority: str) -> None:
+        try:
+            # The wait for the limiter of the provider counts in its TTFT, a saturated provider is hedged
+            attempt.response = attempt.provider.generate(
+                prompt, self.is_streaming, is_json, priority)
+            if self.is_streaming:
+                attempt.iterator = iter(attempt.response)
+                for chunk in attempt.iterator:
+                    attempt.first_chunks.append(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        break
+            attempt.ttft = time.time() - attempt.beg_time
+        except Exception as e:
+            attempt.error = e
+
+        with attempt.lock:
+            attempt.done = True
+            if attempt.cancelled:
+                # The error of a cancelled stream is caused by closing it
+                attempt.close()
+                return
+        if attempt.error is None:
+            attempt.health.record_ttft(attempt.ttft, self.deadline)
+        else:
+            attempt.health.record_error()
+        self.events.put(attempt)
+
+    def cancel(self, attempt: Attempt) -> None:
+        with attempt.lock:
+            attempt.cancelled = True
+            if attempt.done:
+                attempt.close()
+                return
+        # The elapsed time is a lower bound of the TTFT of the provider
+        attempt.health.record_ttft(time.time() - attempt.beg_time,
+                                   self.deadline)
+        attempt.close()
+
+    def run(self, prompt: Union[str, List[Dict[str, str]]], is_json: bool,
+            priority: str) -> Any:
+        """ Returns the response of the first provider to produce a token.
+
+        Raises:
+            Exception: The error of the last provider, if all of them failed.
+        """
+        self.launch(prompt, is_json, priority)
+        pending = 1
+        last_error: Optional[Exception] = None
+        while True:
+            has_next = len(self.attempts) < len(self.providers)
+            try:
+                attempt = self.events.get(
+                    timeout=self.deadline if has_next else None)
+            except Empty:
+                logger.warning(
+                    f"[HEDGED_REQUEST] no token from '{self.attempts[-1].provider.llm_name}' within {self.deadline}s, hedge to '{self.providers[len(self.attempts)].llm_name}'"
+                )
+                metrics_client.incr(
+                    f"{METRIC_PREFIX}{self.providers[len(self.attempts)].llm_name}:hedges"
+                )
+                self.launch(prompt, is_json, priority)
+                pending += 1
+                continue
+
+            pending -= 1
+            if attempt.error is not None:
+                last_error = attempt.error
+                logger.error(
+                    f"[HEDGED_REQUEST] '{attempt.provider.llm_name}' failed, the exception is {attempt.error}"
+                )
+                if has_next:
+                    metrics_client.incr(
+                        f"{METRIC_PREFIX}{self.providers[len(self.attempts)].llm_name}:failovers"
+                    )
+                    self.launch(prompt, is_json, priority)
+                    pending += 1
+                elif pending == 0:
+                    raise last_error
+                continue
+            break
+
+        for other in self.attempts:
+            if other is not attempt:
+                self.cancel(other)
+        # The stream of the winner holds this request, don't keep the losers alive with it
+        providers = [a.provider.llm_name for a in self.attempts]
+        self.attempts = [attempt]
+        self.events = Queue()
+        metrics_client.incr(f"{METRIC_PREFIX}{attempt.provider.llm_name}:wins")
+        if len(providers) > 1:
+            logger.info(
+                f"[HEDGED_REQUEST] '{attempt.provider.llm_name}' won among {providers}, TTFT: {attempt.ttft:.2f}s"
+            )
+        if not self.is_streaming:
+            return attempt.response
+        return self.stream(attempt)
+
+    def stream(self, attempt: Attempt) -> Iterator[Any]:
+        try:
+            yield from attempt.first_chunks
+            yield from attempt.iterator
+        except Exception:
+            attempt.health.record_error()
+            raise
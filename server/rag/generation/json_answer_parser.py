@@ -0,0 +1,132 @@
+import json
+from typing import Any, Dict, List, Optional
+
+
+class JsonAnswerStreamParser:
+    """ Incrementally parses the JSON object of an answer generated in JSON mode.
+
+    The chunks of the completion are fed as they arrive, and the decoded characters of the string
+    value of `field` (e.g. "answer") are returned as soon as they are complete, so they can be forwarded
+    before the object ends. The other values are only skipped over, and the whole object is parsed by
+    `finish()` once the completion is done. Anything around the object, like the ```json fence that some
+    models (e.g. ZhipuAI) add, is ignored.
+    """
+    def __init__(self, field: str = 'answer') -> None:
+        self.field = field
+        self.text_chunks: List[str] = []
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.expect_key = False
+        self.in_string = False
+        self.string_is_key = False
+        self.string_is_field = False
+        self.escape = ''
+        self.high_surrogate = ''
+        self.key_chars: List[str] = []
+        self.last_key: Optional[str] = None
+
+    def feed(self, text: str) -> str:
+        """ Consumes the next chunk of the completion.
+
+        Args:
+            text (str): The chunk.
+
+        Returns:
+            str: The characters of the `field` value decoded from this chunk, may be empty.
+        """
+        self.text_chunks.append(text)
+        decoded: List[str] = []
+        for ch in text:
+            self.consume(ch, decoded)
+        return ''.join(decoded)
+
+    def consume(self, ch: str, decoded: List[str]) -> None:
+        if self.done:
+            return
+        if not self.started:
+            if ch == '{':
+                self.started = True
+                self.depth = 1
+                self.expect_key = True
+            return
+
+        if self.in_string:
+            if self.escape:
+                self.escape += ch
+                if self.escape[1] == 'u' and len(self.escape) < 6:
+                    return
+                try:
+                    value = json.loads(f'"{self.escape}"')
+                except ValueError:
+                    value = self.escape
+                self.escape = ''
+                self.on_string_char(value, decoded)
+            elif ch == '\\':
+                self.escape = ch
+            elif ch == '"':
+                self.on_string_end()
+            else:
+                self.on_string_char(ch, decoded)
+            return
+
+        if ch == '"':
+            self.in_string = True
+            # Only the keys and values of the top-level object matter
+            self.string_is_key = self.depth == 1 and self.expect_key
+            self.string_is_field = self.depth == 1 and not self.expect_key and self.last_key == self.field
+            self.key_chars = []
+        elif ch in '{[':
+            self.depth += 1
+        elif ch in '}]':
+            self.depth -= 1
+            if self.depth == 0:
+                self.done = True
+        elif self.depth == 1 and ch == ':':
+            self.expect_key = False
+        elif self.depth == 1 and ch == ',':
+            self.expect_key = True
+
+    def on_string_char(self, value: str, decoded: List[str]) -> None:
+        if self.string_is_key:
+            self.key_chars.append(value)
+            return
+        if not self.string_is_field:
+            return
+        # A character outside the BMP is escaped as a surrogate pair, e.g. '😀'
+        if len(value) == 1 and '\ud800' <= value <= '\udbff':
+            self.high_surrogate = value
+            return
+        if self.high_surrogate:
+            value = (self.high_surrogate + value).encode(
+                'utf-16', 'surrogatepass').decode('utf-16', 'replace')
+            self.high_surrogate = ''
+        decoded.append(value)
+
+    def on_string_end(self) -> None:
+        if self.string_is_key:
+            self.last_key = ''.join(self.key_chars)
+        self.in_string = False
+        self.string_is_key = False
+        self.string_is_field = False
+
+    def finish(self) -> Dict[str, Any]:
+        """ Parses the whole object once the completion is done.
+
+        Returns:
+            Dict[str, Any]: The parsed object.
+
+        Raises:
+            json.JSONDecodeError: If the completion doesn't contain a valid JSON object.
+        """
+        return parse_json_answer(''.join(self.text_chunks))
+
+
+def parse_json_answer(text: str) -> Dict[str, Any]:
+    """ Parses the JSON object of a complete answer, ignoring a surrounding ```json fence. """
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        # Let json report the error on the original text
+        return json.loads(text)
+    return json.loads(text[start:end + 1])
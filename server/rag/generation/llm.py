@@ -1,64 +1,141 @@
 import os
+from typing import Dict, List, Union
 from openai import OpenAI
 from zhipuai import ZhipuAI
+from server.app.utils.lazy_singleton import LazySingleton
+from server.constant.constants import LLM_LIMITER_COMPLETION_TOKENS
 from server.logger.logger_config import my_logger as logger
+from server.rag.generation.hedged_request import HedgedRequest
+from server.rag.generation.llm_http_client import HttpProfile, create_http_client
+from server.rag.generation.provider_health import ProviderHealth
+from server.rag.generation.provider_limiter import (LimitedStream,
+                                                    ProviderLimiter,
+                                                    estimate_tokens,
+                                                    provider_limiter_registry)
 
 
-class LLMGenerator:
-    def __init__(self) -> None:
-        self.llm_name = os.getenv('LLM_NAME')
+class LLMProvider:
+    def __init__(self, llm_name: str) -> None:
+        self.llm_name = llm_name
+        if self.llm_name not in [
+                'OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot'
+        ]:
+            raise ValueError(
+                f"Unsupported LLM_NAME: '{self.llm_name}'. Must be in['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot']"
+            )
+        # One pooled HTTP client per process, shared by the request threads
+        self.http_profile = HttpProfile.for_provider(self.llm_name)
+        self.http_client = create_http_client(self.llm_name,
+                                              self.http_profile)
+        transport_kwargs = {
+            "http_client": self.http_client,
+            "timeout": self.http_profile.get_timeout(),
+            "max_retries": self.http_profile.max_retries
+        }
+
         if self.llm_name == 'OpenAI':
             api_key = os.getenv('OPENAI_API_KEY')
-            self.client = OpenAI(api_key=api_key)
+            self.client = OpenAI(api_key=api_key, **transport_kwargs)
             self.model_name = os.getenv('GPT_MODEL_NAME')
         elif self.llm_name == 'ZhipuAI':
             api_key = os.getenv('ZHIPUAI_API_KEY')
-            self.client = ZhipuAI(api_key=api_key)
+            self.client = ZhipuAI(api_key=api_key, **transport_kwargs)
             self.model_name = os.getenv('GLM_MODEL_NAME')
         elif self.llm_name == 'Ollama':
             ollama_base_url = os.getenv('OLLAMA_BASE_URL')
             self.client = OpenAI(
                 base_url=f"{ollama_base_url}/v1",
                 api_key='ollama',  # required, but unused
-            )
+                **transport_kwargs)
             self.model_name = os.getenv('OLLAMA_MODEL_NAME')
         elif self.llm_name == 'DeepSeek':
             api_key = os.getenv('DEEPSEEK_API_KEY')
             self.client = OpenAI(api_key=api_key,
-                                 base_url="https://api.deepseek.com/v1")
+                                 base_url="https://api.deepseek.com/v1",
+                                 **transport_kwargs)
             self.model_name = os.getenv('DEEPSEEK_MODEL_NAME')
         elif self.llm_name == 'Moonshot':
             api_key = os.getenv('MOONSHOT_API_KEY')
             self.client = OpenAI(api_key=api_key,
-                                 base_url="https://api.moonshot.cn/v1")
+                                 base_url="https://api.moonshot.cn/v1",
+                                 **transport_kwargs)
             self.model_name = os.getenv('MOONSHOT_MODEL_NAME')
-        else:
-            raise ValueError(
-                f"Unsupported LLM_NAME: '{self.llm_name}'. Must be in['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot']"
-            )
+
+    @property
+    def limiter(self) -> ProviderLimiter:
+        # Looked up on each call: the registry is reset in a forked worker, and the limiters of the master
+        # may have been copied with their locks held
+        return provider_limiter_registry.get(self.llm_name, self.model_name)
 
     def generate(self,
-                 prompt: str,
+                 prompt: Union[str, List[Dict[str, str]]],
                  is_streaming: bool = False,
-                 is_json: bool = False):
+                 is_json: bool = False,
+                 priority: str = 'answer'):
+        """ Creates a chat completion, within the rate limits of the provider.
+
+        Args:
+            prompt (Union[str, List[Dict[str, str]]]): A single user message, or the chat messages.
+            is_streaming (bool): Whether the response is streamed in chunks.
+            is_json (bool): Whether the response is a JSON object, only supported by the OpenAI compatible APIs.
+            priority (str): The priority class of the call, 'refine' or 'answer'.
+
+        Raises:
+            ProviderBusyError: If the provider is saturated or rate limited.
+        """
+        if isinstance(prompt, str):
+            messages = [{"role": "user", "content": prompt}]
+        else:
+            messages = prompt
+        tokens = sum(estimate_tokens(message["content"])
+                     for message in messages) + LLM_LIMITER_COMPLETION_TOKENS
+        limiter = self.limiter
+        permit = limiter.acquire(priority, tokens)
+        try:
+            response = self.create_completion(messages, is_streaming, is_json)
+        except Exception as e:
+            permit.release()
+            error = limiter.check_rate_limited(e)
+            if error is e:
+                raise
+            raise error from e
+        if is_streaming:
+            # The call runs until the end of the stream
+            return LimitedStream(response, permit)
+        usage = getattr(response, 'usage', None)
+        permit.release(getattr(usage, 'total_tokens', None))
+        return response
+
+    def create_completion(self, messages: List[Dict[str, str]],
+                          is_streaming: bool, is_json: bool):
         if is_streaming:
             if self.llm_name in ['OpenAI', 'Ollama', 'DeepSeek', 'Moonshot']:
-                response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[{
-                        "role": "user",
-                        "content": prompt
-                    }],
-                    temperature=0,
-                    # top_p=0.7,
-                    stream=True)
+                extra_body = None
+                if self.llm_name in ['OpenAI', 'DeepSeek']:
+                    # Report the token usage in an extra last chunk without choices
+                    extra_body = {"stream_options": {"include_usage": True}}
+                if is_json:
+                    # The JSON object is parsed incrementally by `JsonAnswerStreamParser`
+                    response = self.client.chat.completions.create(
+                        model=self.model_name,
+                        response_format={"type": "json_object"},
+                        messages=messages,
+                        temperature=0,
+                        # top_p=0.7,
+                        stream=True,
+                        extra_body=extra_body)
+                else:
+                    response = self.client.chat.completions.create(
+                        model=self.model_name,
+                        messages=messages,
+                        temperature=0,
+                        # top_p=0.7,
+                        stream=True,
+                        extra_body=extra_body)
             elif self.llm_name == 'ZhipuAI':
                 response = self.client.chat.completions.create(
                     model=self.model_name,
-                    messages=[{
-                        "role": "user",
-                        "content": prompt
-                    }],
+                    messages=messages,
                     temperature=0.1,
                     # top_p=0.7,
                     stream=True)
@@ -69,34 +146,78 @@ class LLMGenerator:
                     response = self.client.chat.completions.create(
                         model=self.model_name,
                         response_format={"type": "json_object"},
-                        messages=[{
-                            "role": "user",
-                            "content": prompt
-                        }],
+                        messages=messages,
                         temperature=0,
                         # top_p=0.7,
                         stream=False)
                 else:
                     response = self.client.chat.completions.create(
                         model=self.model_name,
-                        messages=[{
-                            "role": "user",
-                            "content": prompt
-                        }],
+                        messages=messages,
                         temperature=0,
                         # top_p=0.7,
                         stream=False)
             elif self.llm_name == 'ZhipuAI':
                 response = self.client.chat.completions.create(
                     model=self.model_name,
-                    messages=[{
-                        "role": "user",
-                        "content": prompt
-                    }],
+                    messages=messages,
                     temperature=0.1,
                     # top_p=0.7,
                     stream=False)
             return response
 
 
-llm_generator = LLMGenerator()
+class LLMGenerator:
+    """ Generates completions with `LLM_NAME`, hedged with the providers in `LLM_FALLBACK_NAMES` if any.
+
+    The providers are tried in the configured order, except that the demoted ones (see `ProviderHealth`)
+    are moved behind the healthy ones.
+    """
+    def __init__(self) -> None:
+        llm_names = list(
+            dict.fromkeys([os.getenv('LLM_NAME')] + [
+                name.strip()
+                for name in os.getenv('LLM_FALLBACK_NAMES', '').split(',')
+                if name.strip()
+            ]))
+        self.providers: List[LLMProvider] = [
+            LLMProvider(llm_name) for llm_name in llm_names
+        ]
+        self.health: Dict[str, ProviderHealth] = {
+            llm_name: ProviderHealth(llm_name)
+            for llm_name in llm_names
+        }
+        primary = self.providers[0]
+        self.llm_name = primary.llm_name
+        self.client = primary.client
+        self.model_name = primary.model_name
+        if len(self.providers) > 1:
+            logger.info(f"[LLM_GENERATOR] providers in order: {llm_names}")
+
+    def get_ordered_providers(self) -> List[LLMProvider]:
+        # `sorted` is stable, the configured order is kept among healthy and among demoted providers
+        return sorted(
+            self.providers,
+            key=lambda provider: self.health[provider.llm_name].is_demoted())
+
+    def generate(self,
+                 prompt: Union[str, List[Dict[str, str]]],
+                 is_streaming: bool = False,
+                 is_json: bool = False,
+                 priority: str = 'answer'):
+        if len(self.providers) == 1:
+            return self.providers[0].generate(prompt, is_streaming, is_json,
+                                              priority)
+        hedged_request = HedgedRequest(self.get_ordered_providers(),
+                                       self.health, is_streaming)
+        return hedged_request.run(prompt, is_json, priority)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            llm_name: health.get_stats()
+            for llm_name, health in self.health.items()
+        }
+
+
+# The API client is created on first use in each process, pooled connections are never shared across a fork
+llm_generator = LazySingleton('llm_generator', LLMGenerator)
@@ -0,0 +1,159 @@
+import importlib.util
+import time
+from typing import Any, Dict, Optional
+import httpx
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (
+    LLM_HTTP_MAX_CONNECTIONS, LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_HTTP_KEEPALIVE_EXPIRY, LLM_HTTP_CONNECT_TIMEOUT, LLM_HTTP_READ_TIMEOUT,
+    LLM_HTTP_WRITE_TIMEOUT, LLM_HTTP_POOL_TIMEOUT, LLM_HTTP_MAX_RETRIES,
+    LLM_HTTP2, LLM_HTTP_PROVIDER_SETTINGS)
+from server.logger.logger_config import my_logger as logger
+
+METRIC_PREFIX = "llm_http:"
+
+
+class HttpProfile:
+    """ The HTTP transport settings of the API client of an LLM provider.
+
+    Attributes:
+        max_connections (int): Maximum number of connections in the pool, shared by the request threads.
+        max_keepalive_connections (int): Maximum number of idle connections kept for reuse.
+        keepalive_expiry (float): Seconds an idle connection is kept for reuse.
+        connect_timeout (float): Seconds to establish a connection, including the TLS handshake.
+        read_timeout (float): Seconds to wait for the next chunk of the response.
+        write_timeout (float): Seconds to send a chunk of the request.
+        pool_timeout (float): Seconds to wait for a free connection when the pool is exhausted.
+        max_retries (int): Retries of the SDK on connection errors, 429 and 5xx responses.
+        http2 (bool): Whether HTTP/2 is negotiated, only if the 'h2' package is installed.
+    """
+    def __init__(self,
+                 max_connections: int = LLM_HTTP_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = LLM_HTTP_KEEPALIVE_EXPIRY,
+                 connect_timeout: float = LLM_HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = LLM_HTTP_READ_TIMEOUT,
+                 write_timeout: float = LLM_HTTP_WRITE_TIMEOUT,
+                 pool_timeout: float = LLM_HTTP_POOL_TIMEOUT,
+                 max_retries: int = LLM_HTTP_MAX_RETRIES,
+                 http2: bool = LLM_HTTP2):
+        if http2 and importlib.util.find_spec('h2') is None:
+            logger.warning(
+                "[LLM_HTTP] HTTP/2 is disabled, the 'h2' package is not installed"
+            )
+            http2 = False
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+        self.max_retries = max_retries
+        self.http2 = http2
+
+    @classmethod
+    def for_provider(cls, llm_name: str) -> 'HttpProfile':
+        """Returns the default settings, overridden by `LLM_HTTP_PROVIDER_SETTINGS[llm_name]`."""
+        return cls(**LLM_HTTP_PROVIDER_SETTINGS.get(llm_name, {}))
+
+    def get_timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(connect=self.connect_timeout,
+                             read=self.read_timeout,
+                             write=self.write_timeout,
+                             pool=self.pool_timeout)
+
+    def __repr__(self) -> str:
+        return f"HttpProfile({', '.join(f'{k}={v!r}' for k, v in vars(self).items())})"
+
+
+class ConnectionTracer:
+    """ Counts whether each request of a provider opened a new connection or reused a pooled one.
+
+    It hooks the 'trace' extension of httpcore, which reports the connect and TLS handshake events
+    of the request. A request without a connect event was sent on a kept-alive connection.
+    """
+    def __init__(self, llm_name: str) -> None:
+        self.prefix = f"{METRIC_PREFIX}{llm_name}:"
+
+    def on_request(self, request: httpx.Request) -> None:
+        state: Dict[str, Any] = {"connect_start": None}
+        parent_trace = request.extensions.get("trace")
+
+        def trace(event_name: str, info: Dict[str, Any]) -> None:
+            if event_name == "connection.connect_tcp.started":
+                state["connect_start"] = time.perf_counter()
+            elif event_name == "connection.start_tls.complete":
+                metrics_client.incr(f"{self.prefix}tls_handshakes")
+            elif event_name in ("http11.send_request_headers.started",
+                                "http2.send_request_headers.started"):
+                self.record_connection(state)
+            if parent_trace is not None:
+                parent_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+
+    def record_connection(self, state: Dict[str, Any]) -> None:
+        connect_start: Optional[float] = state["connect_start"]
+        metrics_client.incr(f"{self.prefix}requests")
+        if connect_start is None:
+            metrics_client.incr(f"{self.prefix}reused_connections")
+        else:
+            metrics_client.incr(f"{self.prefix}new_connections")
+            metrics_client.incr(
+                f"{self.prefix}connect_ms",
+                int((time.perf_counter() - connect_start) * 1000))
+
+    def on_response(self, response: httpx.Response) -> None:
+        if response.status_code >= 400:
+            metrics_client.incr(f"{self.prefix}error_responses")
+
+
+def create_http_client(llm_name: str, profile: HttpProfile) -> httpx.Client:
+    """ Creates the pooled HTTP client of a provider.
+
+    An `httpx.Client` is thread safe, so one client per process is shared by the request threads
+    and keeps warm connections across the refine and answer calls. It must not be shared across
+    processes: the sockets of the parent are dropped after a fork (see `LazySingleton`).
+
+    Args:
+        llm_name (str): The LLM provider, used to label the metrics.
+        profile (HttpProfile): The transport settings.
+
+    Returns:
+        httpx.Client: The client to pass as `http_client` to the SDK.
+    """
+    tracer = ConnectionTracer(llm_name)
+    limits = httpx.Limits(
+        max_connections=profile.max_connections,
+        max_keepalive_connections=profile.max_keepalive_connections,
+        keepalive_expiry=profile.keepalive_expiry)
+    logger.info(f"[LLM_HTTP] create client for '{llm_name}', profile: {profile}")
+    return httpx.Client(limits=limits,
+                        timeout=profile.get_timeout(),
+                        http2=profile.http2,
+                        follow_redirects=True,
+                        event_hooks={
+                            "request": [tracer.on_request],
+                            "response": [tracer.on_response]
+                        })
+
+
+def get_connection_stats() -> Dict[str, Dict[str, float]]:
+    """ Aggregates the connection counters of each provider.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The counters and the reuse rate, keyed by provider.
+    """
+    stats: Dict[str, Dict[str, float]] = {}
+    for name, value in metrics_client.get_all(METRIC_PREFIX).items():
+        llm_name, counter = name[len(METRIC_PREFIX):].split(':', 1)
+        stats.setdefault(llm_name, {})[counter] = value
+    for provider_stats in stats.values():
+        requests = provider_stats.get("requests", 0)
+        new_connections = provider_stats.get("new_connections", 0)
+        provider_stats["reuse_rate"] = provider_stats.get(
+            "reused_connections", 0) / requests if requests else 0.0
+        provider_stats["avg_connect_ms"] = provider_stats.get(
+            "connect_ms", 0) / new_connections if new_connections else 0.0
+    return stats
@@ -0,0 +1,165 @@
+from threading import Lock
+from typing import Any, Callable, Dict, List, Tuple
+from server.constant.constants import RECALL_TOP_K
+
+
+def build_answer_system_prompt(bot_topic: str, lang: str,
+                               is_streaming: bool) -> str:
+    if not is_streaming:
+        answer_format_prompt = f'''**Expected Response Format:**
+The response should be a JSON object, with 'answer' and 'source' fields.
+- "answer": "A detailed and specific answer, crafted in the question's language and fully formatted using **Markdown** syntax. **Don't repeat the question**". Only cite the most relevant Documents that answer the question accurately.
+- "source": ["List only unique `Citation URL` from the context that are directly related to the answer. Ensure that each URL is listed only once. If no documents are referenced, or the documents are not relevant, use an empty list []. The number of `Citation URL` should not exceed {RECALL_TOP_K}. The generated answer must have indeed used content from the document corresponding to the `Citation URL` before including that URL in the `source`; otherwise, the URL should not be included in the `source`."]'''
+    else:
+        answer_format_prompt = f'''**Expected Response Format:**
+The response should be fully formatted using **Mardown** syntax (Note: Don't start with 'Answer:' or 'answer:'). First output the answer. Then output the Sources.
+- A detailed and specific answer, crafted in the question's language. Don't repeat the question. Only cite the most relevant Documents that answer the question accurately.
+- Sources: "List only unique `Citation URL` from the context that are directly related to the answer. Ensure that each URL is listed only once. If no documents are referenced, or the documents are not relevant, return ''. The number of `Citation URL` should not exceed {RECALL_TOP_K}. The generated answer must have indeed used content from the document corresponding to the `Citation URL` before including that URL in the `Sources`; otherwise, the URL should not be included in the `Sources`."'''
+
+    return f"""You are a smart customer service assistant and problem-solver, tasked to answer any question about `{bot_topic}`. Using the provided context, answer the user's question to the best of your ability using the resources provided.
+
+If the user's question is a straightforward greeting, the assistant will offer a friendly standard response, guiding users to seek information or services related to `{bot_topic}`.
+
+Base on the Chat History and the provided context. First, analyze the provided context information without assuming prior knowledge. Identify all relevant aspects of knowledge contained within. Then, from various perspectives and angles, answer questions as thoroughly and comprehensively as possible to better address and resolve the user's question. If the question is not related to the provided context, the user is informed that no relevant answer can be provided.
+
+The user's message contains the **Question** and the **Context for Answering the Question**.
+
+**Response Requirements:**
+- Don't repeat the question at the beginning.
+- If unsure about the answer, proactively seek clarification.
+- Ensure that answers are strictly based on the provided context.
+- Inform users that questions unrelated to the provided context cannot be answered.
+- Format the answer using Markdown syntax for clarity and readability.
+- Respond in the language of the original question; for instance, reply in Chinese if the question was asked in Chinese and in English if it was asked in English!
+
+**REMEMBER:** Please do not fabricate any knowledge. If you cannot get knowledge from the provided context, please directly state that you do not know, rather than constructing nonexistent and potentially fake information!!!
+
+**NOTE:** The detected language of the question is '{lang}'. Please respond in '{lang}'.
+
+{answer_format_prompt}
+
+Please format answer as follows:
+The answer must be fully formatted using Markdown syntax. This includes:
+- **Bold** (`**bold**`) and *italic* (`*italic*`) text for emphasis.
+- Unordered lists (`- item`) for itemization and ordered lists (`1. item`) for sequencing.
+- `Inline code` (`` `Inline code` ``) for brief code snippets and (` ``` `) for longer examples, specifying the programming language for syntax highlighting when possible.
+- [Hyperlinks](URL) (`[Hyperlinks](URL)`) to reference external sources.
+- Headings (`# Heading 1`, `## Heading 2`, ...) to structure the answer effectively.
+"""
+
+
+def build_refine_query_system_prompt(lang: str) -> str:
+    return f"""Given a conversation (between Human and Assistant) and a follow up message from Human, using the prior knowledge relationships, rewrite the message to be a standalone and detailed question that captures all relevant context from the conversation. Ensure the rewritten question:
+1. Preserves the original intent of the follow-up message.
+2. If the true intent of the follow-up message cannot be determined, make no modifications to avoid generating an incorrect question.
+3. The length of the rewritten question should not increase significantly compared to the follow-up message, to avoid altering the original intent.
+4. Do not directly use the content of the Assistant's responses to form the rewritten question. Prioritize referring to the information of the Human's historical question.
+5. Maintains the same language as the follow-up message (e.g., reply in Chinese if the question was asked in Chinese and in English if it was asked in English).
+
+The user's message contains the Chat History and the Follow Up Input. Only output the Refined Standalone Question.
+
+**NOTE:** The detected language of the Input is '{lang}'. Please respond in '{lang}'."""
+
+
+def build_chitchat_system_prompt(bot_topic: str, lang: str,
+                                 is_streaming: bool) -> str:
+    if not is_streaming:
+        answer_format_prompt = '''**Expected Response Format:**
+The response should be a JSON object, with 'answer' and 'source' fields.
+- "answer": "The reply, formatted using **Markdown** syntax."
+- "source": []'''
+    else:
+        answer_format_prompt = "**Expected Response Format:** Only output the reply, formatted using **Markdown** syntax."
+
+    return f"""You are a friendly customer service assistant for `{bot_topic}`. The user's message is small talk, not a question about `{bot_topic}`.
+
+Reply briefly and politely in one or two sentences, then invite the user to ask questions about `{bot_topic}`. Don't make up any information about `{bot_topic}`.
+
+**NOTE:** The detected language of the message is '{lang}'. Please respond in '{lang}'.
+
+{answer_format_prompt}"""
+
+
+def build_query_expansion_system_prompt(lang: str, max_paraphrases: int,
+                                        max_hypothetical_answers: int) -> str:
+    return f"""Given a question from a user, generate alternative texts that help to search a knowledge base for the documents answering it:
+1. "paraphrases": up to {max_paraphrases} rewrites of the question, using different words, synonyms or a more specific phrasing. Each one must keep the original intent.
+2. "hypothetical_answers": up to {max_hypothetical_answers} short passages of two or three sentences, written like the documentation that would answer the question. They are only used for the search, so plausible wording matters more than accuracy.
+
+Maintain the same language as the question (e.g., write in Chinese if the question was asked in Chinese and in English if it was asked in English).
+
+**Expected Response Format:**
+The response should be a JSON object, with "paraphrases" and "hypothetical_answers" fields, both lists of strings.
+
+**NOTE:** The detected language of the question is '{lang}'. Please respond in '{lang}'."""
+
+
+def build_query_construction_system_prompt() -> str:
+    return """Given a question from a user, extract the constraints on the documents that should answer it. The user's message lists the Domains, Sections and File Types of the knowledge base, then the Question.
+
+Only set a constraint when the question explicitly restricts where the answer should come from, e.g. "in the SDK docs", "according to the pdf" or "what's new in the latest release". Only use values from the lists.
+
+**Expected Response Format:**
+The response should be a JSON object, with the following fields:
+- "domain": One of the Domains, or null.
+- "section": One of the Sections, or null.
+- "file_type": One of the File Types, or null.
+- "latest": true if the question asks for the latest or most recent information, otherwise false."""
+
+
+class PromptTemplateRegistry:
+    """ Builds the static system prompts, and keeps each one so that it is byte-identical across requests.
+
+    Providers such as OpenAI and DeepSeek cache the processed prefix of a prompt. The system prompt holds
+    everything that depends only on its parameters (e.g. the bot topic, the language and the streaming mode),
+    and the per-request question, history and documents come after it in the user message, so consecutive
+    requests share the longest possible prefix.
+    """
+    def __init__(self) -> None:
+        self.builders: Dict[str, Callable[..., str]] = {}
+        self.system_prompts: Dict[Tuple[Any, ...], str] = {}
+        self.lock = Lock()
+
+    def register(self, name: str, builder: Callable[..., str]) -> None:
+        self.builders[name] = builder
+
+    def get_system_prompt(self, name: str, **params: Any) -> str:
+        key = (name, ) + tuple(sorted(params.items()))
+        system_prompt = self.system_prompts.get(key)
+        if system_prompt is None:
+            with self.lock:
+                system_prompt = self.system_prompts.setdefault(
+                    key, self.builders[name](**params))
+        return system_prompt
+
+    def build_messages(self, name: str, user_prompt: str,
+                       **params: Any) -> List[Dict[str, str]]:
+        """ Returns the chat messages: the static system prompt of the template, then the dynamic user prompt.
+
+        Args:
+            name (str): The registered template name.
+            user_prompt (str): The per-request part of the prompt.
+            **params (Any): The parameters of the system prompt.
+
+        Returns:
+            List[Dict[str, str]]: The 'system' and 'user' messages.
+        """
+        return [{
+            "role": "system",
+            "content": self.get_system_prompt(name, **params)
+        }, {
+            "role": "user",
+            "content": user_prompt
+        }]
+
+
+# Initialize the prompt template registry
+prompt_template_registry = PromptTemplateRegistry()
+prompt_template_registry.register('answer', build_answer_system_prompt)
+prompt_template_registry.register('refine_query',
+                                  build_refine_query_system_prompt)
+prompt_template_registry.register('chitchat', build_chitchat_system_prompt)
+prompt_template_registry.register('query_expansion',
+                                  build_query_expansion_system_prompt)
+prompt_template_registry.register('query_construction',
+                                  build_query_construction_system_prompt)
@@ -0,0 +1,70 @@
+from threading import Lock
+import time
+from typing import Dict, Optional
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (LLM_PROVIDER_HEALTH_ALPHA,
+                                       LLM_PROVIDER_MAX_ERROR_RATE,
+                                       LLM_PROVIDER_DEMOTION_TIME)
+from server.logger.logger_config import my_logger as logger
+
+METRIC_PREFIX = "llm_provider:"
+
+
+class ProviderHealth:
+    """ Moving averages of the time to first token (TTFT) and the error rate of an LLM provider.
+
+    The averages are kept per process, the counters are also added to `metrics_client`.
+    A provider that errors too often, or is slower than the hedge deadline, is demoted for
+    `demotion_time` seconds; after that it gets traffic again, and is demoted again if it is still unhealthy.
+    """
+    def __init__(self,
+                 llm_name: str,
+                 alpha: float = LLM_PROVIDER_HEALTH_ALPHA,
+                 max_error_rate: float = LLM_PROVIDER_MAX_ERROR_RATE,
+                 demotion_time: float = LLM_PROVIDER_DEMOTION_TIME) -> None:
+        self.llm_name = llm_name
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.demotion_time = demotion_time
+        self.avg_ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.demoted_until = 0.0
+        self.lock = Lock()
+
+    def record_ttft(self, ttft: float, ttft_deadline: float) -> None:
+        """Records the seconds to the first token, or a lower bound of it if the request was cancelled."""
+        with self.lock:
+            if self.avg_ttft is None:
+                self.avg_ttft = ttft
+            else:
+                self.avg_ttft += self.alpha * (ttft - self.avg_ttft)
+            self.error_rate -= self.alpha * self.error_rate
+            if self.avg_ttft > ttft_deadline:
+                self.demote(f"average TTFT {self.avg_ttft:.2f}s")
+        metrics_client.incr(f"{METRIC_PREFIX}{self.llm_name}:ttft_ms",
+                            int(ttft * 1000))
+        metrics_client.incr(f"{METRIC_PREFIX}{self.llm_name}:ttft_samples")
+
+    def record_error(self) -> None:
+        with self.lock:
+            self.error_rate += self.alpha * (1 - self.error_rate)
+            if self.error_rate > self.max_error_rate:
+                self.demote(f"error rate {self.error_rate:.2f}")
+        metrics_client.incr(f"{METRIC_PREFIX}{self.llm_name}:errors")
+
+    def demote(self, reason: str) -> None:
+        if not self.is_demoted():
+            logger.warning(
+                f"[PROVIDER_HEALTH] demote '{self.llm_name}' for {self.demotion_time}s, {reason}"
+            )
+        self.demoted_until = time.time() + self.demotion_time
+
+    def is_demoted(self) -> bool:
+        return time.time() < self.demoted_until
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "avg_ttft": self.avg_ttft or 0.0,
+            "error_rate": self.error_rate,
+            "demoted": self.is_demoted()
+        }
@@ -0,0 +1,343 @@
+from email.utils import parsedate_to_datetime
+import heapq
+import itertools
+import os
+from threading import Condition, Lock
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (LLM_RATE_LIMITS,
+                                       LLM_RATE_LIMIT_DEFAULT,
+                                       LLM_LIMITER_MAX_QUEUE,
+                                       LLM_LIMITER_MAX_WAIT,
+                                       LLM_LIMITER_RESERVED_SHARE,
+                                       LLM_LIMITER_DEFAULT_RETRY_AFTER)
+from server.logger.logger_config import my_logger as logger
+
+METRIC_PREFIX = "llm_limiter:"
+
+# Lower values are served first, ingestion is the bulk class restricted to the unreserved capacity
+PRIORITY_CLASSES = {
+    'query_embedding': 0,
+    'refine': 1,
+    'answer': 2,
+    'ingestion': 3
+}
+BULK_PRIORITY = 'ingestion'
+
+
+class ProviderBusyError(Exception):
+    """ The call was not sent because the provider is saturated or rate limited, it can be retried later. """
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text: str) -> int:
+    # About 4 characters per token for ASCII text, and 1 token per character for CJK and other scripts
+    ascii_count = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_count + 3) // 4 + len(text) - ascii_count
+
+
+def get_retry_after(e: Exception) -> Optional[float]:
+    """Returns the seconds to wait if `e` is a 429 response of the provider, otherwise None."""
+    response = getattr(e, 'response', None)
+    status_code = getattr(e, 'status_code', None) or getattr(
+        response, 'status_code', None)
+    if status_code != 429:
+        return None
+    headers = getattr(response, 'headers', None) or {}
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            # An HTTP date
+            return max(
+                0.0,
+                parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return LLM_LIMITER_DEFAULT_RETRY_AFTER
+
+
+class TokenBucket:
+    """ Refills `rate_per_minute` units per minute, up to one minute worth of units. """
+    def __init__(self, rate_per_minute: float) -> None:
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity,
+                         self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait(self, amount: float, reserve: float, now: float) -> float:
+        """Returns the seconds until `amount` units can be taken while keeping `reserve` units in the bucket."""
+        self.refill(now)
+        needed = min(amount + reserve, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        # The level may go below 0 for a call larger than the bucket, the debt delays the next calls
+        self.level -= amount
+
+
+class Permit:
+    """ The right to send one call, released when the call ends. """
+    def __init__(self, limiter: 'ProviderLimiter', tokens: int) -> None:
+        self.limiter = limiter
+        self.tokens = tokens
+        self.released = False
+        # A hedged request may release the permit of a losing stream while its thread is still reading it
+        self.lock = Lock()
+
+    def release(self, used_tokens: Optional[int] = None) -> None:
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.limiter.release(self, used_tokens)
+
+    def __enter__(self) -> 'Permit':
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.release()
+
+
+class ProviderLimiter:
+    """ Limits the calls of this process to one provider and model.
+
+    A call waits until it is at the head of the queue, a concurrency slot is free and the request and token
+    buckets can pay for it. The queue is ordered by priority class, then by arrival, and it is bounded:
+    a call is rejected with `ProviderBusyError` when the queue is full or when it can't start within
+    the maximum wait of its class. The bulk class may only use the capacity left after `reserved_share`
+    of the concurrency slots and buckets, so that live chat is never starved by ingestion.
+    After a 429 response, no call is sent until its Retry-After has elapsed.
+    """
+    def __init__(self,
+                 name: str,
+                 rpm: int = 0,
+                 tpm: int = 0,
+                 max_concurrency: int = 16,
+                 max_queue: int = LLM_LIMITER_MAX_QUEUE,
+                 reserved_share: float = LLM_LIMITER_RESERVED_SHARE) -> None:
+        self.name = name
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.bulk_max_concurrency = max(
+            1, int(max_concurrency * (1 - reserved_share)))
+        self.max_queue = max_queue
+        self.reserved_share = reserved_share
+        self.in_flight = 0
+        self.waiters: List[Tuple[int, int]] = []
+        self.sequence = itertools.count()
+        self.cooldown_until = 0.0
+        self.condition = Condition()
+
+    def get_wait(self, priority_class: str, tokens: int,
+                 now: float) -> Optional[float]:
+        """Returns the seconds until the call can start, None if it waits for a running call to end."""
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        is_bulk = priority_class == BULK_PRIORITY
+        if self.in_flight >= (self.bulk_max_concurrency
+                              if is_bulk else self.max_concurrency):
+            return None
+        wait = 0.0
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket,
+                                                          tokens)):
+            if bucket is not None:
+                reserve = bucket.capacity * self.reserved_share if is_bulk else 0.0
+                wait = max(wait, bucket.get_wait(amount, reserve, now))
+        return wait
+
+    def acquire(self, priority_class: str, tokens: int = 0) -> Permit:
+        """ Waits for the right to send a call.
+
+        Args:
+            priority_class (str): One of `PRIORITY_CLASSES`.
+            tokens (int): The estimated tokens of the call.
+
+        Returns:
+            Permit: To be released when the call ends.
+
+        Raises:
+            ProviderBusyError: If the queue is full, or the call can't start within the maximum wait of its class.
+        """
+        beg_time = time.monotonic()
+        deadline = beg_time + LLM_LIMITER_MAX_WAIT[priority_class]
+        with self.condition:
+            if len(self.waiters) >= self.max_queue:
+                metrics_client.incr(f"{METRIC_PREFIX}{self.name}:rejected")
+                raise ProviderBusyError(
+                    f"'{self.name}' has {len(self.waiters)} calls waiting",
+                    self.get_retry_hint(beg_time))
+            entry = (PRIORITY_CLASSES[priority_class], next(self.sequence))
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self.get_wait(
+                        priority_class, tokens,
+                        now) if self.waiters[0] == entry else None
+                    if wait == 0.0:
+                        break
+                    if now >= deadline:
+                        metrics_client.incr(
+                            f"{METRIC_PREFIX}{self.name}:timeouts")
+                        raise ProviderBusyError(
+                            f"'{self.name}' is saturated, the '{priority_class}' call waited {now - beg_time:.1f}s",
+                            self.get_retry_hint(now))
+                    # Woken up by a released call or a change of the head, or when the buckets are refilled
+                    self.condition.wait(deadline - now if wait is None else min(
+                        wait, deadline - now))
+                self.in_flight += 1
+                if self.request_bucket is not None:
+                    self.request_bucket.take(1)
+                if self.token_bucket is not None:
+                    self.token_bucket.take(tokens)
+            finally:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+
+        wait_ms = int((time.monotonic() - beg_time) * 1000)
+        metrics_client.incr(f"{METRIC_PREFIX}{self.name}:{priority_class}.calls")
+        if wait_ms:
+            metrics_client.incr(
+                f"{METRIC_PREFIX}{self.name}:{priority_class}.wait_ms", wait_ms)
+        return Permit(self, tokens)
+
+    def release(self, permit: Permit, used_tokens: Optional[int]) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            if self.token_bucket is not None and used_tokens is not None:
+                # Settle the estimate with the actual usage
+                self.token_bucket.take(used_tokens - permit.tokens)
+            self.condition.notify_all()
+
+    def get_retry_hint(self, now: float) -> float:
+        return max(self.cooldown_until - now, 1.0)
+
+    def on_rate_limited(self, retry_after: float) -> None:
+        with self.condition:
+            self.cooldown_until = max(self.cooldown_until,
+                                      time.monotonic() + retry_after)
+        logger.warning(
+            f"[PROVIDER_LIMITER] '{self.name}' is rate limited, pause the calls for {retry_after:.1f}s"
+        )
+        metrics_client.incr(f"{METRIC_PREFIX}{self.name}:rate_limited")
+
+    def check_rate_limited(self, e: Exception) -> Exception:
+        """ Converts a 429 error of the provider into `ProviderBusyError`, and backs off. Other errors are returned as is. """
+        retry_after = get_retry_after(e)
+        if retry_after is None:
+            return e
+        self.on_rate_limited(retry_after)
+        return ProviderBusyError(f"'{self.name}' is rate limited: {e}",
+                                 retry_after)
+
+
+class LimitedStream:
+    """ Wraps a streamed completion to hold its permit until the stream ends. """
+    def __init__(self, stream: Any, permit: Permit) -> None:
+        self.stream = stream
+        self.permit = permit
+
+    def __iter__(self) -> Iterator[Any]:
+        used_tokens = None
+        try:
+            for chunk in self.stream:
+                usage = getattr(chunk, 'usage', None)
+                if usage:
+                    used_tokens = getattr(usage, 'total_tokens', None)
+                yield chunk
+        except Exception as e:
+            error = self.permit.limiter.check_rate_limited(e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            self.permit.release(used_tokens)
+
+    def __getattr__(self, name: str) -> Any:
+        # e.g. `response`, used to abort the stream
+        return getattr(self.stream, name)
+
+    def __del__(self) -> None:
+        # The stream may be abandoned without being exhausted, e.g. the loser of a hedged request
+        self.permit.release()
+
+
+class ProviderLimiterRegistry:
+    """ The limiters of this process, keyed by provider and model, with the limits of `LLM_RATE_LIMITS`.
+
+    The limits apply per process, the limits of the account of the provider should be divided by the
+    number of worker processes.
+    """
+    def __init__(self) -> None:
+        self.limiters: Dict[str, ProviderLimiter] = {}
+        self.lock = Lock()
+        os.register_at_fork(after_in_child=self.reinit_after_fork)
+
+    def reinit_after_fork(self) -> None:
+        # The waiters and calls of the parent don't exist in the child
+        self.limiters = {}
+        self.lock = Lock()
+
+    def get(self, llm_name: str, model_name: str) -> ProviderLimiter:
+        name = f"{llm_name}/{model_name}"
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            with self.lock:
+                limiter = self.limiters.get(name)
+                if limiter is None:
+                    provider_limits = LLM_RATE_LIMITS.get(llm_name, {})
+                    limits = provider_limits.get(
+                        model_name,
+                        provider_limits.get('*', LLM_RATE_LIMIT_DEFAULT))
+                    logger.info(
+                        f"[PROVIDER_LIMITER] create limiter for '{name}', limits: {limits}"
+                    )
+                    limiter = ProviderLimiter(name, **limits)
+                    self.limiters[name] = limiter
+        return limiter
+
+
+def get_limiter_stats() -> Dict[str, Dict[str, float]]:
+    """ Aggregates the limiter counters of each provider and model.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The counters and the average wait of each priority class, keyed by limiter.
+    """
+    stats: Dict[str, Dict[str, float]] = {}
+    for name, value in metrics_client.get_all(METRIC_PREFIX).items():
+        # Model names may contain ':', e.g. 'llama3:8b'
+        limiter_name, counter = name[len(METRIC_PREFIX):].rsplit(':', 1)
+        stats.setdefault(limiter_name, {})[counter] = value
+    for limiter_stats in stats.values():
+        for priority_class in PRIORITY_CLASSES:
+            calls = limiter_stats.get(f"{priority_class}.calls", 0)
+            if calls:
+                limiter_stats[f"{priority_class}.avg_wait_ms"] = limiter_stats.get(
+                    f"{priority_class}.wait_ms", 0) / calls
+    return stats
+
+
+# Initialize the provider limiter registry
+provider_limiter_registry = ProviderLimiterRegistry()
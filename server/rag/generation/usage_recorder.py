@@ -0,0 +1,153 @@
+import atexit
+import os
+from threading import Event, Lock, Thread
+import time
+from typing import Any, List, Optional, Tuple
+from server.app.utils.diskcache_lock import diskcache_lock
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.sqlite_client import get_db_connection
+from server.constant.constants import (LLM_USAGE_BATCH_SIZE,
+                                       LLM_USAGE_FLUSH_INTERVAL,
+                                       LLM_MODEL_PRICES)
+from server.logger.logger_config import my_logger as logger
+
+
+def estimate_cost(model_name: str, prompt_tokens: int,
+                  completion_tokens: int) -> float:
+    # Providers return versioned names such as 'gpt-4o-mini-2024-07-18', use the longest matching prefix
+    prices = None
+    for name in sorted(LLM_MODEL_PRICES, key=len, reverse=True):
+        if model_name.startswith(name):
+            prices = LLM_MODEL_PRICES[name]
+            break
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1e6
+
+
+def get_cached_tokens(usage: Any) -> int:
+    """Returns the prompt tokens served from the prefix cache of the provider, 0 if it doesn't report them."""
+    # DeepSeek
+    cached_tokens = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cached_tokens is not None:
+        return cached_tokens
+    # OpenAI, the details may be parsed as a dict by older SDKs
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        return details.get('cached_tokens') or 0
+    return getattr(details, 'cached_tokens', 0) or 0
+
+
+class UsageRecorder:
+    """ Buffers the token usage of LLM calls and writes it to `t_llm_usage_tab` in batches.
+
+    A writer thread flushes the buffer every `flush_interval` seconds, or as soon as `batch_size`
+    records are pending, so the request path never waits for SQLite.
+    """
+    def __init__(self,
+                 batch_size: int = LLM_USAGE_BATCH_SIZE,
+                 flush_interval: float = LLM_USAGE_FLUSH_INTERVAL) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: List[Tuple[Any, ...]] = []
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.writer: Optional[Thread] = None
+        self.writer_pid = 0
+        # The records of the parent are written by the parent, and its writer thread doesn't exist in the child
+        os.register_at_fork(after_in_child=self.reinit_after_fork)
+        atexit.register(self.flush)
+
+    def reinit_after_fork(self) -> None:
+        self.pending = []
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.writer = None
+        self.writer_pid = 0
+
+    def ensure_writer(self) -> None:
+        if self.writer_pid == os.getpid() and self.writer.is_alive():
+            return
+        with self.lock:
+            if self.writer_pid == os.getpid() and self.writer.is_alive():
+                return
+            self.writer = Thread(target=self.run, daemon=True)
+            self.writer.start()
+            self.writer_pid = os.getpid()
+
+    def record(self,
+               user_id: str,
+               stage: str,
+               model_name: str,
+               usage: Any,
+               latency: float,
+               first_token_latency: float = 0.0,
+               cache_hit: bool = False,
+               coalesced: bool = False) -> None:
+        """ Adds the usage of an LLM call to the buffer.
+
+        Args:
+            user_id (str): The user of the request.
+            stage (str): 'refine_query', 'query_expansion', 'query_construction', 'smart_query', 'smart_query_stream' or 'smart_query_json_stream'.
+            model_name (str): The model that served the call, empty if no model was called.
+            usage (Any): The `usage` of the response, None if the LLM wasn't called or didn't report it.
+            latency (float): Seconds of the whole call.
+            first_token_latency (float): Seconds to the first token of a streaming call.
+            cache_hit (bool): Whether the answer came from Cache without calling the LLM.
+            coalesced (bool): Whether the answer was shared with an identical in-flight query.
+        """
+        prompt_tokens = completion_tokens = 0
+        if usage is not None and not coalesced:
+            prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+            completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+            cached_tokens = get_cached_tokens(usage)
+            logger.info(
+                f"[USAGE_RECORDER] stage: '{stage}', model: '{model_name}', prompt_tokens: {prompt_tokens}, cached_tokens: {cached_tokens}, completion_tokens: {completion_tokens}"
+            )
+            metrics_client.incr(f"llm_prompt_cache:{stage}:prompt_tokens",
+                                prompt_tokens)
+            metrics_client.incr(f"llm_prompt_cache:{stage}:cached_tokens",
+                                cached_tokens)
+        record = (user_id, stage, model_name or '', prompt_tokens,
+                  completion_tokens, prompt_tokens + completion_tokens,
+                  int(latency * 1000), int(first_token_latency * 1000),
+                  int(cache_hit), int(coalesced),
+                  estimate_cost(model_name or '', prompt_tokens,
+                                completion_tokens), int(time.time()))
+        with self.lock:
+            self.pending.append(record)
+            is_full = len(self.pending) >= self.batch_size
+        self.ensure_writer()
+        if is_full:
+            self.wakeup.set()
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        conn = None
+        try:
+            conn = get_db_connection()
+            with diskcache_lock.lock():
+                conn.executemany(
+                    'INSERT INTO t_llm_usage_tab (user_id, stage, model_name, prompt_tokens, completion_tokens, total_tokens, latency_ms, first_token_ms, cache_hit, coalesced, cost, ctime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    batch)
+                conn.commit()
+        except Exception as e:
+            logger.error(
+                f"[USAGE_RECORDER] write {len(batch)} records failed, the exception is {e}"
+            )
+        finally:
+            if conn:
+                conn.close()
+
+
+# Initialize the LLM usage recorder
+usage_recorder = UsageRecorder()
@@ -6,6 +6,11 @@ import re
 from typing import List, Optional, Any
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+# Paragraphs, lines, sentences of Chinese then of other languages, and clauses
+MARKDOWN_SEPARATORS = [
+    "\n\n", "\n", "。|！|？", "\.\s|\!\s|\?\s", "；|;\s", "，|,\s"
+]
+
 
 def remove_empty_lines(text: str) -> str:
     lines = text.splitlines()
@@ -42,9 +47,7 @@ class MarkdownTextSplitter(RecursiveCharacterTextSplitter):
     ) -> None:
         """Create a new TextSplitter."""
         super().__init__(keep_separator=keep_separator, **kwargs)
-        self._separators = separators or [
-            "\n\n", "\n", "。|！|？", "\.\s|\!\s|\?\s", "；|;\s", "，|,\s"
-        ]
+        self._separators = separators or MARKDOWN_SEPARATORS
         self._is_separator_regex = is_separator_regex
         self._is_remove_empty_line = is_remove_empty_line
 
@@ -0,0 +1,137 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+import numpy as np
+from langchain_core.embeddings.embeddings import Embeddings
+from server.logger.logger_config import my_logger as logger
+
+
+class DimensionReducer:
+    """ Shrinks embedding vectors to a fixed dimension before they are stored or searched.
+
+    Supported methods:
+      'truncate' - Keep the leading components (Matryoshka-style), then re-normalize.
+      'pca'      - Project onto the principal components fitted offline, then re-normalize.
+    """
+    METHODS = ('truncate', 'pca')
+
+    def __init__(self,
+                 method: str,
+                 dimension: int,
+                 projection_file: Optional[str] = None) -> None:
+        if method not in self.METHODS:
+            raise ValueError(
+                f"Unsupported reduction method '{method}'. Must be in {list(self.METHODS)}."
+            )
+        if dimension <= 0:
+            raise ValueError(
+                f"Reduced dimension must be positive, got {dimension}.")
+
+        self.method = method
+        self.dimension = dimension
+        self.mean: Optional[np.ndarray] = None
+        self.components: Optional[np.ndarray] = None
+        if method == 'pca':
+            if not projection_file or not Path(projection_file).exists():
+                raise ValueError(
+                    f"PCA projection file '{projection_file}' not found! Run `python evaluate_embedding_dimension.py --save-pca {dimension}` first."
+                )
+            self.mean, self.components = self.load_projection(
+                projection_file)
+            if self.components.shape[0] != dimension:
+                raise ValueError(
+                    f"PCA projection file '{projection_file}' has {self.components.shape[0]} components, expected {dimension}."
+                )
+        logger.info(
+            f"[DIM_REDUCER] init, method: '{method}', dimension: {dimension}")
+
+    def reduce(self, vectors: List[List[float]]) -> List[List[float]]:
+        """ Reduces a batch of vectors. Empty vectors (failed embeddings) are passed through unchanged.
+
+        Args:
+            vectors (List[List[float]]): Full-dimension embedding vectors.
+
+        Returns:
+            List[List[float]]: Reduced and L2-normalized vectors.
+        """
+        indexes = [i for i, vec in enumerate(vectors) if vec]
+        if not indexes:
+            return vectors
+
+        matrix = np.asarray([vectors[i] for i in indexes], dtype=np.float32)
+        reduced = self.reduce_matrix(matrix)
+        result = list(vectors)
+        for i, vec in zip(indexes, reduced.tolist()):
+            result[i] = vec
+        return result
+
+    def reduce_matrix(self, matrix: np.ndarray) -> np.ndarray:
+        if self.method == 'truncate':
+            reduced = matrix[:, :self.dimension]
+        else:
+            reduced = (matrix - self.mean) @ self.components.T
+        return normalize_rows(reduced)
+
+    @staticmethod
+    def fit_pca(matrix: np.ndarray,
+                dimension: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Fits a PCA projection on a matrix of full-dimension vectors.
+
+        Args:
+            matrix (np.ndarray): Array of shape (n_samples, full_dimension).
+            dimension (int): Number of principal components to keep.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The mean vector and the (dimension, full_dimension) component matrix.
+        """
+        if dimension > min(matrix.shape):
+            raise ValueError(
+                f"Cannot fit {dimension} components on a matrix of shape {matrix.shape}."
+            )
+        mean = matrix.mean(axis=0)
+        _, _, vt = np.linalg.svd(matrix - mean, full_matrices=False)
+        return mean.astype(np.float32), vt[:dimension].astype(np.float32)
+
+    @staticmethod
+    def save_projection(projection_file: str, mean: np.ndarray,
+                        components: np.ndarray) -> None:
+        Path(projection_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(projection_file, 'wb') as f:
+            np.savez(f, mean=mean, components=components)
+
+    @staticmethod
+    def load_projection(
+            projection_file: str) -> Tuple[np.ndarray, np.ndarray]:
+        data = np.load(projection_file)
+        return data["mean"], data["components"]
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ReducedDimensionEmbeddings(Embeddings):
+    """ Wraps an Embeddings implementation so that documents and queries are reduced the same way. """
+    def __init__(self, base_embeddings: Embeddings,
+                 reducer: DimensionReducer) -> None:
+        self.base_embeddings = base_embeddings
+        self.reducer = reducer
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.reducer.reduce(self.base_embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.reducer.reduce([self.base_embeddings.embed_query(text)
+                                    ])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self.reducer.reduce(self.base_embeddings.embed_queries(texts))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        ret = await self.base_embeddings.aembed_documents(texts)
+        return self.reducer.reduce(ret)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        ret = await self.base_embeddings.aembed_query(text)
+        return self.reducer.reduce([ret])[0]
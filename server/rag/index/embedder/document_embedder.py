@@ -1,17 +1,117 @@
 import json
 import os
 import time
-from typing import List, Tuple, Dict, Optional
+from typing import Any, List, Tuple, Dict, Optional
+from urllib.parse import urlparse
 from langchain_community.vectorstores import Chroma
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain.schema.document import Document
-from server.constant.constants import (OPENAI_EMBEDDING_MODEL_NAME,
+from langchain_core.embeddings.embeddings import Embeddings
+from server.constant.constants import (FROM_LOCAL_FILE,
+                                       OPENAI_EMBEDDING_MODEL_NAME,
                                        ZHIPUAI_EMBEDDING_MODEL_NAME,
                                        CHROMA_DB_DIR, CHROMA_COLLECTION_NAME,
-                                       OLLAMA_EMBEDDING_MODEL_NAME)
+                                       OLLAMA_EMBEDDING_MODEL_NAME,
+                                       EMBEDDING_REDUCTION_METHOD,
+                                       EMBEDDING_REDUCED_DIMENSION,
+                                       EMBEDDING_PCA_PROJECTION_FILE)
+from server.app.utils.diskcache_client import diskcache_client
+from server.app.utils.lazy_singleton import LazySingleton
 from server.logger.logger_config import my_logger as logger
+from server.rag.index.embedder.dimension_reducer import DimensionReducer, ReducedDimensionEmbeddings
+from server.rag.index.embedder.query_embedding_cache import CachedQueryEmbeddings
+from server.rag.index.embedder.rate_limited_embeddings import RateLimitedEmbeddings
 from server.rag.index.embedder.zhipuai_embedder import ZhipuAIEmbeddings
+from server.rag.post_retrieval.rerank.rerank_score_cache import rerank_score_cache
+
+KB_VERSION_KEY = "open_kf:kb_version"
+
+
+def get_kb_version() -> int:
+    """The version of the knowledge base, increased whenever embeddings are added or deleted."""
+    return diskcache_client.cache.get(KB_VERSION_KEY, default=0)
+
+
+def bump_kb_version() -> None:
+    try:
+        diskcache_client.cache.incr(KB_VERSION_KEY, default=0)
+    except Exception as e:
+        logger.error(f"Increase the knowledge base version failed, the exception is {e}")
+
+
+def get_url_domain(url: str) -> str:
+    domain = urlparse(url).netloc.lower()
+    return domain[4:] if domain.startswith('www.') else domain
+
+
+def get_url_section(url: str) -> str:
+    """The first segment of the URL path, e.g. 'sdks' for 'https://docs.openim.io/sdks/quickstart'."""
+    segments = [segment for segment in urlparse(url).path.split('/') if segment]
+    # The last segment is the page itself
+    return segments[0].lower() if len(segments) > 1 else ''
+
+
+def build_chunk_metadata(url: str, doc_source: int, doc_id: int,
+                         part_index: int, timestamp: int) -> Dict[str, Any]:
+    """ Returns the metadata of a chunk, the structured fields can be used as filters of the vector search.
+
+    `file_type` is the extension of local files, and 'html' for web pages. `section` is the first path segment
+    of web pages, and empty for local files whose URL is a download path. `mtime` is the time the content
+    of the document was last embedded.
+    """
+    if doc_source == FROM_LOCAL_FILE:
+        file_type = os.path.splitext(urlparse(url).path)[1][1:].lower()
+        section = ''
+    else:
+        file_type = 'html'
+        section = get_url_section(url)
+    return {
+        "source": url,
+        "id": f"{doc_source}-{doc_id}-part{part_index}",
+        "doc_source": doc_source,
+        "domain": get_url_domain(url),
+        "section": section,
+        "file_type": file_type,
+        "mtime": timestamp
+    }
+
+
+def create_base_embeddings(llm_name: str) -> Tuple[Embeddings, str]:
+    """ Returns the full-dimension embeddings of the provider serving `llm_name`, and the embedding model name.
+
+    The calls go through the limiter of that provider, so query and ingestion embedding calls share its rate limits.
+    """
+    if llm_name == 'OpenAI':
+        embeddings = OpenAIEmbeddings(
+            openai_api_key=os.getenv('OPENAI_API_KEY'),
+            model=OPENAI_EMBEDDING_MODEL_NAME)
+        embedding_model_name = OPENAI_EMBEDDING_MODEL_NAME
+    elif llm_name == 'ZhipuAI':
+        embeddings = ZhipuAIEmbeddings(
+            api_key=os.getenv('ZHIPUAI_API_KEY'),
+            model=ZHIPUAI_EMBEDDING_MODEL_NAME)
+        embedding_model_name = ZHIPUAI_EMBEDDING_MODEL_NAME
+    elif llm_name == 'Ollama':
+        base_url = os.getenv('OLLAMA_BASE_URL')
+        embeddings = OllamaEmbeddings(base_url=base_url,
+                                      model=OLLAMA_EMBEDDING_MODEL_NAME)
+        embedding_model_name = OLLAMA_EMBEDDING_MODEL_NAME
+    elif llm_name in ['DeepSeek', 'Moonshot']:
+        # DeepSeek and Moonshot use ZhipuAI's Embedding API
+        embeddings = ZhipuAIEmbeddings(
+            api_key=os.getenv('ZHIPUAI_API_KEY'),
+            model=ZHIPUAI_EMBEDDING_MODEL_NAME)
+        embedding_model_name = ZHIPUAI_EMBEDDING_MODEL_NAME
+    else:
+        raise ValueError(
+            f"Unsupported LLM_NAME '{llm_name}'. Must be in ['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot']."
+        )
+
+    embedding_llm_name = 'ZhipuAI' if llm_name in ['DeepSeek', 'Moonshot'] else llm_name
+    embeddings = RateLimitedEmbeddings(embeddings, embedding_llm_name,
+                                       embedding_model_name)
+    return embeddings, embedding_model_name
 
 
 class DocumentEmbedder:
@@ -19,32 +119,27 @@ class DocumentEmbedder:
 
     def __init__(self) -> None:
         self.llm_name = os.getenv('LLM_NAME')
-        if self.llm_name == 'OpenAI':
-            embeddings = OpenAIEmbeddings(
-                openai_api_key=os.getenv('OPENAI_API_KEY'),
-                model=OPENAI_EMBEDDING_MODEL_NAME)
-        elif self.llm_name == 'ZhipuAI':
-            embeddings = ZhipuAIEmbeddings(
-                api_key=os.getenv('ZHIPUAI_API_KEY'),
-                model=ZHIPUAI_EMBEDDING_MODEL_NAME)
-        elif self.llm_name == 'Ollama':
-            base_url = os.getenv('OLLAMA_BASE_URL')
-            embeddings = OllamaEmbeddings(base_url=base_url,
-                                          model=OLLAMA_EMBEDDING_MODEL_NAME)
-        elif self.llm_name in ['DeepSeek', 'Moonshot']:
-            # DeepSeek and Moonshot use ZhipuAI's Embedding API
-            embeddings = ZhipuAIEmbeddings(
-                api_key=os.getenv('ZHIPUAI_API_KEY'),
-                model=ZHIPUAI_EMBEDDING_MODEL_NAME)
-        else:
-            raise ValueError(
-                f"Unsupported LLM_NAME '{self.llm_name}'. Must be in ['OpenAI', 'ZhipuAI', 'Ollama', 'DeepSeek', 'Moonshot']."
-            )
+        embeddings, self.embedding_model_name = create_base_embeddings(
+            self.llm_name)
 
         collection_name = CHROMA_COLLECTION_NAME
+        if EMBEDDING_REDUCTION_METHOD != 'none':
+            reducer = DimensionReducer(EMBEDDING_REDUCTION_METHOD,
+                                       EMBEDDING_REDUCED_DIMENSION,
+                                       EMBEDDING_PCA_PROJECTION_FILE)
+            embeddings = ReducedDimensionEmbeddings(embeddings, reducer)
+            # Vectors of different dimensions can't share a collection
+            collection_name = f"{CHROMA_COLLECTION_NAME}_{EMBEDDING_REDUCTION_METHOD}{EMBEDDING_REDUCED_DIMENSION}"
+            self.embedding_model_name = f"{self.embedding_model_name}_{EMBEDDING_REDUCTION_METHOD}{EMBEDDING_REDUCED_DIMENSION}"
+
+        # Popular queries are embedded once and shared across worker processes
+        self.query_embedding_cache = CachedQueryEmbeddings(
+            embeddings, self.embedding_model_name)
+        embeddings = self.query_embedding_cache
+
         persist_directory = CHROMA_DB_DIR
         logger.info(
-            f"[DOC_EMBEDDER] init, collection_name: '{collection_name}', persist_directory: '{persist_directory}', llm_name: '{self.llm_name}'"
+            f"[DOC_EMBEDDER] init, collection_name: '{collection_name}', persist_directory: '{persist_directory}', llm_name: '{self.llm_name}', reduction_method: '{EMBEDDING_REDUCTION_METHOD}'"
         )
         collection_metadata = {"hnsw:space": "cosine"}
         self.chroma_vector = Chroma(collection_name=collection_name,
@@ -62,10 +157,8 @@ class DocumentEmbedder:
             timestamp = int(time.time())
             doc_id, url, chunk_text_vec = item
             for part_index, part_content in enumerate(chunk_text_vec):
-                metadata: Dict[str, str] = {
-                    "source": url,
-                    "id": f"{doc_source}-{doc_id}-part{part_index}"
-                }
+                metadata = build_chunk_metadata(url, doc_source, doc_id,
+                                                part_index, timestamp)
                 doc = Document(page_content=part_content, metadata=metadata)
                 documents_to_add.append(doc)
 
@@ -83,17 +176,23 @@ class DocumentEmbedder:
                      timestamp, timestamp))
                 records_to_update.append((timestamp, doc_id))
 
+        if records_to_add:
+            bump_kb_version()
         return records_to_add, records_to_update
 
-    async def aadd_local_file_embedding(self, doc_id: int, url: str,
+    async def aadd_local_file_embedding(self,
+                                        doc_id: int,
+                                        url: str,
                                         chunk_text_vec: List[str],
-                                        doc_source: int) -> List[str]:
+                                        doc_source: int,
+                                        start_index: int = 0) -> List[str]:
+        """`start_index` is the index of the first chunk of `chunk_text_vec` in the file."""
         file_documents_to_add = []
-        for part_index, part_content in enumerate(chunk_text_vec):
-            metadata: Dict[str, str] = {
-                "source": url,
-                "id": f"{doc_source}-{doc_id}-part{part_index}"
-            }
+        timestamp = int(time.time())
+        for part_index, part_content in enumerate(chunk_text_vec,
+                                                  start=start_index):
+            metadata = build_chunk_metadata(url, doc_source, doc_id,
+                                            part_index, timestamp)
             doc = Document(page_content=part_content, metadata=metadata)
             file_documents_to_add.append(doc)
 
@@ -103,15 +202,29 @@ class DocumentEmbedder:
             logger.info(
                 f"[DOC_EMBEDDER] doc_id={doc_id}, url={url}, doc_source={doc_source}, added {len(file_documents_to_add)} chunk parts to Chroma, embedding_id_vec={embedding_id_vec}"
             )
+            bump_kb_version()
             return embedding_id_vec
         else:
             return []
 
+    def evict_rerank_scores(self, embedding_id_vec: List[str]) -> None:
+        # The cached rerank scores of deleted chunks will never be hit again
+        try:
+            texts = self.chroma_vector.get(ids=embedding_id_vec,
+                                           include=["documents"])["documents"]
+            rerank_score_cache.evict_passages(texts)
+        except Exception as e:
+            logger.error(
+                f"[DOC_EMBEDDER] evict_rerank_scores failed, the exception is {e}"
+            )
+
     async def adelete_document_embedding(
             self, embedding_id_vec: List[str]) -> Optional[bool]:
         for start in range(0, len(embedding_id_vec), self.BATCH_SIZE):
             batch = embedding_id_vec[start:start + self.BATCH_SIZE]
+            self.evict_rerank_scores(batch)
             await self.chroma_vector.adelete(batch)
+        bump_kb_version()
         logger.info(
             f"[DOC_EMBEDDER] Deleted {len(embedding_id_vec)} embeddings from Chroma."
         )
@@ -119,10 +232,13 @@ class DocumentEmbedder:
     def delete_document_embedding(self, embedding_id_vec: List[str]) -> None:
         for start in range(0, len(embedding_id_vec), self.BATCH_SIZE):
             batch = embedding_id_vec[start:start + self.BATCH_SIZE]
+            self.evict_rerank_scores(batch)
             self.chroma_vector.delete(batch)
+        bump_kb_version()
         logger.info(
             f"[DOC_EMBEDDER] Deleted {len(embedding_id_vec)} embeddings from Chroma."
         )
 
 
-document_embedder = DocumentEmbedder()
+# Chroma and the embedding client are created on first use in each process
+document_embedder = LazySingleton('document_embedder', DocumentEmbedder)
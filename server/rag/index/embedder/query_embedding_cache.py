@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+from typing import Dict, List, Optional
+from langchain_core.embeddings.embeddings import Embeddings
+from server.app.utils.diskcache_client import diskcache_client
+from server.app.utils.hash import generate_md5
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.text_helper import normalize_text
+from server.constant.constants import (QUERY_EMBEDDING_LRU_SIZE,
+                                       QUERY_EMBEDDING_CACHE_EXPIRE_TIME)
+from server.logger.logger_config import my_logger as logger
+
+METRIC_PREFIX = "query_embedding_cache:"
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """ Caches query embeddings in a per-process LRU backed by a Diskcache tier shared across workers.
+
+    Keys are the embedding model name and the normalized query text. Documents are not cached,
+    they are only embedded once at ingestion.
+    """
+    def __init__(self,
+                 base_embeddings: Embeddings,
+                 model_name: str,
+                 lru_size: int = QUERY_EMBEDDING_LRU_SIZE,
+                 expire_time: int = QUERY_EMBEDDING_CACHE_EXPIRE_TIME) -> None:
+        self.base_embeddings = base_embeddings
+        self.model_name = model_name
+        self.lru_size = lru_size
+        self.expire_time = expire_time
+        self.lru: OrderedDict[str, List[float]] = OrderedDict()
+        self.lru_lock = Lock()
+        # Average latency of an embedding API call, used to estimate the latency saved by a hit
+        self.avg_miss_latency_ms = 0.0
+
+    def get_cache_key(self, normalized_query: str) -> str:
+        query_md5 = generate_md5(normalized_query.encode('utf-8'))
+        return f"open_kf:query_embedding:{self.model_name}:{query_md5}"
+
+    def get_from_lru(self, key: str) -> Optional[List[float]]:
+        with self.lru_lock:
+            embedding = self.lru.get(key)
+            if embedding is not None:
+                self.lru.move_to_end(key)
+            return embedding
+
+    def put_into_lru(self, key: str, embedding: List[float]) -> None:
+        with self.lru_lock:
+            self.lru[key] = embedding
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def record_hit(self, tier: str) -> None:
+        metrics_client.incr(f"{METRIC_PREFIX}{tier}_hit")
+        if not self.avg_miss_latency_ms:
+            misses = metrics_client.get(f"{METRIC_PREFIX}miss")
+            if misses:
+                self.avg_miss_latency_ms = metrics_client.get(
+                    f"{METRIC_PREFIX}miss_latency_ms") / misses
+        metrics_client.incr(f"{METRIC_PREFIX}latency_saved_ms",
+                            int(self.avg_miss_latency_ms))
+
+    def record_miss(self, latency_ms: float) -> None:
+        metrics_client.incr(f"{METRIC_PREFIX}miss")
+        metrics_client.incr(f"{METRIC_PREFIX}miss_latency_ms", int(latency_ms))
+        if self.avg_miss_latency_ms:
+            self.avg_miss_latency_ms = 0.9 * self.avg_miss_latency_ms + 0.1 * latency_ms
+        else:
+            self.avg_miss_latency_ms = latency_ms
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.base_embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.base_embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        normalized_query = normalize_text(text)
+        key = self.get_cache_key(normalized_query)
+
+        embedding = self.get_from_lru(key)
+        if embedding is not None:
+            self.record_hit('lru')
+            return embedding
+
+        try:
+            embedding = diskcache_client.get(key)
+        except Exception as e:
+            logger.error(
+                f"Get query embedding from Cache failed, the exception is {e}")
+            embedding = None
+        if embedding is not None:
+            self.put_into_lru(key, embedding)
+            self.record_hit('disk')
+            return embedding
+
+        beg_time = time.time()
+        embedding = self.base_embeddings.embed_query(normalized_query)
+        self.record_miss((time.time() - beg_time) * 1000)
+        if embedding:
+            # Don't cache the empty fallback of a failed embedding call
+            self.put_into_lru(key, embedding)
+            try:
+                diskcache_client.set(key, embedding, ttl=self.expire_time)
+            except Exception as e:
+                logger.error(
+                    f"Set query embedding into Cache failed, the exception is {e}"
+                )
+        return embedding
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """ Embeds several queries, the ones missing from both tiers in a single batched call. """
+        keys = [self.get_cache_key(normalize_text(text)) for text in texts]
+        embeddings: List[Optional[List[float]]] = []
+        miss_indexes = []
+        for index, key in enumerate(keys):
+            embedding = self.get_from_lru(key)
+            if embedding is not None:
+                self.record_hit('lru')
+            else:
+                try:
+                    embedding = diskcache_client.get(key)
+                except Exception as e:
+                    logger.error(
+                        f"Get query embedding from Cache failed, the exception is {e}"
+                    )
+                    embedding = None
+                if embedding is not None:
+                    self.put_into_lru(key, embedding)
+                    self.record_hit('disk')
+                else:
+                    miss_indexes.append(index)
+            embeddings.append(embedding)
+
+        if miss_indexes:
+            beg_time = time.time()
+            miss_embeddings = self.base_embeddings.embed_queries(
+                [normalize_text(texts[index]) for index in miss_indexes])
+            latency_ms = (time.time() - beg_time) * 1000
+            for index, embedding in zip(miss_indexes, miss_embeddings):
+                self.record_miss(latency_ms / len(miss_indexes))
+                embeddings[index] = embedding
+                if embedding:
+                    self.put_into_lru(keys[index], embedding)
+                    try:
+                        diskcache_client.set(keys[index],
+                                             embedding,
+                                             ttl=self.expire_time)
+                    except Exception as e:
+                        logger.error(
+                            f"Set query embedding into Cache failed, the exception is {e}"
+                        )
+        return embeddings
+
+    def warmup(self, queries: List[str]) -> None:
+        """Embed the queries ahead of time, e.g. the suggested messages of the bot."""
+        for query in queries:
+            if query:
+                self.embed_query(query)
+
+    def get_stats(self) -> Dict[str, float]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        lru_hit = counters.get(f"{METRIC_PREFIX}lru_hit", 0)
+        disk_hit = counters.get(f"{METRIC_PREFIX}disk_hit", 0)
+        miss = counters.get(f"{METRIC_PREFIX}miss", 0)
+        total = lru_hit + disk_hit + miss
+        return {
+            "lru_hit": lru_hit,
+            "disk_hit": disk_hit,
+            "miss": miss,
+            "hit_rate": (lru_hit + disk_hit) / total if total else 0.0,
+            "latency_saved_ms": counters.get(f"{METRIC_PREFIX}latency_saved_ms",
+                                             0),
+            "lru_size": len(self.lru)
+        }
@@ -0,0 +1,71 @@
+from typing import List
+from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.embeddings.embeddings import Embeddings
+from server.rag.generation.provider_limiter import (ProviderLimiter,
+                                                    estimate_tokens,
+                                                    provider_limiter_registry)
+
+
+def embed_query_batch(embeddings: Embeddings,
+                      texts: List[str]) -> List[List[float]]:
+    """ Embeds several queries in one call of the provider.
+
+    OpenAI and ZhipuAI embed queries and documents the same way. Ollama prepends a different instruction
+    to queries, so the instruction of `embed_query` is kept.
+    """
+    if isinstance(embeddings, OllamaEmbeddings):
+        return embeddings._embed(
+            [f"{embeddings.query_instruction}{text}" for text in texts])
+    return embeddings.embed_documents(texts)
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """ Wraps an Embeddings implementation so that its calls go through the limiter of the provider.
+
+    Documents are embedded at ingestion in the bulk 'ingestion' class, queries in the 'query_embedding'
+    class that is served first. The async methods of `Embeddings` run the sync ones in an executor,
+    so the wait for the limiter never blocks the event loop.
+    """
+    def __init__(self, base_embeddings: Embeddings, llm_name: str,
+                 model_name: str) -> None:
+        self.base_embeddings = base_embeddings
+        self.llm_name = llm_name
+        self.model_name = model_name
+
+    @property
+    def limiter(self) -> ProviderLimiter:
+        # Looked up on each call: the registry is reset in a forked worker, and the limiters of the master
+        # may have been copied with their locks held
+        return provider_limiter_registry.get(self.llm_name, self.model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        tokens = sum(estimate_tokens(text) for text in texts)
+        with self.limiter.acquire('ingestion', tokens):
+            try:
+                return self.base_embeddings.embed_documents(texts)
+            except Exception as e:
+                error = self.limiter.check_rate_limited(e)
+                if error is e:
+                    raise
+                raise error from e
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.limiter.acquire('query_embedding', estimate_tokens(text)):
+            try:
+                return self.base_embeddings.embed_query(text)
+            except Exception as e:
+                error = self.limiter.check_rate_limited(e)
+                if error is e:
+                    raise
+                raise error from e
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        tokens = sum(estimate_tokens(text) for text in texts)
+        with self.limiter.acquire('query_embedding', tokens):
+            try:
+                return embed_query_batch(self.base_embeddings, texts)
+            except Exception as e:
+                error = self.limiter.check_rate_limited(e)
+                if error is e:
+                    raise
+                raise error from e
@@ -1,7 +1,7 @@
 import aiosqlite
 import json
 import time
-from typing import List
+from typing import Any, Callable, Dict, List, Optional
 from server.app.utils.diskcache_lock import diskcache_lock
 from server.logger.logger_config import my_logger as logger
 from server.constant.constants import (SQLITE_DB_DIR, SQLITE_DB_NAME,
@@ -61,14 +61,28 @@ class AsyncTextParser:
 
             try:
                 with self.distributed_lock.lock():
+                    # Replace, so that a resumed job can write the same chunks again
                     await db.executemany(
-                        "INSERT INTO t_local_file_chunk_tab (file_id, chunk_index, content, content_length, ctime, mtime) VALUES (?, ?, ?, ?, ?, ?)",
+                        "INSERT OR REPLACE INTO t_local_file_chunk_tab (file_id, chunk_index, content, content_length, ctime, mtime) VALUES (?, ?, ?, ?, ?, ?)",
                         chunks_to_add)
                     await db.commit()
             except Exception as e:
                 logger.error(f"Process distributed_lock exception: {e}")
 
-    async def add_content(self, doc_id: int, content: str, url: str) -> None:
+    async def add_content(
+        self,
+        doc_id: int,
+        content: str,
+        url: str,
+        checkpoint: Optional[Dict[str, Any]] = None,
+        on_checkpoint: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> None:
+        """
+        Split, store and embed the content of a local file.
+
+        `checkpoint` holds the progress of a previous attempt, `next_chunk` and `embedding_id_list`, and
+        `on_checkpoint` is called with the new progress after each embedded batch.
+        """
         if not content:
             await self.update_doc_status(doc_id, LOCAL_FILE_PROCESS_FAILED)
             return
@@ -84,8 +98,16 @@ class AsyncTextParser:
         chunk_text_vec = text_splitter_obj.split_text(content)
         await self.update_doc_status(doc_id, LOCAL_FILE_PARSING_COMPLETED)
 
-        embedding_id_vec = []
-        for start in range(0, len(chunk_text_vec), self.ADD_BATCH_SIZE):
+        checkpoint = checkpoint or {}
+        next_chunk = checkpoint.get("next_chunk", 0)
+        embedding_id_vec = list(checkpoint.get("embedding_id_list", []))
+        if next_chunk:
+            logger.warning(
+                f"[FILE_CONTENT] add_content resume, doc_id: {doc_id}, next_chunk: {next_chunk}, total chunks: {len(chunk_text_vec)}"
+            )
+
+        for start in range(next_chunk, len(chunk_text_vec),
+                           self.ADD_BATCH_SIZE):
             batch = chunk_text_vec[start:start + self.ADD_BATCH_SIZE]
 
             await self.add_local_file_chunk(doc_id, batch, start)
@@ -93,11 +115,20 @@ class AsyncTextParser:
             try:
                 with self.distributed_lock.lock():
                     ret = await document_embedder.aadd_local_file_embedding(
-                        doc_id, url, batch, self.doc_source)
+                        doc_id, url, batch, self.doc_source, start)
                     if ret:
                         embedding_id_vec.extend(ret)
             except Exception as e:
                 logger.error(f"Process distributed_lock exception: {e}")
+                # Stop here, a retry resumes from the last checkpoint
+                await self.update_doc_status(doc_id, LOCAL_FILE_PROCESS_FAILED)
+                return
+
+            if on_checkpoint:
+                on_checkpoint({
+                    "next_chunk": start + len(batch),
+                    "embedding_id_list": embedding_id_vec
+                })
 
         if embedding_id_vec:
             await self.update_doc_status(doc_id, LOCAL_FILE_EMBEDDED)
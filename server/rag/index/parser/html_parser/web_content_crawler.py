@@ -5,7 +5,7 @@ import json
 import os
 import re
 import time
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, Set
 from urllib.parse import urljoin, urlparse
 from bs4 import BeautifulSoup
 import html2text
@@ -167,6 +167,20 @@ class AsyncCrawlerSiteContent:
             results = await cursor.fetchall()
             return dict(results)
 
+    async def get_embedded_doc_ids(self, doc_id_list: List[int]) -> Set[int]:
+        """
+        Fetch the doc IDs that already have embeddings stored in t_doc_embedding_map_tab.
+        """
+        placeholders = ', '.join('?' for _ in doc_id_list)
+        async with aiosqlite.connect(self.sqlite_db_path) as db:
+            await db.execute("PRAGMA journal_mode=WAL;")
+
+            cursor = await db.execute(
+                f"SELECT doc_id FROM t_doc_embedding_map_tab WHERE doc_source = ? AND doc_id IN ({placeholders})",
+                [self.doc_source] + doc_id_list)
+            rows = await cursor.fetchall()
+            return {row[0] for row in rows}
+
     def compare_contents(
         self, existing_contents_md5: Dict[int, str],
         fetched_contents: Dict[int, List[str]]
@@ -205,6 +219,18 @@ class AsyncCrawlerSiteContent:
         updated_contents, unchanged_doc_ids = self.compare_contents(
             existing_contents_md5, fetched_contents)
 
+        # A previous attempt may have stored the content but died before embedding it
+        if unchanged_doc_ids:
+            embedded_doc_ids = await self.get_embedded_doc_ids(
+                unchanged_doc_ids)
+            for doc_id in unchanged_doc_ids:
+                if doc_id not in embedded_doc_ids:
+                    updated_contents[doc_id] = fetched_contents[doc_id]
+            unchanged_doc_ids = [
+                doc_id for doc_id in unchanged_doc_ids
+                if doc_id in embedded_doc_ids
+            ]
+
         # Process updated contents: delete old embeddings, insert new ones, and update DB records
         if updated_contents:
             await self.process_updated_contents(updated_contents, url_dict)
@@ -0,0 +1,238 @@
+from collections import Counter
+import math
+import re
+import time
+from typing import Dict, List, Set, Tuple
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (CONTEXT_COMPRESSION_KEEP_RATIO,
+                                       CONTEXT_COMPRESSION_MIN_TOKEN_BUDGET,
+                                       CONTEXT_COMPRESSION_WINDOW)
+from server.logger.logger_config import my_logger as logger
+from server.rag.generation.provider_limiter import estimate_tokens
+from server.rag.index.chunk.markdown_splitter import (
+    MARKDOWN_SEPARATORS, split_text_with_regex_from_end)
+from server.rag.post_retrieval.rerank.rerank_batcher import rerank_batcher
+
+METRIC_PREFIX = "context_compression:"
+
+# The separators of paragraphs, lines and sentences, clauses are too short to stand alone
+SENTENCE_SEPARATOR = "|".join(MARKDOWN_SEPARATORS[:4])
+# Code blocks are kept as a single unit
+CODE_BLOCK_PATTERN = re.compile(r"```.*?```", re.DOTALL)
+# Single CJK characters, and words of the other languages
+TERM_PATTERN = re.compile(
+    r"[\u3400-\u4dbf\u4e00-\u9fff]|[^\W_\u3400-\u4dbf\u4e00-\u9fff]+")
+# Marks the text removed between two kept spans of a chunk
+GAP_MARKER = "\n...\n"
+
+
+def split_sentences(text: str) -> List[str]:
+    """ Splits a chunk into sentences with their trailing separators, so that contiguous sentences join back into the original text. """
+    pieces: List[str] = []
+    start = 0
+    for match in CODE_BLOCK_PATTERN.finditer(text):
+        pieces.extend(
+            split_text_with_regex_from_end(text[start:match.start()],
+                                           SENTENCE_SEPARATOR, True))
+        pieces.append(match.group())
+        start = match.end()
+    pieces.extend(
+        split_text_with_regex_from_end(text[start:], SENTENCE_SEPARATOR,
+                                       True))
+
+    # Separator-only pieces, e.g. blank lines, stick to the previous sentence
+    sentences: List[str] = []
+    for piece in pieces:
+        if sentences and not piece.strip():
+            sentences[-1] += piece
+        else:
+            sentences.append(piece)
+    return sentences
+
+
+def get_terms(text: str) -> List[str]:
+    return TERM_PATTERN.findall(text.lower())
+
+
+def bm25_scores(query: str,
+                sentences: List[str],
+                k1: float = 1.2,
+                b: float = 0.75) -> List[float]:
+    """ Scores the sentences against the query with BM25, the sentences being the corpus. """
+    query_terms = set(get_terms(query))
+    sentence_terms = [Counter(get_terms(sentence)) for sentence in sentences]
+    lengths = [sum(terms.values()) for terms in sentence_terms]
+    avg_length = sum(lengths) / len(lengths) if lengths else 0
+    if not query_terms or not avg_length:
+        return [0.0] * len(sentences)
+
+    doc_freq = Counter(term for terms in sentence_terms for term in terms
+                       if term in query_terms)
+    count = len(sentences)
+    idf = {
+        term: math.log(1 + (count - freq + 0.5) / (freq + 0.5))
+        for term, freq in doc_freq.items()
+    }
+    scores = []
+    for terms, length in zip(sentence_terms, lengths):
+        score = 0.0
+        for term, weight in idf.items():
+            freq = terms.get(term, 0)
+            if freq:
+                score += weight * freq * (k1 + 1) / (
+                    freq + k1 * (1 - b + b * length / avg_length))
+        scores.append(score)
+    return scores
+
+
+class ExtractiveCompressor:
+    """ Compresses the recalled chunks to their sentences most relevant to the query, without an LLM call.
+
+    The chunks are split into sentences with the separators of `MarkdownTextSplitter` and scored against
+    the query, by the cross-encoder of the reranker when it is loaded, otherwise by BM25. Each chunk keeps its
+    best sentence first, in the order of the chunks, then the best remaining sentences of any chunk are added
+    while they fit in the token budget. Each sentence comes with `window` sentences of context on both sides.
+    The budget is `keep_ratio` of the recalled tokens, and at least `min_token_budget`: chunks fitting in it
+    together are kept whole.
+    """
+    def __init__(self,
+                 keep_ratio: float = CONTEXT_COMPRESSION_KEEP_RATIO,
+                 min_token_budget: int = CONTEXT_COMPRESSION_MIN_TOKEN_BUDGET,
+                 window: int = CONTEXT_COMPRESSION_WINDOW) -> None:
+        self.keep_ratio = keep_ratio
+        self.min_token_budget = min_token_budget
+        self.window = window
+
+    def get_token_budget(self, tokens_before: int) -> int:
+        return max(int(tokens_before * self.keep_ratio), self.min_token_budget)
+
+    def score_sentences(self, query: str, sentences: List[str],
+                        use_cross_encoder: bool) -> List[float]:
+        if use_cross_encoder:
+            try:
+                scores = rerank_batcher.predict([[query, sentence]
+                                                 for sentence in sentences])
+                # Multi-logit models score each class, the last one is relevance
+                return [
+                    score[-1] if isinstance(score, list) else score
+                    for score in scores
+                ]
+            except Exception as e:
+                logger.error(
+                    f"[CONTEXT_COMPRESSION] score sentences with the cross-encoder failed, the exception is {e}"
+                )
+        return bm25_scores(query, sentences)
+
+    def select(self, sentence_tokens: List[List[int]],
+               ranked: List[Tuple[int, int]],
+               token_budget: int) -> List[Set[int]]:
+        selected: List[Set[int]] = [set() for _ in sentence_tokens]
+        used_tokens = 0
+        for chunk_index, sentence_index in ranked:
+            tokens = sentence_tokens[chunk_index]
+            window = range(max(sentence_index - self.window, 0),
+                           min(sentence_index + self.window + 1, len(tokens)))
+            # Fall back to the sentence alone when its context doesn't fit
+            for candidates in (window, [sentence_index]):
+                new_indexes = [
+                    i for i in candidates if i not in selected[chunk_index]
+                ]
+                cost = sum(tokens[i] for i in new_indexes)
+                if used_tokens + cost <= token_budget:
+                    selected[chunk_index].update(new_indexes)
+                    used_tokens += cost
+                    break
+        return selected
+
+    def compress(self, query: str, texts: List[str],
+                 use_cross_encoder: bool) -> List[str]:
+        """ Returns the compressed text of each chunk, empty for the chunks without any kept sentence.
+
+        Args:
+            query (str): The standalone query.
+            texts (List[str]): The texts of the chunks, from the most to the least relevant.
+            use_cross_encoder (bool): Whether the sentences are scored by the cross-encoder of the reranker.
+
+        Returns:
+            List[str]: The compressed texts, in the order of `texts`.
+        """
+        tokens_before = sum(estimate_tokens(text) for text in texts)
+        token_budget = self.get_token_budget(tokens_before)
+        if tokens_before <= token_budget:
+            metrics_client.incr(f"{METRIC_PREFIX}skipped")
+            return texts
+
+        beg_time = time.time()
+        sentence_lists = [split_sentences(text) for text in texts]
+        sentence_tokens = [[estimate_tokens(sentence) for sentence in sentences]
+                           for sentences in sentence_lists]
+        positions = [(chunk_index, sentence_index)
+                     for chunk_index, sentences in enumerate(sentence_lists)
+                     for sentence_index in range(len(sentences))]
+        flat_scores = self.score_sentences(
+            query, [sentence_lists[i][j] for i, j in positions],
+            use_cross_encoder)
+        scores: Dict[Tuple[int, int], float] = dict(zip(positions, flat_scores))
+
+        # The best sentence of each chunk first, then all the others by score
+        ranked = sorted(positions, key=lambda x: scores[x], reverse=True)
+        best_of_chunks: List[Tuple[int, int]] = []
+        seen_chunks: Set[int] = set()
+        for position in ranked:
+            if position[0] not in seen_chunks:
+                seen_chunks.add(position[0])
+                best_of_chunks.append(position)
+        best_of_chunks.sort()
+        selected = self.select(sentence_tokens, best_of_chunks + ranked,
+                               token_budget)
+        if not any(selected):
+            # Not even a single sentence fits, e.g. a long code block, the budget is exceeded rather than losing the context
+            metrics_client.incr(f"{METRIC_PREFIX}over_budget")
+            return texts
+
+        compressed_texts = []
+        for sentences, indexes in zip(sentence_lists, selected):
+            spans: List[str] = []
+            previous_index = None
+            for index in sorted(indexes):
+                if previous_index is not None and index == previous_index + 1:
+                    spans[-1] += sentences[index]
+                else:
+                    spans.append(sentences[index])
+                previous_index = index
+            compressed_texts.append(
+                GAP_MARKER.join(span.strip() for span in spans))
+
+        tokens_after = sum(estimate_tokens(text) for text in compressed_texts)
+        timecost = time.time() - beg_time
+        metrics_client.incr(f"{METRIC_PREFIX}calls")
+        metrics_client.incr(f"{METRIC_PREFIX}tokens_before", tokens_before)
+        metrics_client.incr(f"{METRIC_PREFIX}tokens_after", tokens_after)
+        metrics_client.incr(f"{METRIC_PREFIX}latency_ms", int(timecost * 1000))
+        logger.info(
+            f"[CONTEXT_COMPRESSION] for the query: '{query}', {len(positions)} sentences of {len(texts)} chunks, tokens: {tokens_before} -> {tokens_after}, the timecost is {timecost}"
+        )
+        return compressed_texts
+
+    def get_stats(self) -> Dict[str, float]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        calls = counters.get(f"{METRIC_PREFIX}calls", 0)
+        tokens_before = counters.get(f"{METRIC_PREFIX}tokens_before", 0)
+        tokens_after = counters.get(f"{METRIC_PREFIX}tokens_after", 0)
+        return {
+            "calls":
+            calls,
+            "skipped":
+            counters.get(f"{METRIC_PREFIX}skipped", 0),
+            "compression_ratio":
+            tokens_after / tokens_before if tokens_before else 1.0,
+            "tokens_saved":
+            tokens_before - tokens_after,
+            "avg_latency_ms":
+            counters.get(f"{METRIC_PREFIX}latency_ms", 0) /
+            calls if calls else 0.0
+        }
+
+
+# Initialize the extractive compressor
+extractive_compressor = ExtractiveCompressor()
@@ -0,0 +1,176 @@
+from typing import Any, Dict, List, Optional, Tuple
+from langchain.schema.document import Document
+from server.app.utils.diskcache_client import diskcache_client
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (SESSION_EXPIRE_TIME,
+                                       CONVERSATION_REUSE_MIN_TERM_COVERAGE,
+                                       CONVERSATION_REUSE_SCORE_DECAY)
+from server.logger.logger_config import my_logger as logger
+from server.rag.index.embedder.document_embedder import get_kb_version
+from server.rag.post_retrieval.compression.extractive_compressor import get_terms
+from server.rag.pre_retrieval.query_transformation.refine_classifier import refine_classifier
+from server.rag.retrieval.vector_search import vector_search
+
+METRIC_PREFIX = "retrieval_memory:"
+
+# The reasons of `RefineClassifier` for a query that leans on the previous turn
+FOLLOW_UP_REASONS = {'anaphora', 'follow_up', 'ellipsis'}
+
+# Words that don't carry the topic of a follow-up
+STOP_WORDS_EN = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'been', 'do', 'does',
+    'did', 'can', 'could', 'should', 'would', 'will', 'may', 'might', 'must',
+    'i', 'me', 'my', 'we', 'our', 'you', 'your', 'it', 'its', 'this', 'that',
+    'these', 'those', 'they', 'them', 'their', 'he', 'she', 'his', 'her',
+    'and', 'or', 'but', 'so', 'then', 'also', 'too', 'of', 'to', 'in', 'on',
+    'at', 'for', 'with', 'by', 'from', 'about', 'as', 'into', 'how', 'what',
+    'why', 'when', 'where', 'which', 'who', 'whom', 'there', 'here', 'more',
+    'other', 'another', 'else', 'same', 'such', 'one', 'ones', 'if', 'not',
+    'no', 'yes', 'please', 'tell', 'explain', 'detail', 'details', 'mean',
+    'example', 'examples', 'again', 'any', 'some', 'all', 'way', 'ways'
+}
+STOP_CHARS_ZH = set('的了吗呢吧啊呀么是在有和与或也还就都又再这那它他她其该此个些怎什为如何请问能可以会要我你们')
+
+
+class RetrievalMemory:
+    """ Remembers the documents of the previous turn of each user, so that follow-up questions can reuse them.
+
+    The metadata ids and recall scores of the documents put in the prompt are kept in Diskcache next to the
+    query history, split by streaming mode like it, and expire with the session. Only a follow-up leaning on
+    the previous turn (according to `RefineClassifier`) with an unchanged knowledge base uses them. If its
+    content words mostly appear in the previous question or documents, it is on the same topic: its documents
+    are fetched by id and the fresh recall, with its embedding call, is skipped. Otherwise the previous
+    documents are merged with the fresh recall, with decayed scores.
+    """
+    def get_key(self, user_id: str, is_streaming: bool) -> str:
+        if is_streaming:
+            return f"open_kf:retrieval_memory:{user_id}:stream"
+        return f"open_kf:retrieval_memory:{user_id}"
+
+    def save(self, user_id: str, is_streaming: bool, query: str,
+             results: List[Tuple[Document, float]]) -> None:
+        """ Remembers the documents of this turn, from the most to the least relevant. """
+        key = self.get_key(user_id, is_streaming)
+        try:
+            if not results:
+                # Nothing to reuse, and the documents of an older turn are off topic now
+                diskcache_client.delete(key)
+                return
+            memory = {
+                "query": query,
+                "kb_version": get_kb_version(),
+                "chunks": [{
+                    "id": doc.metadata["id"],
+                    "score": score
+                } for doc, score in results if "id" in doc.metadata]
+            }
+            diskcache_client.set(key, memory, ttl=SESSION_EXPIRE_TIME)
+        except Exception as e:
+            logger.error(
+                f"[RETRIEVAL_MEMORY] save for user_id: '{user_id}' failed, the exception is {e}"
+            )
+
+    def load(self, user_id: str,
+             is_streaming: bool) -> Optional[Dict[str, Any]]:
+        try:
+            return diskcache_client.get(self.get_key(user_id, is_streaming))
+        except Exception as e:
+            logger.error(
+                f"[RETRIEVAL_MEMORY] load for user_id: '{user_id}' failed, the exception is {e}"
+            )
+            return None
+
+    def fetch_results(
+            self, memory: Dict[str, Any]) -> List[Tuple[Document, float]]:
+        chunks = memory["chunks"]
+        docs = vector_search.get_documents_by_chunk_ids(
+            [chunk["id"] for chunk in chunks])
+        return [(docs[chunk["id"]], chunk["score"]) for chunk in chunks
+                if chunk["id"] in docs]
+
+    def get_term_coverage(self, query: str, previous_query: str,
+                          previous_results: List[Tuple[Document,
+                                                       float]]) -> float:
+        terms = {
+            term
+            for term in get_terms(query)
+            if term not in STOP_WORDS_EN and term not in STOP_CHARS_ZH
+        }
+        if not terms:
+            return 1.0
+        known_terms = set(get_terms(previous_query))
+        for doc, _ in previous_results:
+            known_terms.update(get_terms(doc.page_content))
+        return len(terms & known_terms) / len(terms)
+
+    def get_previous_results(
+            self, user_id: str, is_streaming: bool, query: str,
+            history_session: List[Any]
+    ) -> Tuple[List[Tuple[Document, float]], bool]:
+        """ Returns the documents of the previous turn, and whether the query is on the same topic.
+
+        Args:
+            user_id (str): The user.
+            is_streaming (bool): Whether the session is the streaming one.
+            query (str): The current query, before refinement.
+            history_session (List[Any]): The history of the session.
+
+        Returns:
+            Tuple[List[Tuple[Document, float]], bool]: The previous documents with their recall scores, empty
+                unless the query is a follow-up, and whether they can replace the fresh recall.
+        """
+        if not history_session:
+            return [], False
+        _, reason = refine_classifier.classify(query, history_session)
+        if reason not in FOLLOW_UP_REASONS:
+            # A new question doesn't inherit the documents of the previous turn
+            return [], False
+        memory = self.load(user_id, is_streaming)
+        # The documents and scores of a changed knowledge base are stale
+        if not memory or memory["kb_version"] != get_kb_version():
+            return [], False
+        try:
+            previous_results = self.fetch_results(memory)
+        except Exception as e:
+            logger.error(
+                f"[RETRIEVAL_MEMORY] fetch the documents of user_id: '{user_id}' failed, the exception is {e}"
+            )
+            return [], False
+        if not previous_results:
+            return [], False
+
+        coverage = self.get_term_coverage(query, memory["query"],
+                                          previous_results)
+        is_same_topic = coverage >= CONVERSATION_REUSE_MIN_TERM_COVERAGE
+
+        if is_same_topic:
+            metrics_client.incr(f"{METRIC_PREFIX}reused")
+        else:
+            metrics_client.incr(f"{METRIC_PREFIX}merged")
+        logger.info(
+            f"[RETRIEVAL_MEMORY] for the query: '{query}', the previous query is '{memory['query']}', reason: '{reason}', coverage: {coverage:.2f}, is_same_topic: {is_same_topic}"
+        )
+        return previous_results, is_same_topic
+
+    def merge(self, results: List[Tuple[Document, float]],
+              previous_results: List[Tuple[Document, float]],
+              min_relevance_score: float) -> List[Tuple[Document, float]]:
+        """ Adds the previous documents missing from the fresh recall, with decayed scores. """
+        merged = list(results)
+        chunk_ids = {doc.metadata.get("id") for doc, _ in results}
+        for doc, score in previous_results:
+            decayed_score = score * CONVERSATION_REUSE_SCORE_DECAY
+            if doc.metadata["id"] not in chunk_ids and decayed_score >= min_relevance_score:
+                merged.append((doc, decayed_score))
+        return merged
+
+    def get_stats(self) -> Dict[str, int]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        return {
+            "reused": counters.get(f"{METRIC_PREFIX}reused", 0),
+            "merged": counters.get(f"{METRIC_PREFIX}merged", 0)
+        }
+
+
+# Initialize the retrieval memory
+retrieval_memory = RetrievalMemory()
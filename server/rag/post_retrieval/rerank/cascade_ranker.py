@@ -0,0 +1,93 @@
+import time
+from typing import Any, Dict, List
+from server.app.utils.lazy_singleton import LazySingleton
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (RERANK_CASCADE_FIRST_STAGE_MODEL,
+                                       RERANK_CASCADE_TOP_M)
+from server.logger.logger_config import my_logger as logger
+from server.rag.post_retrieval.rerank.flash_ranker import Ranker, RerankRequest
+from server.rag.post_retrieval.rerank.rerank_batcher import RerankBatcher, rerank_batcher
+
+METRIC_PREFIX = "rerank_cascade:"
+
+
+class CascadeRanker:
+    """ Two-stage re-ranking: a cheap model scores all candidates and a heavier model rescores the top survivors.
+
+    The survivors come first, ordered by the second stage score, followed by the other candidates in
+    first stage order. The latency of each stage and the first stage rank of the final top-1 are recorded,
+    so that `RERANK_RECALL_TOP_K` and `RERANK_CASCADE_TOP_M` can be tuned to the CPU budget.
+    """
+    def __init__(self, first_stage: RerankBatcher, second_stage: RerankBatcher,
+                 top_m: int) -> None:
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+        self.top_m = top_m
+
+    def rerank(self, request: RerankRequest) -> List[Dict[str, Any]]:
+        beg_time = time.time()
+        first_results = self.first_stage.rerank(request)
+        first_stage_ms = (time.time() - beg_time) * 1000
+
+        for rank, passage in enumerate(first_results):
+            passage["first_stage_rank"] = rank
+            passage["first_stage_score"] = passage["score"]
+        survivors = first_results[:self.top_m]
+
+        beg_time = time.time()
+        second_results = self.second_stage.rerank(
+            RerankRequest(query=request.query, passages=survivors))
+        second_stage_ms = (time.time() - beg_time) * 1000
+
+        logger.info(
+            f"[RERANK_CASCADE] query: '{request.query}', first stage: {len(first_results)} pairs in {first_stage_ms:.1f}ms, second stage: {len(survivors)} pairs in {second_stage_ms:.1f}ms"
+        )
+        metrics_client.incr(f"{METRIC_PREFIX}calls")
+        metrics_client.incr(f"{METRIC_PREFIX}first_stage_pairs",
+                            len(first_results))
+        metrics_client.incr(f"{METRIC_PREFIX}first_stage_ms",
+                            int(first_stage_ms))
+        if second_results:
+            metrics_client.incr(f"{METRIC_PREFIX}second_stage_pairs",
+                                len(survivors))
+            metrics_client.incr(f"{METRIC_PREFIX}second_stage_ms",
+                                int(second_stage_ms))
+            # Top-1 often coming from the last survivors means `top_m` is too small
+            metrics_client.incr(
+                f"{METRIC_PREFIX}top1_first_stage_rank:{second_results[0]['first_stage_rank']}"
+            )
+
+        return second_results + first_results[self.top_m:]
+
+    def get_stats(self) -> Dict[str, Any]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        calls = counters.get(f"{METRIC_PREFIX}calls", 0)
+        rank_prefix = f"{METRIC_PREFIX}top1_first_stage_rank:"
+        return {
+            "calls":
+            calls,
+            "top_m":
+            self.top_m,
+            "avg_first_stage_ms":
+            counters.get(f"{METRIC_PREFIX}first_stage_ms", 0) /
+            calls if calls else 0.0,
+            "avg_second_stage_ms":
+            counters.get(f"{METRIC_PREFIX}second_stage_ms", 0) /
+            calls if calls else 0.0,
+            "top1_first_stage_rank": {
+                int(name[len(rank_prefix):]): value
+                for name, value in counters.items()
+                if name.startswith(rank_prefix)
+            }
+        }
+
+
+# Initialize the cascade ranker, the models are loaded on first use in the 'cascade' mode
+first_stage_reranker = LazySingleton(
+    'first_stage_reranker', lambda: Ranker(RERANK_CASCADE_FIRST_STAGE_MODEL))
+first_stage_rerank_batcher = LazySingleton(
+    'first_stage_rerank_batcher',
+    lambda: RerankBatcher(first_stage_reranker))
+cascade_ranker = LazySingleton(
+    'cascade_ranker', lambda: CascadeRanker(
+        first_stage_rerank_batcher, rerank_batcher, RERANK_CASCADE_TOP_M))
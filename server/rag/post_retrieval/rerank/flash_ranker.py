@@ -4,24 +4,114 @@ Source: https://github.com/PrithivirajDamodaran/FlashRank/blob/main/flashrank/Ra
 
 import collections
 import json
+import os
 from pathlib import Path
 import sys
-from typing import Optional, List, Dict, Any
+from threading import Lock
+from typing import Callable, Optional, List, Dict, Any, OrderedDict, Tuple
 import numpy as np
 import onnxruntime as ort
 from tokenizers import AddedToken, Tokenizer
-from server.constant.constants import RERANK_MODEL_NAME
+from server.app.utils.hash import generate_md5
+from server.app.utils.lazy_singleton import LazySingleton
+from server.constant.constants import (
+    RERANK_MODEL_NAME, SERVER_WORKER_COUNT, RERANK_INTRA_OP_NUM_THREADS,
+    RERANK_INTER_OP_NUM_THREADS, RERANK_GRAPH_OPTIMIZATION_LEVEL,
+    RERANK_ENABLE_CPU_MEM_ARENA, RERANK_CACHE_OPTIMIZED_MODEL,
+    RERANK_USE_IO_BINDING, RERANK_MODEL_PRECISION,
+    RERANK_MIN_PADDING_EFFICIENCY, RERANK_PASSAGE_TOKEN_CACHE_SIZE,
+    RERANK_MAX_LENGTH, RERANK_PASSAGE_WINDOW_TOKENS)
 from server.logger.logger_config import my_logger as logger
+from server.rag.post_retrieval.rerank.rerank_score_cache import rerank_score_cache
 
 default_cache_dir = "server/rag/post_retrieval/rerank/tmp_cache"
 #default_model = "ms-marco-TinyBERT-L-2-v2"
 default_model = RERANK_MODEL_NAME
 model_file_map = {
-    "ms-marco-TinyBERT-L-2-v2": "flashrank-TinyBERT-L-2-v2.onnx",
-    "ms-marco-MiniLM-L-12-v2": "flashrank-MiniLM-L-12-v2_Q.onnx"
+    "ms-marco-TinyBERT-L-2-v2": {
+        "fp32": "flashrank-TinyBERT-L-2-v2.onnx",
+        "int8": "flashrank-TinyBERT-L-2-v2_Q.onnx"
+    },
+    "ms-marco-MiniLM-L-12-v2": {
+        "fp32": "flashrank-MiniLM-L-12-v2.onnx",
+        "int8": "flashrank-MiniLM-L-12-v2_Q.onnx"
+    }
 }
 
 
+def get_window_start(hits: np.ndarray, window: int) -> int:
+    """ Returns the start of the window of `window` tokens with the most query tokens.
+
+    The matches are centered among the best starts of the first matching region, the midpoint of two
+    separate regions would fall between them.
+
+    Args:
+        hits (np.ndarray): 1 for the passage tokens found in the query, 0 otherwise.
+        window (int): The number of tokens to keep, shorter than the passage.
+
+    Returns:
+        int: The position of the first token of the window.
+    """
+    cumsum = np.concatenate(([0], np.cumsum(hits)))
+    # The number of query tokens in the window starting at each position
+    counts = cumsum[window:] - cumsum[:-window]
+    best = np.flatnonzero(counts == counts.max())
+    gaps = np.flatnonzero(np.diff(best) > 1)
+    run_end = int(gaps[0]) if len(gaps) else len(best) - 1
+    return int(best[0] + best[run_end]) // 2
+
+
+graph_optimization_level_map = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+
+
+class RuntimeProfile:
+    """ The ONNX Runtime execution settings of a Ranker.
+
+    Attributes:
+        intra_op_num_threads (int): Threads used inside an operator, 0 means the CPU cores divided by the worker processes.
+        inter_op_num_threads (int): Threads used to run independent operators in parallel.
+        graph_optimization_level (str): 'disable', 'basic', 'extended' or 'all'.
+        enable_cpu_mem_arena (bool): Whether freed memory is kept in an arena for reuse.
+        cache_optimized_model (bool): Whether the optimized graph is serialized and loaded on the next start.
+        use_io_binding (bool): Whether inputs are bound to reused buffers with IO binding.
+        precision (str): 'fp32' or 'int8', the preferred model file in `model_file_map`.
+    """
+    def __init__(self,
+                 intra_op_num_threads: int = RERANK_INTRA_OP_NUM_THREADS,
+                 inter_op_num_threads: int = RERANK_INTER_OP_NUM_THREADS,
+                 graph_optimization_level: str = RERANK_GRAPH_OPTIMIZATION_LEVEL,
+                 enable_cpu_mem_arena: bool = RERANK_ENABLE_CPU_MEM_ARENA,
+                 cache_optimized_model: bool = RERANK_CACHE_OPTIMIZED_MODEL,
+                 use_io_binding: bool = RERANK_USE_IO_BINDING,
+                 precision: str = RERANK_MODEL_PRECISION):
+        if graph_optimization_level not in graph_optimization_level_map:
+            raise ValueError(
+                f"Unsupported graph_optimization_level '{graph_optimization_level}'. Must be in {list(graph_optimization_level_map)}."
+            )
+        if precision not in ["fp32", "int8"]:
+            raise ValueError(
+                f"Unsupported precision '{precision}'. Must be in ['fp32', 'int8']."
+            )
+        if intra_op_num_threads <= 0:
+            intra_op_num_threads = max(
+                1, (os.cpu_count() or 1) // SERVER_WORKER_COUNT)
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self.graph_optimization_level = graph_optimization_level
+        self.enable_cpu_mem_arena = enable_cpu_mem_arena
+        self.cache_optimized_model = cache_optimized_model
+        self.use_io_binding = use_io_binding
+        self.precision = precision
+
+    def __repr__(self) -> str:
+        return f"RuntimeProfile({', '.join(f'{k}={v!r}' for k, v in vars(self).items())})"
+
+
 class RerankRequest:
     """ Represents a reranking request with a query and a list of passages. 
 
@@ -49,20 +139,192 @@ class Ranker:
     def __init__(self,
                  model_name: str = default_model,
                  cache_dir: str = default_cache_dir,
-                 max_length: int = 512):
+                 max_length: int = RERANK_MAX_LENGTH,
+                 profile: Optional[RuntimeProfile] = None,
+                 passage_window_tokens: int = RERANK_PASSAGE_WINDOW_TOKENS):
         """ Initializes the Ranker class with specified model and cache settings.
 
         Args:
             model_name (str): The name of the model to be used.
             cache_dir (str): The directory where models are cached.
             max_length (int): The maximum length of the tokens.
+            profile (Optional[RuntimeProfile]): The ONNX Runtime settings, defaults to the constants.
+            passage_window_tokens (int): Trim each passage to its window of this many tokens with the most query tokens, 0 to disable.
         """
+        self.model_name: str = model_name
         self.cache_dir: Path = Path(cache_dir)
         self.model_dir: Path = self.cache_dir / model_name
+        self.profile: RuntimeProfile = profile or RuntimeProfile()
         self._prepare_model_dir(model_name)
-        model_file = model_file_map[model_name]
-        self.session = ort.InferenceSession(str(self.model_dir / model_file))
+        self.model_file: Path = self._select_model_file(model_name)
+        self.model_optimized: bool = False
+        # The model is kept in memory, so a forked worker process rebuilds its session without reading the disk
+        self.model_bytes: bytes = self._load_model_bytes()
         self.tokenizer: Tokenizer = self._get_tokenizer(max_length)
+        self.min_padding_efficiency: float = RERANK_MIN_PADDING_EFFICIENCY
+        self._init_token_cache()
+        if passage_window_tokens and self.special_token_ids is None:
+            # Pairs encoded by the tokenizer as a whole are truncated by it, there is no passage to window
+            logger.warning(
+                f"[RANKER] the pair template of '{model_name}' is not supported, passage windowing is disabled"
+            )
+            passage_window_tokens = 0
+        self.passage_window_tokens: int = passage_window_tokens
+        # Scores depend on the precision of the model file actually loaded and on how passages are cut,
+        # keep them apart in the score cache
+        self.score_cache_name: str = f"{model_name}_{self.profile.precision}"
+        if self.max_length != 512 or passage_window_tokens:
+            self.score_cache_name += f"_len{self.max_length}_win{passage_window_tokens}"
+        self._init_session()
+        logger.info(
+            f"[RANKER] init, model_file: '{self.model_file}', optimized: {self.model_optimized}, profile: {self.profile}"
+        )
+
+    def _init_session(self) -> None:
+        self.session = self._create_session()
+        self.io_binding_lock = Lock()
+        self.io_binding: Optional[ort.IOBinding] = None
+        self.input_buffers: Dict[str, np.ndarray] = {}
+        if self.profile.use_io_binding:
+            self.io_binding = self.session.io_binding()
+
+    def reinit_after_fork(self) -> None:
+        """ Rebuilds the ONNX Runtime session in a forked process.
+
+        The thread pools of a session don't survive a fork. The model bytes and the tokenizer loaded by
+        the parent are reused, and stay shared copy-on-write with it.
+        """
+        self.passage_token_cache_lock = Lock()
+        self._init_session()
+
+    def _init_token_cache(self) -> None:
+        """ Prepares building the cross-encoder input from separately tokenized queries and passages.
+
+        Passages are static chunks, their token ids are kept in an LRU so only the query is tokenized per
+        request. The special tokens are found by encoding a probe pair; if the pair template isn't
+        `[CLS] A [SEP] B [SEP]`, every pair is encoded by the tokenizer as a whole instead.
+        """
+        self.segment_tokenizer: Tokenizer = Tokenizer.from_str(
+            self.tokenizer.to_str())
+        self.segment_tokenizer.no_padding()
+        self.segment_tokenizer.no_truncation()
+        self.max_length: int = self.tokenizer.truncation["max_length"]
+        self.pad_id: int = self.tokenizer.padding["pad_id"]
+        self.passage_token_cache: OrderedDict[str, np.ndarray] = collections.OrderedDict()
+        self.passage_token_cache_size: int = RERANK_PASSAGE_TOKEN_CACHE_SIZE
+        self.passage_token_cache_lock = Lock()
+        # Marks the word piece ids that continue a word and the punctuation ids. A passage window
+        # never starts on a continuation, and neither of them is counted as a query term
+        vocab = self.segment_tokenizer.get_vocab()
+        self.continuation_mask: np.ndarray = np.zeros(max(vocab.values()) + 1,
+                                                      dtype=bool)
+        self.punctuation_mask: np.ndarray = np.zeros(max(vocab.values()) + 1,
+                                                     dtype=bool)
+        for token, index in vocab.items():
+            if token.startswith("##"):
+                self.continuation_mask[index] = True
+            elif not any(c.isalnum() for c in token):
+                self.punctuation_mask[index] = True
+
+        # The ids of [CLS], the first [SEP] and the last [SEP]
+        self.special_token_ids: Optional[List[int]] = None
+        pair = self.tokenizer.encode("what is it", "a probe passage")
+        first, second = [
+            e.ids for e in self.segment_tokenizer.encode_batch(
+                ["what is it", "a probe passage"], add_special_tokens=False)
+        ]
+        ids = pair.ids
+        n1, n2 = len(first), len(second)
+        if (len(ids) == n1 + n2 + 3 and ids[1:1 + n1] == first
+                and ids[2 + n1:2 + n1 + n2] == second and pair.type_ids
+                == [0] * (n1 + 2) + [1] * (n2 + 1)):
+            self.special_token_ids = [ids[0], ids[1 + n1], ids[-1]]
+        else:
+            logger.warning(
+                f"[RANKER] the pair template of '{self.model_name}' is not supported, passage tokens are not cached"
+            )
+
+    def _select_model_file(self, model_name: str) -> Path:
+        """ Selects the model file of the preferred precision, or the other precision if it is missing.
+
+        Args:
+            model_name (str): The name of the model.
+
+        Returns:
+            Path: The path of the model file.
+        """
+        files = model_file_map[model_name]
+        preferred = self.profile.precision
+        fallback = "fp32" if preferred == "int8" else "int8"
+        for precision in [preferred, fallback]:
+            model_file = self.model_dir / files[precision]
+            if model_file.exists():
+                if precision != preferred:
+                    logger.warning(
+                        f"[RANKER] '{files[preferred]}' not found, use the {precision} model '{model_file}'"
+                    )
+                    self.profile.precision = precision
+                return model_file
+        logger.error(
+            f"Model file of '{model_name}' not found in '{self.model_dir}'!")
+        sys.exit(-1)
+
+    def _load_model_bytes(self) -> bytes:
+        """ Reads the model file into memory.
+
+        With `cache_optimized_model`, the optimized graph is saved next to the model file on the first start
+        and read instead of the model file afterwards, so it is not optimized again.
+
+        Returns:
+            bytes: The serialized model.
+        """
+        profile = self.profile
+        model_file = self.model_file
+        if profile.cache_optimized_model and profile.graph_optimization_level != "disable":
+            optimized_file = model_file.with_name(
+                f"{model_file.stem}.{profile.graph_optimization_level}.opt.onnx"
+            )
+            if not optimized_file.exists():
+                # Several processes may start at once, write to a private file and rename it
+                tmp_file = optimized_file.with_name(
+                    f"{optimized_file.name}.{os.getpid()}.tmp")
+                sess_options = self._get_session_options()
+                sess_options.optimized_model_filepath = str(tmp_file)
+                ort.InferenceSession(str(model_file), sess_options)
+                try:
+                    os.replace(tmp_file, optimized_file)
+                    logger.info(
+                        f"[RANKER] saved the optimized model to '{optimized_file}'"
+                    )
+                except OSError as e:
+                    logger.error(
+                        f"[RANKER] save the optimized model failed, the exception is {e}"
+                    )
+            if optimized_file.exists():
+                model_file = optimized_file
+                self.model_optimized = True
+        return model_file.read_bytes()
+
+    def _get_session_options(self) -> ort.SessionOptions:
+        profile = self.profile
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = profile.intra_op_num_threads
+        sess_options.inter_op_num_threads = profile.inter_op_num_threads
+        sess_options.enable_cpu_mem_arena = profile.enable_cpu_mem_arena
+        sess_options.graph_optimization_level = graph_optimization_level_map[
+            profile.graph_optimization_level]
+        return sess_options
+
+    def _create_session(self) -> ort.InferenceSession:
+        """ Creates the ONNX Runtime session from the model bytes according to the runtime profile.
+
+        Returns:
+            ort.InferenceSession: The ONNX runtime session.
+        """
+        sess_options = self._get_session_options()
+        if self.model_optimized:
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return ort.InferenceSession(self.model_bytes, sess_options)
 
     def _prepare_model_dir(self, model_name: str):
         """ Ensures the model directory is prepared by downloading and extracting the model if not present.
@@ -130,11 +392,18 @@ class Ranker:
             vocab[token] = index
         return vocab
 
-    def rerank(self, request: RerankRequest) -> List[Dict[str, Any]]:
+    def rerank(
+        self,
+        request: RerankRequest,
+        predict: Optional[Callable[[List[List[str]]], List[float]]] = None
+    ) -> List[Dict[str, Any]]:
         """ Reranks a list of passages based on a query using a pre-trained model.
 
+        Cached scores are reused, only the missed pairs are scored by the model.
+
         Args:
             request (RerankRequest): The request containing the query and passages to rerank.
+            predict (Optional[Callable[[List[List[str]]], List[float]]]): Scores the missed pairs, defaults to `self.predict`.
 
         Returns:
             List[Dict[str, Any]]: The reranked list of passages with added scores.
@@ -143,36 +412,261 @@ class Ranker:
         passages = request.passages
 
         #logger.info("Running pairwise ranking..")
-        query_passage_pairs = [[query, passage["text"]]
-                               for passage in passages]
+        scores = rerank_score_cache.cached_predict(
+            self.score_cache_name, query, [passage["text"] for passage in passages],
+            predict or self.predict)
 
-        input_text = self.tokenizer.encode_batch(query_passage_pairs)
-        input_ids = np.array([e.ids for e in input_text])
-        token_type_ids = np.array([e.type_ids for e in input_text])
-        attention_mask = np.array([e.attention_mask for e in input_text])
+        for score, passage in zip(scores, passages):
+            passage["score"] = score
+
+        passages.sort(key=lambda x: x["score"], reverse=True)
+        return passages
+
+    def predict(self, query_passage_pairs: List[List[str]]) -> List[float]:
+        """ Scores query-passage pairs, running one tightly padded inference per length bucket.
+
+        Args:
+            query_passage_pairs (List[List[str]]): The [query, passage] pairs, possibly from different queries.
+
+        Returns:
+            List[float]: The relevance scores, in the order of the pairs.
+        """
+        if not query_passage_pairs:
+            return []
+        if self.special_token_ids is not None:
+            input_ids, token_type_ids, attention_mask = self._build_inputs(
+                query_passage_pairs)
+        else:
+            input_text = self.tokenizer.encode_batch(query_passage_pairs)
+            input_ids = np.array([e.ids for e in input_text], dtype=np.int64)
+            token_type_ids = np.array([e.type_ids for e in input_text],
+                                      dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in input_text],
+                                      dtype=np.int64)
 
         use_token_type_ids = token_type_ids is not None and not np.all(
             token_type_ids == 0)
 
-        onnx_input = {
-            "input_ids": input_ids.astype(np.int64),
-            "attention_mask": attention_mask.astype(np.int64)
-        }
-        if use_token_type_ids:
-            onnx_input["token_type_ids"] = token_type_ids.astype(np.int64)
+        lengths = attention_mask.sum(axis=1)
+        buckets = self._split_into_buckets(lengths)
+
+        logits = None
+        for bucket in buckets:
+            # Padding is on the right, so the columns beyond the longest pair of the bucket are all padding
+            max_length = int(lengths[bucket].max())
+            onnx_input = {
+                "input_ids":
+                np.ascontiguousarray(input_ids[bucket, :max_length]),
+                "attention_mask":
+                np.ascontiguousarray(attention_mask[bucket, :max_length])
+            }
+            if use_token_type_ids:
+                onnx_input["token_type_ids"] = np.ascontiguousarray(
+                    token_type_ids[bucket, :max_length])
+
+            if self.io_binding is not None:
+                outputs = self._run_with_io_binding(onnx_input)
+            else:
+                outputs = self.session.run(None, onnx_input)
+
+            if logits is None:
+                logits = np.empty((len(lengths), ) + outputs[0].shape[1:],
+                                  dtype=outputs[0].dtype)
+            logits[bucket] = outputs[0]
+
+        real_tokens = int(lengths.sum())
+        logger.debug(
+            f"[RANKER] predict, pairs: {len(lengths)}, buckets: {len(buckets)}, padding efficiency: {real_tokens / input_ids.size:.2%} -> {real_tokens / sum(len(b) * lengths[b].max() for b in buckets):.2%}"
+        )
+
+        scores = np.exp(logits) / (
+            1 + np.exp(logits)) if logits.shape[1] > 1 else np.exp(
+                logits.flatten()) / (1 + np.exp(logits.flatten()))
+        return scores.tolist()
+
+    def _build_inputs(
+        self, query_passage_pairs: List[List[str]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Builds `[CLS] query [SEP] passage [SEP]` inputs from the token ids of the queries and the cached passages.
+
+        The result is the same as encoding the pairs with the tokenizer, including its 'longest_first' truncation.
 
-        outputs = self.session.run(None, onnx_input)
+        Args:
+            query_passage_pairs (List[List[str]]): The [query, passage] pairs.
 
-        scores = np.exp(outputs[0]) / (
-            1 + np.exp(outputs[0])) if outputs[0].shape[1] > 1 else np.exp(
-                outputs[0].flatten()) / (1 + np.exp(outputs[0].flatten()))
-        scores = scores.tolist()
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: input_ids, token_type_ids and attention_mask, padded on the right.
+        """
+        # Room left for the sequences after the 3 special tokens
+        budget = self.max_length - 3
+        queries = list(dict.fromkeys(query for query, _ in query_passage_pairs))
+        query_ids = dict(zip(queries, self._encode_segments(queries)))
+        passage_ids = self._get_passage_ids(
+            [passage for _, passage in query_passage_pairs])
+
+        segments = []
+        for (query, _), p_ids in zip(query_passage_pairs, passage_ids):
+            q_ids = query_ids[query]
+            if self.passage_window_tokens:
+                window = min(self.passage_window_tokens,
+                             max(budget - len(q_ids), 1))
+                p_ids = self._select_window(q_ids, p_ids, window)
+            n1, n2 = self._truncate_longest_first(len(q_ids), len(p_ids),
+                                                  budget)
+            segments.append((q_ids[:n1], p_ids[:n2]))
+
+        cls_id, sep_id, last_sep_id = self.special_token_ids
+        width = max(len(q) + len(p) for q, p in segments) + 3
+        input_ids = np.full((len(segments), width), self.pad_id, dtype=np.int64)
+        token_type_ids = np.zeros((len(segments), width), dtype=np.int64)
+        attention_mask = np.zeros((len(segments), width), dtype=np.int64)
+        for i, (q_ids, p_ids) in enumerate(segments):
+            n1, n2 = len(q_ids), len(p_ids)
+            end = n1 + n2 + 3
+            input_ids[i, 0] = cls_id
+            input_ids[i, 1:1 + n1] = q_ids
+            input_ids[i, 1 + n1] = sep_id
+            input_ids[i, 2 + n1:2 + n1 + n2] = p_ids
+            input_ids[i, end - 1] = last_sep_id
+            token_type_ids[i, 2 + n1:end] = 1
+            attention_mask[i, :end] = 1
+        return input_ids, token_type_ids, attention_mask
+
+    def _select_window(self, q_ids: np.ndarray, p_ids: np.ndarray,
+                       window: int) -> np.ndarray:
+        """ Selects the window of the passage with the most occurrences of query tokens.
+
+        Without windowing the tokenizer keeps the beginning of a long passage, and the relevant text at
+        its end is lost.
 
-        for score, passage in zip(scores, passages):
-            passage["score"] = score
+        Args:
+            q_ids (np.ndarray): The token ids of the query.
+            p_ids (np.ndarray): The token ids of the passage.
+            window (int): The number of tokens to keep.
 
-        passages.sort(key=lambda x: x["score"], reverse=True)
-        return passages
+        Returns:
+            np.ndarray: The token ids of the window, or the passage if it already fits.
+        """
+        if len(p_ids) <= window:
+            return p_ids
+        # Pieces like '##er' are too common to tell where the query terms are
+        q_terms = q_ids[~(self.punctuation_mask[q_ids]
+                          | self.continuation_mask[q_ids])]
+        hits = np.isin(p_ids, q_terms).astype(np.int64)
+        if not hits.any():
+            return p_ids[:window]
+        start = get_window_start(hits, window)
+        # Don't cut a word in the middle
+        while start > 0 and self.continuation_mask[p_ids[start]]:
+            start -= 1
+        return p_ids[start:start + window]
+
+    @staticmethod
+    def _truncate_longest_first(n1: int, n2: int,
+                                budget: int) -> Tuple[int, int]:
+        """ Returns the lengths kept by the 'longest_first' truncation of the tokenizer for a pair. """
+        if n1 + n2 <= budget:
+            return n1, n2
+        swap = n1 > n2
+        if swap:
+            n1, n2 = n2, n1
+        n2 = n1 if n1 > budget else max(n1, budget - n1)
+        if n1 + n2 > budget:
+            n1 = budget // 2
+            n2 = n1 + budget % 2
+        return (n2, n1) if swap else (n1, n2)
+
+    def _encode_segments(self, texts: List[str]) -> List[np.ndarray]:
+        # Not truncated here, the truncation of a pair depends on which sequence is longer
+        return [
+            np.array(e.ids, dtype=np.int64) for e in
+            self.segment_tokenizer.encode_batch(texts, add_special_tokens=False)
+        ]
+
+    def _get_passage_ids(self, passages: List[str]) -> List[np.ndarray]:
+        """ Gets the token ids of the passages from the LRU, tokenizing the missed ones. """
+        keys = [generate_md5(passage.encode('utf-8')) for passage in passages]
+        passage_ids: List[Optional[np.ndarray]] = []
+        with self.passage_token_cache_lock:
+            for key in keys:
+                ids = self.passage_token_cache.get(key)
+                if ids is not None:
+                    self.passage_token_cache.move_to_end(key)
+                passage_ids.append(ids)
+
+        missed_index_list = [
+            i for i, ids in enumerate(passage_ids) if ids is None
+        ]
+        if missed_index_list:
+            encoded = self._encode_segments(
+                [passages[i] for i in missed_index_list])
+            with self.passage_token_cache_lock:
+                for i, ids in zip(missed_index_list, encoded):
+                    passage_ids[i] = ids
+                    self.passage_token_cache[keys[i]] = ids
+                while len(self.passage_token_cache
+                          ) > self.passage_token_cache_size:
+                    self.passage_token_cache.popitem(last=False)
+        logger.debug(
+            f"[RANKER] passage token cache, hit: {len(passages) - len(missed_index_list)}, miss: {len(missed_index_list)}"
+        )
+        return passage_ids
+
+    def _split_into_buckets(self, lengths: np.ndarray) -> List[np.ndarray]:
+        """ Groups the pairs by token length, so that little padding is needed within a bucket.
+
+        The pairs are sorted by length and a longer pair starts a new bucket when adding it would drop
+        the ratio of real tokens to padded tokens of the bucket below `min_padding_efficiency`.
+
+        Args:
+            lengths (np.ndarray): The token length of each pair.
 
+        Returns:
+            List[np.ndarray]: The indexes of the pairs in each bucket.
+        """
+        buckets: List[np.ndarray] = []
+        order = np.argsort(lengths, kind="stable")
+        begin = 0
+        real_tokens = 0
+        for i, index in enumerate(order):
+            length = int(lengths[index])
+            if i > begin and (real_tokens + length) < (
+                    i - begin + 1) * length * self.min_padding_efficiency:
+                buckets.append(order[begin:i])
+                begin = i
+                real_tokens = 0
+            real_tokens += length
+        buckets.append(order[begin:])
+        return buckets
+
+    def _run_with_io_binding(
+            self, onnx_input: Dict[str, np.ndarray]) -> List[np.ndarray]:
+        """ Runs the session with the inputs copied into buffers that are reused across calls.
+
+        Each input keeps one buffer, which is only reallocated when a larger batch arrives.
 
-reranker = Ranker()
+        Args:
+            onnx_input (Dict[str, np.ndarray]): The input arrays keyed by input name.
+
+        Returns:
+            List[np.ndarray]: The outputs of the session.
+        """
+        with self.io_binding_lock:
+            self.io_binding.clear_binding_inputs()
+            self.io_binding.clear_binding_outputs()
+            for name, array in onnx_input.items():
+                buffer = self.input_buffers.get(name)
+                if buffer is None or buffer.size < array.size:
+                    buffer = np.empty(array.size, dtype=np.int64)
+                    self.input_buffers[name] = buffer
+                view = buffer[:array.size].reshape(array.shape)
+                view[...] = array
+                self.io_binding.bind_cpu_input(name, view)
+            for output in self.session.get_outputs():
+                self.io_binding.bind_output(output.name)
+            self.session.run_with_iobinding(self.io_binding)
+            return self.io_binding.copy_outputs_to_cpu()
+
+
+# The model is loaded on first use, or by `reranker.warmup()` in the gunicorn master to share it with the workers
+reranker = LazySingleton('reranker', Ranker)
@@ -0,0 +1,156 @@
+import os
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+import time
+from typing import Any, Dict, List, Optional
+from server.app.utils.lazy_singleton import LazySingleton
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (RERANK_MAX_BATCH_SIZE,
+                                       RERANK_MAX_WAIT_MS,
+                                       RERANK_DISPATCH_TIMEOUT)
+from server.logger.logger_config import my_logger as logger
+from server.rag.post_retrieval.rerank.flash_ranker import Ranker, RerankRequest, reranker
+
+METRIC_PREFIX = "rerank_batcher:"
+
+
+class PendingPairs:
+    """ The query-passage pairs of one rerank call, waiting for their scores. """
+    def __init__(self, query_passage_pairs: List[List[str]]) -> None:
+        self.query_passage_pairs = query_passage_pairs
+        self.scores: List[float] = []
+        self.error: Optional[Exception] = None
+        self.done = Event()
+        # Set when the caller stopped waiting and scored the pairs itself
+        self.abandoned = False
+
+
+class RerankBatcher:
+    """ Merges the pairs of concurrent rerank calls into larger batches for the ONNX session.
+
+    A dispatcher thread takes the first waiting call, then keeps collecting calls for up to
+    `max_wait_ms` or until `max_batch_size` pairs are gathered. The collected pairs are scored
+    with one padded inference and the scores are handed back to each caller.
+    """
+    def __init__(self,
+                 ranker: Ranker,
+                 max_batch_size: int = RERANK_MAX_BATCH_SIZE,
+                 max_wait_ms: int = RERANK_MAX_WAIT_MS,
+                 dispatch_timeout: float = RERANK_DISPATCH_TIMEOUT) -> None:
+        self.ranker = ranker
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.dispatch_timeout = dispatch_timeout
+        self.queue: Queue = Queue()
+        self.dispatcher: Optional[Thread] = None
+        self.dispatcher_pid = 0
+        self.start_lock = Lock()
+
+    def reinit_after_fork(self) -> None:
+        # The dispatcher thread of the parent doesn't exist in the child, start a new one on first use
+        self.queue = Queue()
+        self.dispatcher = None
+        self.dispatcher_pid = 0
+        self.start_lock = Lock()
+
+    def ensure_dispatcher(self) -> None:
+        # Threads don't survive a fork, so each worker process starts its own dispatcher
+        if self.dispatcher_pid == os.getpid() and self.dispatcher.is_alive():
+            return
+        with self.start_lock:
+            if self.dispatcher_pid == os.getpid() and self.dispatcher.is_alive(
+            ):
+                return
+            # The calls already waiting in the queue are served by the new dispatcher
+            self.dispatcher = Thread(target=self.run, daemon=True)
+            self.dispatcher.start()
+            self.dispatcher_pid = os.getpid()
+            logger.info(
+                f"[RERANK_BATCHER] dispatcher started, pid: {self.dispatcher_pid}, max_batch_size: {self.max_batch_size}, max_wait: {self.max_wait}"
+            )
+
+    def predict(self, query_passage_pairs: List[List[str]]) -> List[float]:
+        """ Scores the pairs together with the pairs of concurrent calls.
+
+        Args:
+            query_passage_pairs (List[List[str]]): The [query, passage] pairs.
+
+        Returns:
+            List[float]: The relevance scores, in the order of the pairs.
+        """
+        if not query_passage_pairs:
+            return []
+        self.ensure_dispatcher()
+        pending = PendingPairs(query_passage_pairs)
+        self.queue.put(pending)
+        if not pending.done.wait(self.dispatch_timeout):
+            # The dispatcher died or hangs, don't block the request
+            pending.abandoned = True
+            metrics_client.incr(f"{METRIC_PREFIX}timeouts")
+            logger.error(
+                f"[RERANK_BATCHER] no scores from the dispatcher within {self.dispatch_timeout}s, score {len(query_passage_pairs)} pairs directly"
+            )
+            return self.ranker.predict(query_passage_pairs)
+        if pending.error is not None:
+            raise pending.error
+        return pending.scores
+
+    def rerank(self, request: RerankRequest) -> List[Dict[str, Any]]:
+        """ Same as `Ranker.rerank`, with the inference shared by concurrent calls. """
+        return self.ranker.rerank(request, predict=self.predict)
+
+    def run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            pair_count = len(batch[0].query_passage_pairs)
+            deadline = time.time() + self.max_wait
+            while pair_count < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                batch.append(pending)
+                pair_count += len(pending.query_passage_pairs)
+            self.process_batch(batch)
+
+    def process_batch(self, batch: List[PendingPairs]) -> None:
+        batch = [pending for pending in batch if not pending.abandoned]
+        if not batch:
+            return
+        query_passage_pairs = [
+            pair for pending in batch for pair in pending.query_passage_pairs
+        ]
+        try:
+            scores: List[float] = []
+            # A single call may carry more pairs than `max_batch_size`
+            for i in range(0, len(query_passage_pairs), self.max_batch_size):
+                scores.extend(
+                    self.ranker.predict(
+                        query_passage_pairs[i:i + self.max_batch_size]))
+
+            offset = 0
+            for pending in batch:
+                count = len(pending.query_passage_pairs)
+                pending.scores = scores[offset:offset + count]
+                offset += count
+        except Exception as e:
+            logger.error(
+                f"[RERANK_BATCHER] process_batch failed, calls: {len(batch)}, pairs: {len(query_passage_pairs)}, the exception is {e}"
+            )
+            for pending in batch:
+                pending.error = e
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+        metrics_client.incr(f"{METRIC_PREFIX}batches")
+        metrics_client.incr(f"{METRIC_PREFIX}calls", len(batch))
+        metrics_client.incr(f"{METRIC_PREFIX}pairs", len(query_passage_pairs))
+
+
+# Initialize the rerank batcher, the model is loaded on first use
+rerank_batcher = LazySingleton('rerank_batcher',
+                               lambda: RerankBatcher(reranker))
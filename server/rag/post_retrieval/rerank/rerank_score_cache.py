@@ -0,0 +1,252 @@
+import atexit
+import os
+from threading import Event, Lock, Thread
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from server.app.utils.diskcache_client import diskcache_client
+from server.app.utils.diskcache_lock import DiskcacheLock
+from server.app.utils.hash import generate_md5
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.sqlite_client import get_db_connection
+from server.app.utils.text_helper import normalize_text
+from server.constant.constants import (RERANK_SCORE_CACHE_MAX_SIZE,
+                                       RERANK_SCORE_CACHE_PRUNE_INTERVAL,
+                                       RERANK_SCORE_CACHE_LOCK_ID,
+                                       RERANK_SCORE_CACHE_BATCH_SIZE,
+                                       RERANK_SCORE_CACHE_FLUSH_INTERVAL)
+from server.logger.logger_config import my_logger as logger
+
+METRIC_PREFIX = "rerank_score_cache:"
+
+
+class RerankScoreCache:
+    """ Persists the sigmoid scores of the re-ranking model in `t_rerank_score_cache_tab`.
+
+    Scores are keyed by the model name, the md5 of the normalized query and the md5 of the passage text,
+    so a score stays valid as long as the chunk is unchanged. Rows of a chunk are evicted when its
+    embedding is deleted, and the oldest rows are pruned beyond `max_size`.
+    New scores are buffered like `UsageRecorder` does: a writer thread flushes them every `flush_interval`
+    seconds, or as soon as `batch_size` scores are pending, so the request path never waits for SQLite.
+    """
+    def __init__(
+            self,
+            max_size: int = RERANK_SCORE_CACHE_MAX_SIZE,
+            prune_interval: int = RERANK_SCORE_CACHE_PRUNE_INTERVAL,
+            batch_size: int = RERANK_SCORE_CACHE_BATCH_SIZE,
+            flush_interval: float = RERANK_SCORE_CACHE_FLUSH_INTERVAL
+    ) -> None:
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_count = 0
+        self.distributed_lock = DiskcacheLock(diskcache_client.cache,
+                                              RERANK_SCORE_CACHE_LOCK_ID)
+        # The scores waiting to be written, keyed by (model_name, query_md5, passage_md5)
+        self.pending: Dict[Tuple[str, str, str], Tuple[float, int]] = {}
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.writer: Optional[Thread] = None
+        self.writer_pid = 0
+        # The scores of the parent are written by the parent, and its writer thread doesn't exist in the child
+        os.register_at_fork(after_in_child=self.reinit_after_fork)
+        atexit.register(self.flush)
+
+    def reinit_after_fork(self) -> None:
+        self.pending = {}
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.writer = None
+        self.writer_pid = 0
+
+    def ensure_writer(self) -> None:
+        if self.writer_pid == os.getpid() and self.writer.is_alive():
+            return
+        with self.lock:
+            if self.writer_pid == os.getpid() and self.writer.is_alive():
+                return
+            self.writer = Thread(target=self.run, daemon=True)
+            self.writer.start()
+            self.writer_pid = os.getpid()
+
+    @staticmethod
+    def get_passage_md5(text: str) -> str:
+        return generate_md5(text.encode('utf-8'))
+
+    def get_scores(self, model_name: str, query_md5: str,
+                   passage_md5_list: List[str]) -> Dict[str, float]:
+        scores: Dict[str, float] = {}
+        # The scores not written yet
+        with self.lock:
+            for passage_md5 in passage_md5_list:
+                pending = self.pending.get(
+                    (model_name, query_md5, passage_md5))
+                if pending is not None:
+                    scores[passage_md5] = pending[0]
+        missed_md5_list = [
+            passage_md5 for passage_md5 in passage_md5_list
+            if passage_md5 not in scores
+        ]
+        if not missed_md5_list:
+            return scores
+
+        placeholders = ','.join(['?'] * len(missed_md5_list))
+        conn = get_db_connection()
+        try:
+            rows = conn.execute(
+                f"SELECT passage_md5, score FROM t_rerank_score_cache_tab WHERE model_name = ? AND query_md5 = ? AND passage_md5 IN ({placeholders})",
+                [model_name, query_md5] + missed_md5_list).fetchall()
+            scores.update({row["passage_md5"]: row["score"] for row in rows})
+            return scores
+        finally:
+            conn.close()
+
+    def set_scores(self, model_name: str, query_md5: str,
+                   scores: Dict[str, float]) -> None:
+        """Adds the new scores to the buffer, written by the writer thread."""
+        timestamp = int(time.time())
+        with self.lock:
+            for passage_md5, score in scores.items():
+                self.pending[(model_name, query_md5,
+                              passage_md5)] = (score, timestamp)
+            is_full = len(self.pending) >= self.batch_size
+        self.ensure_writer()
+        if is_full:
+            self.wakeup.set()
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        conn = None
+        try:
+            conn = get_db_connection()
+            with self.distributed_lock.lock():
+                conn.executemany(
+                    "INSERT OR REPLACE INTO t_rerank_score_cache_tab (model_name, query_md5, passage_md5, score, ctime) VALUES (?, ?, ?, ?, ?)",
+                    [(model_name, query_md5, passage_md5, score, timestamp)
+                     for (model_name, query_md5, passage_md5), (
+                         score, timestamp) in batch.items()])
+                conn.commit()
+        except Exception as e:
+            logger.error(
+                f"[RERANK_SCORE_CACHE] write {len(batch)} scores failed, the exception is {e}"
+            )
+            return
+        finally:
+            if conn:
+                conn.close()
+
+        self.write_count += 1
+        if self.write_count % self.prune_interval == 0:
+            try:
+                self.prune()
+            except Exception as e:
+                logger.error(
+                    f"[RERANK_SCORE_CACHE] prune failed, the exception is {e}")
+
+    def prune(self) -> None:
+        """Deletes the oldest rows beyond `max_size`."""
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                cur = conn.execute(
+                    "DELETE FROM t_rerank_score_cache_tab WHERE id <= (SELECT id FROM t_rerank_score_cache_tab ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (self.max_size, ))
+                conn.commit()
+                if cur.rowcount > 0:
+                    logger.info(
+                        f"[RERANK_SCORE_CACHE] prune, deleted {cur.rowcount} rows"
+                    )
+        finally:
+            conn.close()
+
+    def evict_passages(self, texts: List[str]) -> None:
+        """Deletes the scores of the passages whose chunks are removed from the knowledge base."""
+        passage_md5_list = list(
+            {self.get_passage_md5(text)
+             for text in texts if text})
+        if not passage_md5_list:
+            return
+        # Don't let the writer put back the scores of removed chunks
+        passage_md5_set = set(passage_md5_list)
+        with self.lock:
+            self.pending = {
+                key: value
+                for key, value in self.pending.items()
+                if key[2] not in passage_md5_set
+            }
+        placeholders = ','.join(['?'] * len(passage_md5_list))
+        conn = get_db_connection()
+        try:
+            with self.distributed_lock.lock():
+                cur = conn.execute(
+                    f"DELETE FROM t_rerank_score_cache_tab WHERE passage_md5 IN ({placeholders})",
+                    passage_md5_list)
+                conn.commit()
+            logger.info(
+                f"[RERANK_SCORE_CACHE] evict_passages, passages: {len(passage_md5_list)}, deleted {cur.rowcount} rows"
+            )
+        finally:
+            conn.close()
+
+    def cached_predict(
+            self, model_name: str, query: str, texts: List[str],
+            predict: Callable[[List[List[str]]], List[float]]) -> List[float]:
+        """ Scores the passages against the query, running `predict` only on the cache misses.
+
+        Args:
+            model_name (str): The name of the re-ranking model.
+            query (str): The user query.
+            texts (List[str]): The passage texts.
+            predict (Callable[[List[List[str]]], List[float]]): Scores [query, passage] pairs.
+
+        Returns:
+            List[float]: The scores, in the order of `texts`.
+        """
+        query_md5 = generate_md5(normalize_text(query).encode('utf-8'))
+        passage_md5_list = [self.get_passage_md5(text) for text in texts]
+        try:
+            cached_scores = self.get_scores(model_name, query_md5,
+                                            passage_md5_list)
+        except Exception as e:
+            logger.error(
+                f"Get rerank scores from SQLite failed, the exception is {e}")
+            cached_scores = {}
+
+        missed_index_list = [
+            i for i, passage_md5 in enumerate(passage_md5_list)
+            if passage_md5 not in cached_scores
+        ]
+        if len(missed_index_list) < len(texts):
+            metrics_client.incr(f"{METRIC_PREFIX}hit",
+                                len(texts) - len(missed_index_list))
+        if missed_index_list:
+            metrics_client.incr(f"{METRIC_PREFIX}miss", len(missed_index_list))
+            missed_scores = predict([[query, texts[i]]
+                                     for i in missed_index_list])
+            new_scores = {}
+            for i, score in zip(missed_index_list, missed_scores):
+                cached_scores[passage_md5_list[i]] = score
+                # Only single-logit models produce a scalar score
+                if isinstance(score, float):
+                    new_scores[passage_md5_list[i]] = score
+            if new_scores:
+                try:
+                    self.set_scores(model_name, query_md5, new_scores)
+                except Exception as e:
+                    logger.error(
+                        f"Set rerank scores into SQLite failed, the exception is {e}"
+                    )
+        return [cached_scores[passage_md5] for passage_md5 in passage_md5_list]
+
+
+# Initialize the rerank score cache
+rerank_score_cache = RerankScoreCache()
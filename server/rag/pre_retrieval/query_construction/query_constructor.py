@@ -0,0 +1,272 @@
+from collections import Counter
+import re
+from threading import Lock
+import time
+from typing import Any, Dict, List, Optional
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.sqlite_client import get_db_connection
+from server.constant.constants import (QUERY_CONSTRUCTION_RECENT_DAYS,
+                                       QUERY_CONSTRUCTION_USE_LLM,
+                                       QUERY_CONSTRUCTION_MAX_LLM_SECTIONS)
+from server.logger.logger_config import my_logger as logger
+from server.rag.generation.json_answer_parser import parse_json_answer
+from server.rag.generation.llm import llm_generator
+from server.rag.generation.prompt_templates import prompt_template_registry
+from server.rag.generation.usage_recorder import usage_recorder
+from server.rag.index.embedder.document_embedder import (get_kb_version,
+                                                         get_url_domain,
+                                                         get_url_section)
+
+METRIC_PREFIX = "query_construction:"
+
+# The words naming each `file_type` of the chunk metadata
+FILE_TYPE_ALIASES = {
+    'pdf': ['pdf'],
+    'docx': ['docx', 'word'],
+    'xlsx': ['xlsx', 'excel', 'spreadsheet'],
+    'pptx': ['pptx', 'ppt', 'powerpoint', 'slides', 'slide deck'],
+    'csv': ['csv'],
+    'md': ['markdown'],
+    'txt': ['txt', 'text file'],
+    'epub': ['epub', 'ebook'],
+    'mobi': ['mobi'],
+    'html': ['web page', 'webpage', 'website', '网页', '网站']
+}
+
+# A file type only scopes the question when it is where the answer is looked for,
+# e.g. 'in the onboarding pdf' or 'pdf documents about X', but not 'how to export a pdf'
+SCOPE_PREPOSITIONS = r"(?:in|from|within|inside|according to|based on)\s+(?:the\s+|a\s+|an\s+|our\s+|your\s+|this\s+|that\s+)?(?:[\w-]+\s+){0,2}"
+SCOPE_NOUNS_EN = r"\s+(?:files?|documents?|docs?)\b"
+SCOPE_NOUNS_ZH = r"\s*(?:文件|文档|里|中)"
+
+FILE_TYPE_PATTERNS = {
+    file_type:
+    re.compile(
+        rf"\b{SCOPE_PREPOSITIONS}(?:{'|'.join(aliases)})\b|\b(?:{'|'.join(aliases)}){SCOPE_NOUNS_EN}|(?:{'|'.join(aliases)}){SCOPE_NOUNS_ZH}",
+        re.IGNORECASE)
+    for file_type, aliases in FILE_TYPE_ALIASES.items()
+}
+
+# 'latest' is the only time constraint, relative to the newest embedding: the `mtime` of a chunk is when
+# it was embedded, not the date of its content, so a year in the question can't be matched against it
+RECENT_PATTERN = re.compile(
+    r"\b(?:latest|newest|most recent|recently|up-to-date|up to date)\b|最新|最近",
+    re.IGNORECASE)
+
+# Words hinting at a scope, sent to the LLM fallback when the patterns above don't resolve it
+SCOPE_HINT_PATTERN = re.compile(
+    rf"\b(?:{'|'.join(alias for aliases in FILE_TYPE_ALIASES.values() for alias in aliases)})\b|\b(?:version|release|changelog|updated?)\b|版本|更新|发布",
+    re.IGNORECASE)
+
+# First path segments that don't identify a product area
+GENERIC_SECTIONS = {
+    'docs', 'doc', 'documentation', 'en', 'en-us', 'zh', 'zh-cn', 'cn', 'ja',
+    'ko', 'de', 'fr', 'es', 'blog', 'blogs', 'posts', 'post', 'page', 'pages',
+    'wiki', 'web', 'static', 'html', 'latest', 'stable', 'main', 'master',
+    'guide', 'guides', 'help'
+}
+
+
+class QueryConstraints:
+    """ The structured constraints of a question, matching the metadata of the chunks.
+
+    Attributes:
+        domain (Optional[str]): The site of the documents, e.g. 'docs.openim.io'.
+        section (Optional[str]): The product area, the first path segment of the web pages, e.g. 'sdks'.
+        file_types (List[str]): The `file_type` values of the documents, e.g. ['pdf'].
+        min_mtime (Optional[int]): The documents must have been embedded at or after this timestamp.
+    """
+    def __init__(self) -> None:
+        self.domain: Optional[str] = None
+        self.section: Optional[str] = None
+        self.file_types: List[str] = []
+        self.min_mtime: Optional[int] = None
+
+    def is_empty(self) -> bool:
+        return self.to_where() is None
+
+    def to_where(self) -> Optional[Dict[str, Any]]:
+        """Returns the `where` filter of Chroma, or None if there is no constraint."""
+        conditions: List[Dict[str, Any]] = []
+        if self.domain:
+            conditions.append({"domain": self.domain})
+        if self.section:
+            conditions.append({"section": self.section})
+        if len(self.file_types) == 1:
+            conditions.append({"file_type": self.file_types[0]})
+        elif self.file_types:
+            conditions.append({"file_type": {"$in": self.file_types}})
+        if self.min_mtime is not None:
+            conditions.append({"mtime": {"$gte": self.min_mtime}})
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {"$and": conditions}
+
+    def __repr__(self) -> str:
+        return f"QueryConstraints({self.to_where()})"
+
+
+class QueryConstructor:
+    """ Extracts the structured constraints of a question, used as metadata filters of the vector search.
+
+    Local patterns recognize file types named as the place of the answer, the 'latest' intent, and the
+    domains and product areas of the knowledge base mentioned in the question. The vocabulary of domains and
+    sections is loaded from the ingested URLs, and reloaded when the knowledge base changes.
+    With `QUERY_CONSTRUCTION_USE_LLM`, questions hinting at a scope that the patterns can't resolve are sent to the LLM.
+    """
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.kb_version: Optional[int] = None
+        self.domains: List[str] = []
+        self.sections: List[str] = []
+        self.latest_mtime = 0
+
+    def load_vocabulary(self) -> None:
+        kb_version = get_kb_version()
+        if kb_version == self.kb_version:
+            return
+        with self.lock:
+            if kb_version == self.kb_version:
+                return
+            urls: List[str] = []
+            latest_mtime = 0
+            conn = None
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute(
+                    'SELECT url FROM t_sitemap_url_tab UNION ALL SELECT url FROM t_isolated_url_tab'
+                )
+                urls = [row['url'] for row in cur.fetchall()]
+                cur.execute('SELECT MAX(mtime) FROM t_doc_embedding_map_tab')
+                latest_mtime = cur.fetchone()[0] or 0
+            except Exception as e:
+                logger.error(
+                    f"[QUERY_CONSTRUCTION] load the vocabulary failed, the exception is {e}"
+                )
+                return
+            finally:
+                if conn:
+                    conn.close()
+
+            domains = Counter(get_url_domain(url) for url in urls)
+            sections = Counter(get_url_section(url) for url in urls)
+            # Only a strict subset of the documents is worth a filter.
+            # Longer domains are matched first, e.g. 'docs.openim.io' before 'openim.io'
+            self.domains = sorted(
+                [domain for domain in domains if domain],
+                key=len,
+                reverse=True) if len(domains) > 1 else []
+            self.sections = [
+                section for section, count in sections.most_common()
+                if len(section) >= 3 and not section.isdigit()
+                and section not in GENERIC_SECTIONS and count < len(urls)
+            ]
+            self.latest_mtime = latest_mtime
+            self.kb_version = kb_version
+            logger.info(
+                f"[QUERY_CONSTRUCTION] vocabulary loaded, kb_version: {kb_version}, domains: {len(self.domains)}, sections: {len(self.sections)}"
+            )
+
+    def match_section(self, query_lower: str) -> Optional[str]:
+        normalized_query = re.sub(r'[-_]', ' ', query_lower)
+        for section in self.sections:
+            name = re.sub(r'[-_]', ' ', section)
+            singular = name[:-1] if name.endswith('s') else name
+            if re.search(rf"\b(?:{re.escape(name)}|{re.escape(singular)})\b",
+                         normalized_query):
+                return section
+        return None
+
+    def extract_local(self, query: str) -> QueryConstraints:
+        constraints = QueryConstraints()
+        query_lower = query.lower()
+
+        for domain in self.domains:
+            if domain in query_lower:
+                constraints.domain = domain
+                break
+        constraints.section = self.match_section(query_lower)
+        constraints.file_types = [
+            file_type for file_type, pattern in FILE_TYPE_PATTERNS.items()
+            if pattern.search(query)
+        ]
+
+        if self.latest_mtime and RECENT_PATTERN.search(query):
+            constraints.min_mtime = self.latest_mtime - QUERY_CONSTRUCTION_RECENT_DAYS * 86400
+        return constraints
+
+    def extract_with_llm(self, query: str, user_id: str) -> QueryConstraints:
+        user_prompt = f"""**Domains:** {self.domains}
+**Sections:** {self.sections[:QUERY_CONSTRUCTION_MAX_LLM_SECTIONS]}
+**File Types:** {list(FILE_TYPE_ALIASES)}
+
+**Question:** {query}"""
+        messages = prompt_template_registry.build_messages(
+            'query_construction', user_prompt)
+
+        beg_time = time.time()
+        response = llm_generator.generate(messages, False, True, 'refine')
+        timecost = time.time() - beg_time
+        metrics_client.incr(f"{METRIC_PREFIX}llm_calls")
+        usage_recorder.record(user_id, 'query_construction',
+                              getattr(response, 'model', ''),
+                              getattr(response, 'usage', None), timecost)
+
+        data = parse_json_answer(response.choices[0].message.content)
+        constraints = QueryConstraints()
+        # Only values of the knowledge base are kept, the LLM may make up others
+        if data.get('domain') in self.domains:
+            constraints.domain = data['domain']
+        if data.get('section') in self.sections:
+            constraints.section = data['section']
+        if data.get('file_type') in FILE_TYPE_ALIASES:
+            constraints.file_types = [data['file_type']]
+        if data.get('latest') is True and self.latest_mtime:
+            constraints.min_mtime = self.latest_mtime - QUERY_CONSTRUCTION_RECENT_DAYS * 86400
+        logger.info(
+            f"[QUERY_CONSTRUCTION] for the query: '{query}', the LLM returns {data}. The timecost is {timecost}"
+        )
+        return constraints
+
+    def construct(self, query: str, user_id: str) -> QueryConstraints:
+        """ Returns the constraints of `query`, empty if it isn't scoped. """
+        self.load_vocabulary()
+        constraints = self.extract_local(query)
+        if constraints.is_empty() and QUERY_CONSTRUCTION_USE_LLM and SCOPE_HINT_PATTERN.search(
+                query):
+            try:
+                constraints = self.extract_with_llm(query, user_id)
+            except Exception as e:
+                logger.error(
+                    f"[QUERY_CONSTRUCTION] for the query: '{query}', the LLM fallback failed, the exception is {e}"
+                )
+                constraints = QueryConstraints()
+
+        if constraints.is_empty():
+            metrics_client.incr(f"{METRIC_PREFIX}unscoped")
+        else:
+            metrics_client.incr(f"{METRIC_PREFIX}scoped")
+            logger.info(
+                f"[QUERY_CONSTRUCTION] for the query: '{query}', the constraints are {constraints}"
+            )
+        return constraints
+
+    def record_fallback(self) -> None:
+        """Records a scoped search that matched too few chunks and was retried on the whole collection."""
+        metrics_client.incr(f"{METRIC_PREFIX}fallback")
+
+    def get_stats(self) -> Dict[str, int]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        return {
+            "scoped": counters.get(f"{METRIC_PREFIX}scoped", 0),
+            "unscoped": counters.get(f"{METRIC_PREFIX}unscoped", 0),
+            "fallback": counters.get(f"{METRIC_PREFIX}fallback", 0),
+            "llm_calls": counters.get(f"{METRIC_PREFIX}llm_calls", 0)
+        }
+
+
+# Initialize the query constructor
+query_constructor = QueryConstructor()
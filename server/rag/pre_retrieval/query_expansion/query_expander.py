@@ -0,0 +1,153 @@
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from threading import Lock
+import time
+from typing import Dict, List, Optional
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.text_helper import normalize_text
+from server.constant.constants import (
+    QUERY_EXPANSION_MAX_PARAPHRASES, QUERY_EXPANSION_MAX_HYPOTHETICAL_ANSWERS,
+    QUERY_EXPANSION_LATENCY_BUDGET_MS, QUERY_EXPANSION_PROBE_INTERVAL)
+from server.logger.logger_config import my_logger as logger
+from server.rag.generation.json_answer_parser import parse_json_answer
+from server.rag.generation.llm import llm_generator
+from server.rag.generation.prompt_templates import prompt_template_registry
+from server.rag.generation.usage_recorder import usage_recorder
+
+METRIC_PREFIX = "query_expansion:"
+
+
+class ExpansionTask:
+    """ The pending expansion of a query, bounded by the latency budget counted from its submission. """
+    def __init__(self, query: str, future: Optional[Future],
+                 deadline: float) -> None:
+        self.query = query
+        self.future = future
+        self.deadline = deadline
+
+    def result(self) -> List[str]:
+        """ Returns the expanded queries, or an empty list if the expansion was skipped, failed or is over budget. """
+        if self.future is None:
+            return []
+        try:
+            expansions = self.future.result(
+                timeout=max(self.deadline - time.time(), 0))
+        except TimeoutError:
+            metrics_client.incr(f"{METRIC_PREFIX}over_budget")
+            logger.warning(
+                f"[QUERY_EXPANSION] for the query: '{self.query}', the expansion exceeds the latency budget and is dropped"
+            )
+            return []
+        except Exception as e:
+            metrics_client.incr(f"{METRIC_PREFIX}error")
+            logger.error(
+                f"[QUERY_EXPANSION] for the query: '{self.query}', the expansion failed, the exception is {e}"
+            )
+            return []
+        metrics_client.incr(f"{METRIC_PREFIX}expanded")
+        return expansions
+
+
+class QueryExpander:
+    """ Expands a query into paraphrases and hypothetical answers (HyDE) with a single LLM call.
+
+    The call runs in a worker thread, so that it overlaps with `refine_query`, and its result is dropped
+    once it exceeds the latency budget, in which case only the original queries are searched.
+    While the average latency of the calls exceeds the budget, expansion is skipped without calling the LLM,
+    except for one probe query out of `probe_interval` that notices when the provider is fast again.
+    """
+    def __init__(
+            self,
+            latency_budget_ms: int = QUERY_EXPANSION_LATENCY_BUDGET_MS,
+            probe_interval: int = QUERY_EXPANSION_PROBE_INTERVAL) -> None:
+        self.latency_budget_ms = latency_budget_ms
+        self.probe_interval = probe_interval
+        self.executor = ThreadPoolExecutor(
+            thread_name_prefix='query_expansion')
+        self.lock = Lock()
+        self.query_count = 0
+        # Average latency of an expansion call
+        self.avg_latency_ms = 0.0
+
+    def should_expand(self) -> bool:
+        with self.lock:
+            self.query_count += 1
+            if self.avg_latency_ms <= self.latency_budget_ms:
+                return True
+            return self.query_count % self.probe_interval == 0
+
+    def record_latency(self, latency_ms: float) -> None:
+        metrics_client.incr(f"{METRIC_PREFIX}calls")
+        metrics_client.incr(f"{METRIC_PREFIX}latency_ms", int(latency_ms))
+        with self.lock:
+            if self.avg_latency_ms:
+                self.avg_latency_ms = 0.8 * self.avg_latency_ms + 0.2 * latency_ms
+            else:
+                self.avg_latency_ms = latency_ms
+
+    def generate_expansions(self, query: str, lang: str,
+                            user_id: str) -> List[str]:
+        messages = prompt_template_registry.build_messages(
+            'query_expansion',
+            f"**Question:** {query}",
+            lang=lang,
+            max_paraphrases=QUERY_EXPANSION_MAX_PARAPHRASES,
+            max_hypothetical_answers=QUERY_EXPANSION_MAX_HYPOTHETICAL_ANSWERS)
+
+        beg_time = time.time()
+        response = llm_generator.generate(messages, False, True, 'refine')
+        timecost = time.time() - beg_time
+        # Calls over budget are recorded too, they keep the average latency honest
+        self.record_latency(timecost * 1000)
+        usage_recorder.record(user_id, 'query_expansion',
+                              getattr(response, 'model', ''),
+                              getattr(response, 'usage', None), timecost)
+
+        data = parse_json_answer(response.choices[0].message.content)
+        paraphrases = data.get('paraphrases')
+        hypothetical_answers = data.get('hypothetical_answers')
+        candidates = []
+        if isinstance(paraphrases, list):
+            candidates.extend(paraphrases[:QUERY_EXPANSION_MAX_PARAPHRASES])
+        if isinstance(hypothetical_answers, list):
+            candidates.extend(
+                hypothetical_answers[:QUERY_EXPANSION_MAX_HYPOTHETICAL_ANSWERS])
+        seen = {normalize_text(query)}
+        expansions = []
+        for candidate in candidates:
+            if not isinstance(candidate, str):
+                continue
+            normalized_candidate = normalize_text(candidate)
+            if normalized_candidate and normalized_candidate not in seen:
+                seen.add(normalized_candidate)
+                expansions.append(candidate.strip())
+        logger.info(
+            f"[QUERY_EXPANSION] for the query: '{query}', the expansions are {expansions}. The timecost is {timecost}"
+        )
+        return expansions
+
+    def submit(self, query: str, lang: str, user_id: str) -> ExpansionTask:
+        """ Starts the expansion of `query` in the background, collect it with `ExpansionTask.result()`. """
+        deadline = time.time() + self.latency_budget_ms / 1000
+        if not self.should_expand():
+            metrics_client.incr(f"{METRIC_PREFIX}skipped")
+            return ExpansionTask(query, None, deadline)
+        future = self.executor.submit(self.generate_expansions, query, lang,
+                                      user_id)
+        return ExpansionTask(query, future, deadline)
+
+    def get_stats(self) -> Dict[str, float]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        calls = counters.get(f"{METRIC_PREFIX}calls", 0)
+        return {
+            "expanded": counters.get(f"{METRIC_PREFIX}expanded", 0),
+            "skipped": counters.get(f"{METRIC_PREFIX}skipped", 0),
+            "over_budget": counters.get(f"{METRIC_PREFIX}over_budget", 0),
+            "error": counters.get(f"{METRIC_PREFIX}error", 0),
+            "avg_latency_ms":
+            counters.get(f"{METRIC_PREFIX}latency_ms", 0) /
+            calls if calls else 0.0
+        }
+
+
+# Initialize the query expander
+query_expander = QueryExpander()
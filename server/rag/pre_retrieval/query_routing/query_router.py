@@ -0,0 +1,261 @@
+import os
+from threading import Lock
+import time
+import unicodedata
+from typing import Dict, Optional, Tuple
+import numpy as np
+from server.app.utils.diskcache_client import diskcache_client
+from server.app.utils.metrics_client import metrics_client
+from server.app.utils.text_helper import normalize_text
+from server.constant.constants import (QUERY_ROUTER_USE_EMBEDDING_CLASSIFIER,
+                                       QUERY_ROUTER_CLASSIFIER_MAX_LENGTH,
+                                       QUERY_ROUTER_CHITCHAT_MIN_SIMILARITY)
+from server.logger.logger_config import my_logger as logger
+from server.rag.index.embedder.dimension_reducer import normalize_rows
+from server.rag.index.embedder.document_embedder import document_embedder
+
+METRIC_PREFIX = "query_router:"
+
+# Whole messages that are not knowledge questions, by intent and language.
+# They are matched after `normalize_route_text`, so case, punctuation and emoji don't matter.
+CHITCHAT_PHRASES = {
+    'greeting': {
+        'en': [
+            'hi', 'hello', 'hey', 'hi there', 'hello there', 'hey there',
+            'good morning', 'good afternoon', 'good evening', 'greetings',
+            'howdy'
+        ],
+        'zh': ['你好', '您好', '嗨', '哈喽', '你好呀', '你好啊', '大家好', '早上好', '早安', '下午好',
+               '晚上好'],
+        'ja': ['こんにちは', 'こんばんは', 'おはよう', 'おはようございます'],
+        'ko': ['안녕', '안녕하세요', '안녕하십니까'],
+        'fr': ['bonjour', 'salut', 'bonsoir', 'coucou'],
+        'es': ['hola', 'buenos días', 'buenos dias', 'buenas tardes', 'buenas noches'],
+        'pt': ['olá', 'ola', 'oi', 'bom dia', 'boa tarde', 'boa noite'],
+        'de': ['hallo', 'guten tag', 'guten morgen', 'guten abend', 'servus', 'moin'],
+        'ru': ['привет', 'здравствуйте', 'добрый день', 'доброе утро', 'добрый вечер'],
+        'ar': ['مرحبا', 'أهلا', 'اهلا', 'السلام عليكم'],
+        'hi': ['नमस्ते', 'नमस्कार']
+    },
+    'thanks': {
+        'en': [
+            'thanks', 'thank you', 'thx', 'thanks a lot', 'thank you very much',
+            'thanks so much', 'many thanks', 'ok thanks', 'ok thank you',
+            'great thanks'
+        ],
+        'zh': ['谢谢', '谢谢你', '谢谢您', '多谢', '感谢', '非常感谢', '好的谢谢', '好的 谢谢'],
+        'ja': ['ありがとう', 'ありがとうございます'],
+        'ko': ['감사합니다', '고마워', '고맙습니다'],
+        'fr': ['merci', 'merci beaucoup'],
+        'es': ['gracias', 'muchas gracias'],
+        'pt': ['obrigado', 'obrigada', 'muito obrigado', 'muito obrigada'],
+        'de': ['danke', 'danke schön', 'vielen dank'],
+        'ru': ['спасибо', 'большое спасибо'],
+        'ar': ['شكرا', 'شكرا لك'],
+        'hi': ['धन्यवाद', 'शुक्रिया']
+    },
+    'goodbye': {
+        'en': ['bye', 'goodbye', 'bye bye', 'see you', 'see you later', 'good night'],
+        'zh': ['再见', '拜拜', '晚安'],
+        'ja': ['さようなら', 'またね', 'おやすみ', 'おやすみなさい'],
+        'ko': ['안녕히 계세요', '안녕히 가세요', '잘 가'],
+        'fr': ['au revoir', 'bonne nuit'],
+        'es': ['adiós', 'adios', 'hasta luego'],
+        'pt': ['tchau', 'adeus', 'até logo'],
+        'de': ['tschüss', 'auf wiedersehen', 'gute nacht'],
+        'ru': ['пока', 'до свидания'],
+        'ar': ['مع السلامة', 'وداعا'],
+        'hi': ['अलविदा', 'फिर मिलेंगे']
+    },
+    # Answered by the LLM with a short prompt, without a canned response
+    'small_talk': {
+        'en': [
+            'how are you', 'who are you', 'what can you do', 'what is your name',
+            'whats your name', 'are you a bot', 'are you human'
+        ],
+        'zh': ['你是谁', '你好吗', '你能做什么', '你会什么', '你叫什么', '你叫什么名字', '你是机器人吗']
+    }
+}
+
+# Canned responses of the intents of `CHITCHAT_PHRASES`, by language
+CANNED_RESPONSES = {
+    'greeting': {
+        'en': "Hello! I'm here to help with any questions about `{bot_topic}`. What would you like to know?",
+        'zh': "你好！我可以为你解答关于 `{bot_topic}` 的问题，请问有什么可以帮你？",
+        'ja': "こんにちは！`{bot_topic}` に関するご質問にお答えします。何をお知りになりたいですか？",
+        'ko': "안녕하세요! `{bot_topic}`에 관한 질문에 답변해 드립니다. 무엇이 궁금하신가요?",
+        'fr': "Bonjour ! Je suis là pour répondre à vos questions sur `{bot_topic}`. Que souhaitez-vous savoir ?",
+        'es': "¡Hola! Estoy aquí para ayudarte con cualquier pregunta sobre `{bot_topic}`. ¿Qué te gustaría saber?",
+        'pt': "Olá! Estou aqui para ajudar com qualquer dúvida sobre `{bot_topic}`. O que você gostaria de saber?",
+        'de': "Hallo! Ich helfe Ihnen gerne bei Fragen zu `{bot_topic}`. Was möchten Sie wissen?",
+        'ru': "Здравствуйте! Я помогу с любыми вопросами о `{bot_topic}`. Что вы хотели бы узнать?",
+        'ar': "مرحبًا! أنا هنا للمساعدة في أي أسئلة حول `{bot_topic}`. ماذا تود أن تعرف؟",
+        'hi': "नमस्ते! मैं `{bot_topic}` से जुड़े किसी भी सवाल में आपकी मदद के लिए यहाँ हूँ। आप क्या जानना चाहेंगे?"
+    },
+    'thanks': {
+        'en': "You're welcome! Feel free to ask if you have any other questions about `{bot_topic}`.",
+        'zh': "不客气！如果还有关于 `{bot_topic}` 的问题，欢迎随时提问。",
+        'ja': "どういたしまして！`{bot_topic}` について他にご質問があれば、お気軽にどうぞ。",
+        'ko': "천만에요! `{bot_topic}`에 대해 다른 질문이 있으면 언제든지 물어보세요.",
+        'fr': "Avec plaisir ! N'hésitez pas si vous avez d'autres questions sur `{bot_topic}`.",
+        'es': "¡De nada! No dudes en preguntar si tienes otras dudas sobre `{bot_topic}`.",
+        'pt': "De nada! Fique à vontade para perguntar se tiver outras dúvidas sobre `{bot_topic}`.",
+        'de': "Gern geschehen! Fragen Sie gerne, wenn Sie weitere Fragen zu `{bot_topic}` haben.",
+        'ru': "Пожалуйста! Обращайтесь, если у вас появятся другие вопросы о `{bot_topic}`.",
+        'ar': "على الرحب والسعة! لا تتردد في السؤال إذا كانت لديك أسئلة أخرى حول `{bot_topic}`.",
+        'hi': "आपका स्वागत है! `{bot_topic}` के बारे में कोई और सवाल हो तो बेझिझक पूछें।"
+    },
+    'goodbye': {
+        'en': "Goodbye! Come back anytime you have questions about `{bot_topic}`.",
+        'zh': "再见！有关于 `{bot_topic}` 的问题随时回来找我。",
+        'ja': "さようなら！`{bot_topic}` についてご質問があれば、いつでもどうぞ。",
+        'ko': "안녕히 가세요! `{bot_topic}`에 대해 궁금한 점이 있으면 언제든지 다시 찾아주세요.",
+        'fr': "Au revoir ! Revenez quand vous voulez pour vos questions sur `{bot_topic}`.",
+        'es': "¡Adiós! Vuelve cuando quieras si tienes preguntas sobre `{bot_topic}`.",
+        'pt': "Tchau! Volte sempre que tiver dúvidas sobre `{bot_topic}`.",
+        'de': "Auf Wiedersehen! Kommen Sie jederzeit wieder, wenn Sie Fragen zu `{bot_topic}` haben.",
+        'ru': "До свидания! Возвращайтесь, если появятся вопросы о `{bot_topic}`.",
+        'ar': "مع السلامة! عد في أي وقت إذا كانت لديك أسئلة حول `{bot_topic}`.",
+        'hi': "अलविदा! `{bot_topic}` के बारे में कोई सवाल हो तो कभी भी वापस आइए।"
+    }
+}
+
+
+def normalize_route_text(text: str) -> str:
+    """Lowercase, and replace punctuation and symbols (including emoji) with spaces."""
+    text = ''.join(' ' if unicodedata.category(ch)[0] in 'PS' else ch
+                   for ch in normalize_text(text).lower())
+    return ' '.join(text.split())
+
+
+def get_intervene_alias_key(query: str) -> str:
+    """The Cache key of the intervened query matching the normalized `query`, e.g. for 'How to deploy' and 'how to deploy?'."""
+    return f"open_kf:intervene_alias:{normalize_route_text(query)}"
+
+
+class QueryRoute:
+    """ The route of a query.
+
+    Attributes:
+        intent (str): 'intervention', 'chitchat' or 'knowledge'.
+        answer (Optional[str]): The canned response of a chitchat query, None if it is answered by the LLM.
+        intervene_data (Optional[str]): The intervened answer, a JSON string with 'answer' and 'source'.
+    """
+    def __init__(self,
+                 intent: str,
+                 answer: Optional[str] = None,
+                 intervene_data: Optional[str] = None) -> None:
+        self.intent = intent
+        self.answer = answer
+        self.intervene_data = intervene_data
+
+
+class QueryRouter:
+    """ Routes each query before recall, so that only knowledge questions touch the vector store.
+
+    - intervention: the normalized query matches an intervened query, its answer is returned
+    - chitchat: greetings, thanks and goodbyes get a canned response in their language, other small talk
+      is answered by the LLM with a short prompt
+    - knowledge: the full RAG pipeline
+
+    The local rules match whole messages. With `QUERY_ROUTER_USE_EMBEDDING_CLASSIFIER`, short queries that the
+    rules don't match are compared with the chitchat phrases by embedding similarity; the query embedding is
+    cached, so a knowledge query reuses it for recall.
+    """
+    def __init__(self, bot_topic: str) -> None:
+        self.bot_topic = bot_topic
+        self.phrases: Dict[str, Tuple[str, str]] = {}
+        for intent, lang_phrases in CHITCHAT_PHRASES.items():
+            for lang, phrases in lang_phrases.items():
+                for phrase in phrases:
+                    self.phrases[normalize_route_text(phrase)] = (intent, lang)
+        self.exemplar_matrix: Optional[np.ndarray] = None
+        self.exemplar_lock = Lock()
+
+    def find_intervene_data(self, query: str) -> Optional[str]:
+        try:
+            intervene_query = diskcache_client.get(
+                get_intervene_alias_key(query))
+            if intervene_query:
+                return diskcache_client.get(
+                    f"open_kf:intervene:{intervene_query}")
+        except Exception as e:
+            logger.error(
+                f"[QUERY_ROUTER] get intervene alias of '{query}' failed, the exception is {e}"
+            )
+        return None
+
+    def get_exemplar_matrix(self) -> np.ndarray:
+        if self.exemplar_matrix is None:
+            with self.exemplar_lock:
+                if self.exemplar_matrix is None:
+                    # All the phrases in one batch of the provider
+                    embeddings = document_embedder.query_embedding_cache.embed_queries(
+                        list(self.phrases))
+                    self.exemplar_matrix = normalize_rows(
+                        np.array([e for e in embeddings if e],
+                                 dtype=np.float32))
+        return self.exemplar_matrix
+
+    def warmup(self) -> None:
+        """Embeds the chitchat phrases ahead of the first request, the matrix is shared by the forked workers."""
+        beg_time = time.time()
+        try:
+            matrix = self.get_exemplar_matrix()
+        except Exception as e:
+            # Retried on the first query that needs it
+            logger.error(
+                f"[QUERY_ROUTER] embed the chitchat phrases failed, the exception is {e}"
+            )
+            return
+        logger.info(
+            f"[QUERY_ROUTER] {len(matrix)} chitchat phrases embedded, the timecost is {time.time() - beg_time}"
+        )
+
+    def classify_chitchat(self, query: str) -> bool:
+        try:
+            embedding = document_embedder.query_embedding_cache.embed_query(
+                query)
+            if not embedding:
+                return False
+            vector = normalize_rows(np.array([embedding], dtype=np.float32))
+            similarity = float(np.max(self.get_exemplar_matrix() @ vector[0]))
+            return similarity >= QUERY_ROUTER_CHITCHAT_MIN_SIMILARITY
+        except Exception as e:
+            logger.error(
+                f"[QUERY_ROUTER] classify '{query}' failed, the exception is {e}"
+            )
+            return False
+
+    def route(self, query: str) -> QueryRoute:
+        query_route = self.route_query(query)
+        metrics_client.incr(f"{METRIC_PREFIX}{query_route.intent}")
+        logger.info(
+            f"[QUERY_ROUTER] the query: '{query}' is routed to '{query_route.intent}'"
+        )
+        return query_route
+
+    def route_query(self, query: str) -> QueryRoute:
+        intervene_data = self.find_intervene_data(query)
+        if intervene_data:
+            return QueryRoute('intervention', intervene_data=intervene_data)
+
+        match = self.phrases.get(normalize_route_text(query))
+        if match is not None:
+            intent, lang = match
+            canned_response = CANNED_RESPONSES.get(intent, {}).get(lang)
+            if canned_response:
+                return QueryRoute(
+                    'chitchat',
+                    answer=canned_response.format(bot_topic=self.bot_topic))
+            return QueryRoute('chitchat')
+
+        if QUERY_ROUTER_USE_EMBEDDING_CLASSIFIER and len(
+                query) <= QUERY_ROUTER_CLASSIFIER_MAX_LENGTH:
+            if self.classify_chitchat(query):
+                return QueryRoute('chitchat')
+        return QueryRoute('knowledge')
+
+
+# Initialize the query router
+query_router = QueryRouter(os.getenv('BOT_TOPIC'))
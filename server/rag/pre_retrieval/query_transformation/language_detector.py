@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import re
+from threading import Lock
+import time
+from typing import Dict, Optional
+import py3langid as langid
+from server.app.utils.text_helper import normalize_text
+from server.constant.constants import (LANG_DETECT_CACHE_SIZE,
+                                       LANG_DETECT_SCRIPT_MIN_RATIO)
+from server.logger.logger_config import my_logger as logger
+
+# The letters of each script that identifies a single language among the supported ones.
+# Kana identifies Japanese, whose texts also contain Han characters.
+SCRIPT_PATTERNS = {
+    # Hiragana, Katakana and Katakana phonetic extensions
+    'ja': re.compile(r'[\u3040-\u30ff\u31f0-\u31ff]'),
+    # Hangul Jamo, compatibility Jamo and syllables
+    'ko': re.compile(r'[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]'),
+    # CJK unified ideographs, extension A and compatibility ideographs
+    'zh': re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]'),
+    # Arabic, Arabic supplement and extended-A
+    'ar': re.compile(r'[\u0600-\u06ff\u0750-\u077f\u08a0-\u08ff]'),
+    'hi': re.compile(r'[\u0900-\u097f]'),
+    'ru': re.compile(r'[\u0400-\u04ff]')
+}
+
+# Letters of other languages sharing the script, e.g. Persian and Urdu, or Ukrainian and Serbian
+AMBIGUOUS_PATTERNS = {
+    'ar': re.compile('[پچژگکیۀٹڈڑںےھ]'),
+    'ru': re.compile('[іїєґўђјљњћџѓќѕ]',
+                     re.IGNORECASE)
+}
+
+
+def detect_script_lang(text: str) -> Optional[str]:
+    """ Returns the language identified by the script of `text`, or None if the script is ambiguous.
+
+    The script must be the only non-Latin one, and cover at least `LANG_DETECT_SCRIPT_MIN_RATIO` of the letters,
+    e.g. 'OpenIM 怎么部署' is Chinese, but Latin texts and 'How to log in with 微信' are left to the model.
+    """
+    letter_count = sum(1 for ch in text if ch.isalpha())
+    if not letter_count:
+        return None
+    counts = {
+        lang: len(pattern.findall(text))
+        for lang, pattern in SCRIPT_PATTERNS.items()
+    }
+    if counts['ja']:
+        counts['ja'] += counts.pop('zh')
+    scripts = [(lang, count) for lang, count in counts.items() if count]
+    if len(scripts) != 1:
+        return None
+    lang, count = scripts[0]
+    if count / letter_count < LANG_DETECT_SCRIPT_MIN_RATIO:
+        return None
+    ambiguous_pattern = AMBIGUOUS_PATTERNS.get(lang)
+    if ambiguous_pattern is not None and ambiguous_pattern.search(text):
+        return None
+    return lang
+
+
+class LanguageDetector:
+    """ Detects the language of queries, shared by all the steps of a turn.
+
+    Queries written in a script that identifies their language skip the statistical model of langid,
+    and the result of each normalized query is kept in a per-process LRU.
+    """
+    def __init__(self, cache_size: int = LANG_DETECT_CACHE_SIZE) -> None:
+        self.cache_size = cache_size
+        self.lru: OrderedDict[str, str] = OrderedDict()
+        self.lru_lock = Lock()
+
+    def warmup(self) -> None:
+        """Loads the model of langid ahead of the first request."""
+        beg_time = time.time()
+        langid.classify('warmup')
+        logger.info(
+            f"[LANG_DETECTOR] langid model loaded, the timecost is {time.time() - beg_time}"
+        )
+
+    def detect(self, query: str) -> str:
+        """ Returns the ISO 639-1 code of the language of `query`, e.g. 'en' or 'zh'. """
+        normalized_query = normalize_text(query)
+        with self.lru_lock:
+            lang = self.lru.get(normalized_query)
+            if lang is not None:
+                self.lru.move_to_end(normalized_query)
+                return lang
+
+        lang = detect_script_lang(normalized_query)
+        if lang is None:
+            lang, _ = langid.classify(normalized_query)
+
+        with self.lru_lock:
+            self.lru[normalized_query] = lang
+            while len(self.lru) > self.cache_size:
+                self.lru.popitem(last=False)
+        return lang
+
+    def clear(self) -> None:
+        with self.lru_lock:
+            self.lru.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"lru_size": len(self.lru)}
+
+
+# Initialize the language detector
+language_detector = LanguageDetector()
@@ -0,0 +1,112 @@
+import re
+from typing import Any, Dict, List, Tuple
+from server.app.utils.metrics_client import metrics_client
+from server.constant.constants import (REFINE_MIN_SELF_CONTAINED_WORDS,
+                                       REFINE_MIN_SELF_CONTAINED_CHARS)
+from server.rag.pre_retrieval.query_transformation.language_detector import language_detector
+
+METRIC_PREFIX = "refine_classifier:"
+
+# Pronouns and references to something said before
+ANAPHORA_WORDS_EN = {
+    'it', 'its', 'itself', 'this', 'that', 'these', 'those', 'they', 'them',
+    'their', 'theirs', 'he', 'him', 'his', 'she', 'her', 'hers', 'one', 'ones',
+    'former', 'latter', 'above', 'previous', 'same', 'such', 'there', 'else',
+    'other', 'another', 'again', 'also', 'too', 'instead'
+}
+
+# Openings of a follow-up that continues the previous question
+FOLLOW_UP_PREFIXES_EN = ('and ', 'but ', 'so ', 'or ', 'then ', 'what about',
+                         'how about', 'what if', 'why', 'any other', 'more ',
+                         'for example')
+
+ANAPHORA_MARKERS_ZH = ('它', '他', '她', '这', '那', '其', '该', '此', '上面', '上述',
+                       '刚才', '之前', '前面', '以上', '同样', '还有', '另外', '呢',
+                       '怎么样', '为什么')
+
+
+class RefineClassifier:
+    """ Decides locally whether a query depends on the conversation, before the LLM call of `refine_query`.
+
+    Without real history there is nothing to resolve. With history, English and Chinese queries are only
+    refined if they contain pronouns or references, start like a follow-up, or are too short to stand alone.
+    Queries in other languages are always refined when there is history.
+    """
+    def __init__(self) -> None:
+        # Average latency of a refine_query call, used to estimate the latency saved by a skip
+        self.avg_refine_latency_ms = 0.0
+
+    def classify(self, query: str,
+                 history_session: List[Any]) -> Tuple[bool, str]:
+        """ Returns whether the query should be refined, and the reason. """
+        if not history_session:
+            return False, 'no_history'
+
+        lang = language_detector.detect(query)
+        query_lower = query.lower().strip()
+        if lang == 'en':
+            words = re.findall(r"[a-z0-9']+", query_lower)
+            if any(word in ANAPHORA_WORDS_EN for word in words):
+                return True, 'anaphora'
+            if query_lower.startswith(FOLLOW_UP_PREFIXES_EN):
+                return True, 'follow_up'
+            if len(words) < REFINE_MIN_SELF_CONTAINED_WORDS:
+                return True, 'ellipsis'
+            return False, 'self_contained'
+        if lang == 'zh':
+            if any(marker in query_lower for marker in ANAPHORA_MARKERS_ZH):
+                return True, 'anaphora'
+            if len(re.sub(r'\W', '', query_lower)) < REFINE_MIN_SELF_CONTAINED_CHARS:
+                return True, 'ellipsis'
+            return False, 'self_contained'
+        return True, 'unsupported_lang'
+
+    def should_refine(self, query: str, history_session: List[Any]) -> bool:
+        is_refined, reason = self.classify(query, history_session)
+        if is_refined:
+            metrics_client.incr(f"{METRIC_PREFIX}refined")
+        else:
+            metrics_client.incr(f"{METRIC_PREFIX}skipped")
+            metrics_client.incr(f"{METRIC_PREFIX}skipped:{reason}")
+            self.record_skip()
+        return is_refined
+
+    def record_skip(self) -> None:
+        if not self.avg_refine_latency_ms:
+            refine_calls = metrics_client.get(f"{METRIC_PREFIX}refine_calls")
+            if refine_calls:
+                self.avg_refine_latency_ms = metrics_client.get(
+                    f"{METRIC_PREFIX}refine_latency_ms") / refine_calls
+        metrics_client.incr(f"{METRIC_PREFIX}latency_saved_ms",
+                            int(self.avg_refine_latency_ms))
+
+    def record_refine_latency(self, latency_ms: float) -> None:
+        metrics_client.incr(f"{METRIC_PREFIX}refine_calls")
+        metrics_client.incr(f"{METRIC_PREFIX}refine_latency_ms",
+                            int(latency_ms))
+        if self.avg_refine_latency_ms:
+            self.avg_refine_latency_ms = 0.9 * self.avg_refine_latency_ms + 0.1 * latency_ms
+        else:
+            self.avg_refine_latency_ms = latency_ms
+
+    def get_stats(self) -> Dict[str, float]:
+        counters = metrics_client.get_all(METRIC_PREFIX)
+        refined = counters.get(f"{METRIC_PREFIX}refined", 0)
+        skipped = counters.get(f"{METRIC_PREFIX}skipped", 0)
+        total = refined + skipped
+        stats = {
+            "refined": refined,
+            "skipped": skipped,
+            "skip_rate": skipped / total if total else 0.0,
+            "latency_saved_ms": counters.get(f"{METRIC_PREFIX}latency_saved_ms",
+                                             0)
+        }
+        skip_prefix = f"{METRIC_PREFIX}skipped:"
+        for name, value in counters.items():
+            if name.startswith(skip_prefix):
+                stats[f"skipped_{name[len(skip_prefix):]}"] = value
+        return stats
+
+
+# Initialize the refine classifier
+refine_classifier = RefineClassifier()
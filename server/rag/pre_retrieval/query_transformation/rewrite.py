@@ -1,6 +1,6 @@
 import re
-import py3langid as langid
 from server.logger.logger_config import my_logger as logger
+from server.rag.pre_retrieval.query_transformation.language_detector import language_detector
 
 
 def detect_query_lang(query: str) -> str:
@@ -20,7 +20,7 @@ def detect_query_lang(query: str) -> str:
     }
 
     # Detect the language of the query
-    lang, _ = langid.classify(query)
+    lang = language_detector.detect(query)
 
     # Get the full language name
     full_language = lang_map.get(lang, 'English')
@@ -29,7 +29,7 @@ def detect_query_lang(query: str) -> str:
 
 def query_rewrite(query: str, bot_topic: str) -> str:
     # Detect the language of the query
-    lang, _ = langid.classify(query)
+    lang = language_detector.detect(query)
 
     # Convert to lowercase for case-insensitive comparison
     query_lower = query.lower()
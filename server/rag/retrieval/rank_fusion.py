@@ -0,0 +1,30 @@
+from typing import Dict, List, Tuple
+from langchain.schema.document import Document
+from server.constant.constants import RRF_K
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Tuple[Document, float]]],
+                           k: int = RRF_K) -> List[Tuple[Document, float]]:
+    """ Fuses the ranked results of several queries by reciprocal rank.
+
+    Documents are identified by the `id` of their metadata. The fused list is sorted by the RRF score,
+    and each document keeps its best relevance score, so that it can still be filtered and reranked.
+
+    Args:
+        result_lists (List[List[Tuple[Document, float]]]): The results of each query, sorted by relevance.
+        k (int): The constant of RRF, damping the weight of the top ranks.
+
+    Returns:
+        List[Tuple[Document, float]]: The fused documents with their best relevance score.
+    """
+    rrf_scores: Dict[str, float] = {}
+    best_results: Dict[str, Tuple[Document, float]] = {}
+    for results in result_lists:
+        for rank, (doc, score) in enumerate(results, start=1):
+            doc_id = doc.metadata.get("id", doc.page_content)
+            rrf_scores[doc_id] = rrf_scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+            best_result = best_results.get(doc_id)
+            if best_result is None or score > best_result[1]:
+                best_results[doc_id] = (doc, score)
+    fused_ids = sorted(rrf_scores, key=lambda x: rrf_scores[x], reverse=True)
+    return [best_results[doc_id] for doc_id in fused_ids]
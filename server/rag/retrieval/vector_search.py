@@ -1,5 +1,6 @@
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from langchain.schema.document import Document
+from server.app.utils.lazy_singleton import LazySingleton
 from server.rag.index.embedder.document_embedder import document_embedder
 
 
@@ -30,16 +31,72 @@ class VectorSearch:
         """
         ret = self.vector_db.similarity_search_with_score(query=query, k=k)
 
-    def similarity_search_with_relevance_scores(self,
-                                                query: str,
-                                                k: int = 4) -> List[Tuple[
-                                                    Document, float]]:
+    def similarity_search_with_relevance_scores(
+            self,
+            query: str,
+            k: int = 4,
+            where: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[Document, float]]:
         """
         Return docs and relevance scores in the range [0, 1].
         0 is dissimilar, 1 is most similar.
+        `where` filters the docs by metadata.
         """
         return self.vector_db.similarity_search_with_relevance_scores(
-            query=query, k=k)
+            query=query, k=k, filter=where)
+
+    def batch_similarity_search_with_relevance_scores(
+            self,
+            queries: List[str],
+            k: int = 4,
+            where: Optional[Dict[str, Any]] = None
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Embed several queries in one batched request, then search them in one query of the Chroma collection.
+        Return the docs and relevance scores in the range [0, 1] of each query, in order.
+        A query whose embedding failed gets no docs.
+        """
+        embeddings = document_embedder.query_embedding_cache.embed_queries(
+            queries)
+        valid_embeddings = [embedding for embedding in embeddings if embedding]
+        if not valid_embeddings:
+            return [[] for _ in queries]
+        results = self.vector_db._collection.query(
+            query_embeddings=valid_embeddings,
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas", "distances"])
+        relevance_score_fn = self.vector_db._select_relevance_score_fn()
+        result_lists = iter(
+            [[(Document(page_content=text, metadata=metadata or {}),
+               relevance_score_fn(distance))
+              for text, metadata, distance in zip(texts, metadatas,
+                                                  distances)]
+             for texts, metadatas, distances in zip(
+                 results["documents"], results["metadatas"],
+                 results["distances"])])
+        return [
+            next(result_lists) if embedding else []
+            for embedding in embeddings
+        ]
+
+    def get_documents_by_chunk_ids(self,
+                                   chunk_ids: List[str]) -> Dict[str, Document]:
+        """
+        Return the current docs of the chunks with the given metadata `id`, e.g. '1-5-part0'.
+        The chunks that were deleted are missing.
+        """
+        if not chunk_ids:
+            return {}
+        ret = self.vector_db.get(where={"id": {
+            "$in": chunk_ids
+        }},
+                                 include=["documents", "metadatas"])
+        return {
+            metadata["id"]: Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(ret["documents"], ret["metadatas"])
+            if metadata and "id" in metadata
+        }
 
 
-vector_search = VectorSearch()
+vector_search = LazySingleton('vector_search', VectorSearch)